@@ -9,6 +9,5 @@ puppetconfig add-valid-fact-value atp_policy linux_postgres12
 puppetconfig add-valid-fact-value atp_policy linux_postgres9.5
 puppetconfig add-valid-fact-value atp_policy linux_postgres9.6
 puppetconfig add-valid-fact-value atp_policy linux_solr
-puppetconfig add-valid-fact-value atp_policy linux_solr
 puppetconfig add-valid-fact-value atp_policy linux_splunk
 puppetconfig add-valid-fact-value atp_policy linux_std
\ No newline at end of file
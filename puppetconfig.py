@@ -3,60 +3,321 @@
 # -----------------------------------------------------------------------------
 # Required Pip Modules
 # -----------------------------------------------------------------------------
-# azure.data.tables >= 12.1.0
+# azure.data.tables >= 12.1.0
 # azure.core >= 1.16.0
 # PyYAML >= 5.4.1
 # prettytable >= 2.1.0
+# aiohttp >= 3.8.0
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
 # To Do:
 # -----------------------------------------------------------------------------
-# lock file for generate
 #   delete-valid-fact <fact> *PARTIAL*
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
 # Import Modules
+# The command modules, and the azure SDK, are imported by the command
+# handlers when they are needed, so that help, config checks and reads from
+# the local replica start quickly
 # -----------------------------------------------------------------------------
 import os
 import sys
 import argparse
-from puppetconfig_functions import *
-from puppetconfig_generate import *
-from puppetconfig_validate import *
-from puppetconfig_constants import DEFAULT_CONFIG_FILE
+import itertools
+from puppetconfig_config import get_config, check_config
+from puppetconfig_stats import start_stats, finish_stats, phase
+from puppetconfig_client import get_table_client
+from puppetconfig_replica import use_replica, replica_list_machines, replica_list_machines_with_fact
+from puppetconfig_replica import replica_get_machine, replica_list_valid_facts, replica_list_valid_values
+from puppetconfig_constants import DEFAULT_CONFIG_FILE, EXIT_UNCHANGED, EXIT_DEFERRED, DEFAULT_WATCH_INTERVAL, DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL, DEFAULT_CACHE_MAX_AGE
+from puppetconfig_constants import DEFAULT_REPLICA_FILE, DEFAULT_REPLICA_MAX_STALENESS, DEFAULT_CONCURRENCY, OUTPUT_FORMATS
+from puppetconfig_constants import MAX_PAGE_SIZE
 import puppetconfig_globals as gbl
 
-# External Modules
+# -----------------------------------------------------------------------------
+# Command registry
+# Maps each command to its handler, called as handler(table_client, args).
+# Commands registered with offline=True can be run with --offline
+# -----------------------------------------------------------------------------
+COMMANDS = {}
+OFFLINE_COMMANDS = []
 
-try:
-    from azure.data.tables import TableServiceClient
-except ModuleNotFoundError:
-    print("Module azure.data.tables not instaled [pip3 install azure.data.tables]")
-    sys.exit(2)
+def command(name, offline=False):
 
-try:
-    from azure.core.credentials import AzureSasCredential
-except ModuleNotFoundError:
-    print("Module azure.core not instaled [pip3 install azure.core]")
-    sys.exit(2)
+    def register(handler):
+        COMMANDS[name] = handler
+        if offline:
+            OFFLINE_COMMANDS.append(name)
+        return handler
 
+    return register
 
 # -----------------------------------------------------------------------------
-# Main Function
+# Function to check that set-fact/delete-fact have either a machine or a
+# selector, but not both
 # -----------------------------------------------------------------------------
-def main():
+def check_machine_selection(args):
 
-    # Initialise Global Variables
-    gbl.init()
+    selected = args.where is not None or args.machines_file is not None
 
-    # Parse command line options
+    if args.machine is None and not selected:
+        print("Specify a machine, --where or --machines-from")
+        sys.exit(1)
+
+    if args.machine is not None and selected:
+        print("Specify a machine, or --where/--machines-from, not both")
+        sys.exit(1)
+
+# -----------------------------------------------------------------------------
+# Function to check the --page-size, --limit and --continue-from options of a
+# list command, and return True if the local replica should be used
+# Continuation tokens are for the table, so --continue-from always reads the
+# table. --limit is applied to replica reads
+# -----------------------------------------------------------------------------
+def check_paging(args):
+
+    if args.page_size is not None and not 1 <= args.page_size <= MAX_PAGE_SIZE:
+        print("--page-size must be between 1 and", MAX_PAGE_SIZE)
+        sys.exit(1)
+
+    if args.limit is not None and args.limit < 1:
+        print("--limit must be at least 1")
+        sys.exit(1)
+
+    if args.continue_from is not None:
+        if gbl.OFFLINE:
+            print("--continue-from is not available with --offline")
+            sys.exit(1)
+        return False
+
+    return use_replica()
+
+# -----------------------------------------------------------------------------
+# Function to apply --limit to records read from the local replica
+# -----------------------------------------------------------------------------
+def limit_records(records, limit):
+
+    return list(itertools.islice(records, limit))
+
+# -----------------------------------------------------------------------------
+# Command handlers
+# -----------------------------------------------------------------------------
+
+@command('list-machines', offline=True)
+def run_list_machines(table_client, args):
+
+    from puppetconfig_output import print_machines
+    if check_paging(args):
+        print_machines(limit_records(replica_list_machines(), args.limit))
+    else:
+        from puppetconfig_functions import do_list_machines
+        do_list_machines(table_client, args.page_size, args.limit, args.continue_from)
+
+@command('list-machines-with-fact', offline=True)
+def run_list_machines_with_fact(table_client, args):
+
+    from puppetconfig_output import print_machines_with_fact
+    if check_paging(args):
+        print_machines_with_fact(limit_records(replica_list_machines_with_fact(args.fact, args.value), args.limit), args.fact)
+    else:
+        from puppetconfig_functions import do_list_machines_with_fact
+        do_list_machines_with_fact(table_client, args.fact, args.value, args.page_size, args.limit, args.continue_from)
+
+@command('show-machine', offline=True)
+def run_show_machine(table_client, args):
+
+    from puppetconfig_output import print_machine
+    if use_replica():
+        record = replica_get_machine(args.machine)
+        if record is None:
+            print("Machine", args.machine, "does not exist")
+            sys.exit(1)
+        print_machine(args.machine, record)
+    else:
+        from puppetconfig_functions import do_show_machine
+        do_show_machine(table_client, args.machine)
+
+@command('set-fact')
+def run_set_fact(table_client, args):
+
+    check_machine_selection(args)
+    if args.machine is None:
+        from puppetconfig_bulk import do_bulk_set_fact
+        do_bulk_set_fact(table_client, args.where, args.machines_file, args.fact, args.value)
+    else:
+        from puppetconfig_functions import do_set_fact
+        do_set_fact(table_client, args.machine, args.fact, args.value)
+
+@command('delete-fact')
+def run_delete_fact(table_client, args):
+
+    check_machine_selection(args)
+    if args.machine is None:
+        from puppetconfig_bulk import do_bulk_delete_fact
+        do_bulk_delete_fact(table_client, args.where, args.machines_file, args.fact)
+    else:
+        from puppetconfig_functions import do_delete_fact
+        do_delete_fact(table_client, args.machine, args.fact)
+
+@command('add-machine')
+def run_add_machine(table_client, args):
+
+    from puppetconfig_functions import do_add_machine
+    do_add_machine(table_client, args.machine, args.facts_values)
+
+@command('delete-machine')
+def run_delete_machine(table_client, args):
+
+    from puppetconfig_functions import do_delete_machine
+    do_delete_machine(table_client, args.machine)
+
+@command('generate')
+def run_generate_command(table_client, args):
+
+    if args.watch:
+        from puppetconfig_watch import do_watch
+        do_watch(table_client, args.config_file, args.interval)
+        sys.exit(0)
+
+    from puppetconfig_generate import do_generate
+    changed = do_generate(table_client, args.config_file, args.full_sync)
+    if args.exit_code and changed is None:
+        sys.exit(EXIT_DEFERRED)
+    if args.exit_code and not changed:
+        sys.exit(EXIT_UNCHANGED)
+
+@command('diff')
+def run_diff(table_client, args):
+
+    from puppetconfig_diff import do_diff
+    differences = do_diff(table_client, args.config_file)
+    if args.exit_code and not differences:
+        sys.exit(EXIT_UNCHANGED)
+
+@command('validate')
+def run_validate(table_client, args):
+
+    from puppetconfig_validate import do_validate
+    do_validate(table_client, args.config_file)
+
+@command('add-valid-fact')
+def run_add_valid_fact(table_client, args):
+
+    from puppetconfig_functions import do_add_valid_fact
+    do_add_valid_fact(table_client, args.fact)
+
+@command('list-valid-fact', offline=True)
+def run_list_valid_fact(table_client, args):
+
+    from puppetconfig_output import print_valid_facts
+    if check_paging(args):
+        print_valid_facts(limit_records(replica_list_valid_facts(), args.limit))
+    else:
+        from puppetconfig_functions import do_list_valid_fact
+        do_list_valid_fact(table_client, args.page_size, args.limit, args.continue_from)
+
+@command('delete-valid-fact')
+def run_delete_valid_fact(table_client, args):
+
+    from puppetconfig_functions import do_delete_valid_fact
+    do_delete_valid_fact(table_client, args.fact)
+
+@command('add-valid-fact-value')
+def run_add_valid_fact_value(table_client, args):
+
+    from puppetconfig_functions import do_add_valid_fact_value
+    do_add_valid_fact_value(table_client, args.fact, args.value)
+
+@command('list-valid-fact-value', offline=True)
+def run_list_valid_fact_value(table_client, args):
+
+    from puppetconfig_output import print_valid_values
+    if check_paging(args):
+        print_valid_values(args.fact, limit_records(replica_list_valid_values(args.fact), args.limit))
+    else:
+        from puppetconfig_functions import do_list_valid_fact_value
+        do_list_valid_fact_value(table_client, args.fact, args.page_size, args.limit, args.continue_from)
+
+@command('delete-valid-fact-value')
+def run_delete_valid_fact_value(table_client, args):
+
+    from puppetconfig_functions import do_delete_valid_fact_value
+    do_delete_valid_fact_value(table_client, args.fact, args.value)
+
+@command('import-catalogue')
+def run_import_catalogue(table_client, args):
+
+    from puppetconfig_catalogue import do_import_catalogue
+    do_import_catalogue(table_client, args.catalogue_file, args.prune)
+
+@command('reindex')
+def run_reindex(table_client, args):
+
+    if not gbl.FACT_INDEX:
+        print("fact_index is not enabled in", args.config_file)
+        sys.exit(1)
+
+    from puppetconfig_functions import do_reindex
+    do_reindex(table_client)
+
+@command('migrate-valid-values')
+def run_migrate_valid_values(table_client, args):
+
+    from puppetconfig_functions import do_migrate_valid_values
+    do_migrate_valid_values(table_client)
+
+@command('sync')
+def run_sync(table_client, args):
+
+    from puppetconfig_functions import do_sync
+    do_sync(table_client)
+
+@command('shell', offline=True)
+def run_shell(table_client, args):
+
+    from puppetconfig_shell import do_shell
+    do_shell(table_client, get_parser(), run_command)
+
+@command('check-config', offline=True)
+def run_check_config(table_client, args):
+
+    errors = check_config(get_config(args.config_file))
+    if len(errors) > 0:
+        for error in errors:
+            print(error)
+        sys.exit(1)
+
+    print("Config file", args.config_file, "OK")
+
+# -----------------------------------------------------------------------------
+# Function to add the paging options to a list command
+# -----------------------------------------------------------------------------
+def add_paging_arguments(subparser):
+
+    subparser.add_argument('--page-size', action='store', type=int, dest='page_size',
+                           help=f'Entities to read per request (1-{MAX_PAGE_SIZE})')
+    subparser.add_argument('--limit', action='store', type=int, dest='limit', help='Stop after this many results')
+    subparser.add_argument('--continue-from', action='store', dest='continue_from', metavar='TOKEN',
+                           help='Continue a list that stopped at --limit')
+
+# -----------------------------------------------------------------------------
+# Function to build the command line parser
+# The shell command parses each line it reads with the same parser
+# -----------------------------------------------------------------------------
+def get_parser():
 
     parser = argparse.ArgumentParser(description='Utility to manage puppet fact configuration')
     parser.add_argument('--debug', action='store_true', dest='debug_flag')
     parser.add_argument('--verbose', action='store_true', dest='verbose_flag')
     parser.add_argument('--config-file', action='store', dest='config_file')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache_flag', help='Do not use the local valid fact catalogue cache')
+    parser.add_argument('--offline', action='store_true', dest='offline_flag', help='Read from the local replica without contacting Azure')
+    parser.add_argument('--output', action='store', dest='output', choices=OUTPUT_FORMATS, default='table',
+                        help='Output format for list and show commands')
+    parser.add_argument('--stats', action='store_true', dest='stats_flag', help='Print a summary of table requests and timings to stderr')
+    parser.add_argument('--trace', action='store', dest='trace_file', help='Write each table request to a file as a JSON line')
     parser.set_defaults(config_file=DEFAULT_CONFIG_FILE)
 
     subparsers = parser.add_subparsers(help='Available Commands - puppetconfig <command> -h for more detail')
@@ -64,12 +325,14 @@ def main():
     # list-machines command
     list_machines_parser = subparsers.add_parser('list-machines', help='List Machines')
     list_machines_parser.set_defaults(command_type='list-machines')
+    add_paging_arguments(list_machines_parser)
 
     # list-machines-with-fact command
     lmwf_parser = subparsers.add_parser('list-machines-with-fact', help='List Machines with specific fact')
     lmwf_parser.set_defaults(command_type='list-machines-with-fact')
     lmwf_parser.add_argument('fact', action='store', help='Fact Name')
     lmwf_parser.add_argument('--value', action='store', dest='value', help='Specific Value')
+    add_paging_arguments(lmwf_parser)
  
     # show-machines command
     show_machine_parser = subparsers.add_parser('show-machine', help='Show Machine Detail')
@@ -77,17 +340,23 @@ def main():
     show_machine_parser.add_argument('machine', action='store', help='Machine Name')
 
     # set-fact command
-    set_fact_parser = subparsers.add_parser('set-fact', help='Set fact value for a machine')
+    set_fact_parser = subparsers.add_parser('set-fact', help='Set fact value for a machine, or for selected machines')
     set_fact_parser.set_defaults(command_type='set-fact')
-    set_fact_parser.add_argument('machine', action='store', help='Machine Name')
+    set_fact_parser.add_argument('machine', action='store', nargs='?', help='Machine Name (omit with --where or --machines-from)')
     set_fact_parser.add_argument('fact', action='store', help='Fact Name')
     set_fact_parser.add_argument('value', action='store', help='Fact Value')
+    set_fact_selector = set_fact_parser.add_mutually_exclusive_group()
+    set_fact_selector.add_argument('--where', action='append', dest='where', help='Select machines with fact=value (may be repeated)')
+    set_fact_selector.add_argument('--machines-from', action='store', dest='machines_file', help='Select machines listed in a file')
 
     # delete-fact command
-    delete_fact_parser = subparsers.add_parser('delete-fact', help='Delete fact for a machine')
+    delete_fact_parser = subparsers.add_parser('delete-fact', help='Delete fact for a machine, or for selected machines')
     delete_fact_parser.set_defaults(command_type='delete-fact')
-    delete_fact_parser.add_argument('machine', action='store', help='Machine Name')
+    delete_fact_parser.add_argument('machine', action='store', nargs='?', help='Machine Name (omit with --where or --machines-from)')
     delete_fact_parser.add_argument('fact', action='store', help='Fact Name')
+    delete_fact_selector = delete_fact_parser.add_mutually_exclusive_group()
+    delete_fact_selector.add_argument('--where', action='append', dest='where', help='Select machines with fact=value (may be repeated)')
+    delete_fact_selector.add_argument('--machines-from', action='store', dest='machines_file', help='Select machines listed in a file')
 
     # add-machine command
     add_machine_parser = subparsers.add_parser('add-machine', help='Add a new machine')
@@ -103,6 +372,16 @@ def main():
     # generate command
     generate_parser = subparsers.add_parser('generate', help='generate facts.yaml file')
     generate_parser.set_defaults(command_type='generate')
+    generate_parser.add_argument('--full', action='store_true', dest='full_sync', help='Read the whole table instead of only changes')
+    generate_parser.add_argument('--exit-code', action='store_true', dest='exit_code', help=f'Exit with status {EXIT_UNCHANGED} if the facts file is unchanged, or {EXIT_DEFERRED} if another generate is running and will do another pass')
+    generate_parser.add_argument('--watch', action='store_true', dest='watch', help='Keep running and regenerate when the table changes')
+    generate_parser.add_argument('--interval', action='store', type=int, dest='interval', help='Seconds between polls in watch mode')
+    generate_parser.set_defaults(interval=DEFAULT_WATCH_INTERVAL)
+
+    # diff command
+    diff_parser = subparsers.add_parser('diff', help='Show what generate would change in the facts file')
+    diff_parser.set_defaults(command_type='diff')
+    diff_parser.add_argument('--exit-code', action='store_true', dest='exit_code', help=f'Exit with status {EXIT_UNCHANGED} if there are no differences')
 
     # validate command
     validate_parser = subparsers.add_parser('validate', help='validate facts.yaml file')
@@ -116,6 +395,7 @@ def main():
     # list-valid-fact command
     lvf_parser = subparsers.add_parser('list-valid-fact', help='List valid facts')
     lvf_parser.set_defaults(command_type='list-valid-fact')
+    add_paging_arguments(lvf_parser)
 
     # delete-valid-fact command
     dvf_parser = subparsers.add_parser('delete-valid-fact', help='Delete a valid fact')
@@ -132,6 +412,7 @@ def main():
     lvfv_parser = subparsers.add_parser('list-valid-fact-value', help='List valid fact values')
     lvfv_parser.set_defaults(command_type='list-valid-fact-value')
     lvfv_parser.add_argument('fact', action='store', help='Fact Name')
+    add_paging_arguments(lvfv_parser)
 
     # delete-valid-fact-value command
     dvfv_parser = subparsers.add_parser('delete-valid-fact-value', help='Delete a valid fact value')
@@ -139,6 +420,62 @@ def main():
     dvfv_parser.add_argument('fact', action='store', help='Fact Name')
     dvfv_parser.add_argument('value', action='store', help='Valid Value To Delete')
 
+    # import-catalogue command
+    ic_parser = subparsers.add_parser('import-catalogue', help='Import valid facts and values from a YAML or CSV file')
+    ic_parser.set_defaults(command_type='import-catalogue')
+    ic_parser.add_argument('catalogue_file', action='store', help='Catalogue File (.yml/.yaml or .csv)')
+    ic_parser.add_argument('--prune', action='store_true', dest='prune', help='Remove valid values not listed in the file')
+
+    # reindex command
+    reindex_parser = subparsers.add_parser('reindex', help='Rebuild the fact index')
+    reindex_parser.set_defaults(command_type='reindex')
+
+    # migrate-valid-values command
+    mvv_parser = subparsers.add_parser('migrate-valid-values', help='Migrate valid fact values to fact|value RowKeys')
+    mvv_parser.set_defaults(command_type='migrate-valid-values')
+
+    # sync command
+    sync_parser = subparsers.add_parser('sync', help='Refresh the local replica from the Azure table')
+    sync_parser.set_defaults(command_type='sync')
+
+    # shell command
+    shell_parser = subparsers.add_parser('shell', help='Interactive shell, keeping the table client and catalogue between commands')
+    shell_parser.set_defaults(command_type='shell')
+
+    # check-config command
+    cc_parser = subparsers.add_parser('check-config', help='Check the configuration file')
+    cc_parser.set_defaults(command_type='check-config')
+
+    return parser
+
+# -----------------------------------------------------------------------------
+# Function to run a command
+# -----------------------------------------------------------------------------
+def run_command(table_client, args, parser):
+
+    if gbl.OFFLINE and args.command_type not in OFFLINE_COMMANDS:
+        print(args.command_type, "is not available with --offline")
+        sys.exit(1)
+
+    handler = COMMANDS.get(args.command_type)
+    if handler is None:
+        print("Invalid command")
+        parser.print_help()
+        sys.exit(1)
+
+    handler(table_client, args)
+
+# -----------------------------------------------------------------------------
+# Main Function
+# -----------------------------------------------------------------------------
+def main():
+
+    # Initialise Global Variables
+    gbl.init()
+
+    # Parse command line options
+    parser = get_parser()
+
     # Parse arguments
     args = parser.parse_args()
     if 'command_type' not in args:
@@ -152,8 +489,22 @@ def main():
     if args.verbose_flag:
         gbl.VERBOSE = True
 
+    if args.offline_flag:
+        gbl.OFFLINE = True
+
+    gbl.OUTPUT = args.output
+
+    if args.stats_flag or args.trace_file is not None:
+        start_stats(args.trace_file)
+
     # Load settings from config file
-    cfg = get_config(args.config_file)
+    with phase('config'):
+        cfg = get_config(args.config_file)
+
+    # check-config reports missing settings itself
+    if args.command_type == 'check-config':
+        run_command(None, args, parser)
+        sys.exit(0)
 
     # Set proxy if required
     proxy = cfg['azure']['proxy']
@@ -166,61 +517,36 @@ def main():
     sas_token = cfg['azure']['sas_token']
     endpoint = cfg['azure']['endpoint']
 
-    table_service_client = TableServiceClient(endpoint=endpoint, credential=AzureSasCredential(sas_token))
-    table_client = table_service_client.get_table_client(table_name=table_name)
+    table_client = get_table_client(endpoint, sas_token, table_name)
 
-    # Perform function here
+    # Fact index
+    if cfg['azure'].get('fact_index', False) == True:
+        gbl.FACT_INDEX = True
 
-    if args.command_type == 'list-machines':
-        do_list_machines(table_client)
+    # Concurrent requests for multi-entity commands
+    gbl.CONCURRENCY = cfg['azure'].get('concurrency', DEFAULT_CONCURRENCY)
 
-    elif args.command_type == 'list-machines-with-fact':
-        do_list_machines_with_fact(table_client, args.fact, args.value)
+    # Key for this table in the catalogue cache and local replica
+    gbl.CACHE_KEY = f"{endpoint}/{table_name}"
 
-    elif args.command_type == 'show-machine':
-        do_show_machine(table_client, args.machine)
-
-    elif args.command_type == 'set-fact':
-        do_set_fact(table_client, args.machine, args.fact, args.value)
-
-    elif args.command_type == 'delete-fact':
-        do_delete_fact(table_client, args.machine, args.fact)
-
-    elif args.command_type == 'add-machine':
-        do_add_machine(table_client, args.machine, args.facts_values)
-
-    elif args.command_type == 'delete-machine':
-        do_delete_machine(table_client, args.machine)
-
-    elif args.command_type == 'generate':
-        do_generate(table_client, args.config_file)
-
-    elif args.command_type == 'validate':
-        do_validate(table_client, args.config_file)
+    # Catalogue cache settings
+    if not args.no_cache_flag:
+        cache_cfg = cfg.get('cache') or {}
+        gbl.CACHE_DIR = cache_cfg.get('cache_dir', DEFAULT_CACHE_DIR)
+        gbl.CACHE_TTL = cache_cfg.get('ttl', DEFAULT_CACHE_TTL)
+        gbl.CACHE_MAX_AGE = cache_cfg.get('max_age', DEFAULT_CACHE_MAX_AGE)
 
-    elif args.command_type == 'add-valid-fact':
-        do_add_valid_fact(table_client, args.fact)
+    # Local replica settings
+    replica_cfg = cfg.get('replica') or {}
+    gbl.REPLICA_FILE = replica_cfg.get('file', DEFAULT_REPLICA_FILE)
+    gbl.REPLICA_MAX_STALENESS = replica_cfg.get('max_staleness', DEFAULT_REPLICA_MAX_STALENESS)
 
-    elif args.command_type == 'list-valid-fact':
-        do_list_valid_fact(table_client)
-
-    elif args.command_type == 'delete-valid-fact':
-        do_delete_valid_fact(table_client, args.fact)
-
-    elif args.command_type == 'add-valid-fact-value':
-        do_add_valid_fact_value(table_client, args.fact, args.value)
-    
-    elif args.command_type == 'list-valid-fact-value':
-        do_list_valid_fact_value(table_client, args.fact)
-
-    elif args.command_type == 'delete-valid-fact-value':
-        do_delete_valid_fact_value(table_client, args.fact, args.value)
+    # Perform function here
+    try:
+        run_command(table_client, args, parser)
+    finally:
+        finish_stats(args.stats_flag)
 
-    else:
-        print("Invalid command")
-        parser.print_help()
-        sys.exit(1)
-    
     # Done
     sys.exit(0)
 
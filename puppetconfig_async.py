@@ -0,0 +1,133 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import asyncio
+from puppetconfig_stats import InstrumentedAsyncTableClient
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from azure.core.exceptions import ResourceNotFoundError
+except:
+    print("Module azure.core not instaled [pip3 install azure.core]")
+    sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Async execution layer for commands that touch many entities
+# Requests are issued concurrently on an azure.data.tables.aio client, with at
+# most gbl.CONCURRENCY requests in flight at once. The functions here return
+# results (or exceptions) to the synchronous callers in puppetconfig_functions,
+# which report errors in the usual way
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Function to return an async table client for the same table, endpoint and
+# credential as a synchronous table client
+# The async SDK and aiohttp are only imported when first needed, as they add
+# noticeably to the startup time of every command
+# -----------------------------------------------------------------------------
+def get_async_table_client(table_client):
+
+    try:
+        import aiohttp
+    except ModuleNotFoundError:
+        print("Module aiohttp not instaled [pip3 install aiohttp]")
+        sys.exit(2)
+
+    try:
+        from azure.data.tables.aio import TableClient as AsyncTableClient
+    except ModuleNotFoundError:
+        print("Module azure.data.tables not instaled [pip3 install azure.data.tables]")
+        sys.exit(2)
+
+    return AsyncTableClient(endpoint=table_client.url, table_name=table_client.table_name,
+                            credential=table_client.credential)
+
+# -----------------------------------------------------------------------------
+# Function to run an async function from synchronous code
+# The function is called as function(client, semaphore, *args) with an async
+# table client that is closed when it returns
+# -----------------------------------------------------------------------------
+def run_async(table_client, function, *args):
+
+    async def runner():
+        semaphore = asyncio.Semaphore(gbl.CONCURRENCY)
+        client = get_async_table_client(table_client)
+        if gbl.STATS is not None:
+            client = InstrumentedAsyncTableClient(client)
+        async with client:
+            return await function(client, semaphore, *args)
+
+    return asyncio.run(runner())
+
+# -----------------------------------------------------------------------------
+# Function to run several queries concurrently
+# queries is a list of (query, select) pairs. Returns a list with the records
+# from each query, or the exception it raised
+# -----------------------------------------------------------------------------
+async def query_entities_async(client, semaphore, queries):
+
+    async def query(query_filter, select):
+        async with semaphore:
+            return [record async for record in client.query_entities(query_filter, select=select)]
+
+    return await asyncio.gather(*[query(query_filter, select) for query_filter, select in queries],
+                                return_exceptions=True)
+
+# -----------------------------------------------------------------------------
+# Function to read several entities from one partition concurrently
+# Returns a dictionary of RowKey -> entity, or None if the entity does not
+# exist. Other errors are raised
+# -----------------------------------------------------------------------------
+async def get_entities_async(client, semaphore, partition_key, row_keys, select=None):
+
+    async def get(row_key):
+        async with semaphore:
+            try:
+                return await client.get_entity(partition_key, row_key, select=select)
+            except ResourceNotFoundError:
+                return None
+
+    row_keys = list(row_keys)
+    records = await asyncio.gather(*[get(row_key) for row_key in row_keys])
+
+    return dict(zip(row_keys, records))
+
+# -----------------------------------------------------------------------------
+# Function to submit transactional batches concurrently
+# Returns a list with the result of each batch, or the exception it raised
+# -----------------------------------------------------------------------------
+async def submit_transactions_async(client, semaphore, batches):
+
+    async def submit(batch):
+        async with semaphore:
+            return await client.submit_transaction(batch)
+
+    return await asyncio.gather(*[submit(batch) for batch in batches], return_exceptions=True)
+
+# -----------------------------------------------------------------------------
+# Function to apply operations to individual entities concurrently
+# Operations use the same (operation, entity[, options]) form as
+# transactional batches. Returns a list with None for each operation that
+# succeeded, or the exception it raised
+# -----------------------------------------------------------------------------
+async def apply_operations_async(client, semaphore, operations):
+
+    async def apply(operation):
+        action, entity = operation[0], operation[1]
+        options = operation[2] if len(operation) > 2 else {}
+        async with semaphore:
+            if action == 'delete':
+                await client.delete_entity(partition_key=entity['PartitionKey'], row_key=entity['RowKey'], **options)
+            elif action == 'create':
+                await client.create_entity(entity=entity)
+            elif action == 'update':
+                await client.update_entity(entity=entity, **options)
+            else:
+                await client.upsert_entity(entity=entity, **options)
+
+    return await asyncio.gather(*[apply(operation) for operation in operations], return_exceptions=True)
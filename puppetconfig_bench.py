@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Benchmarks for puppetconfig
+# Run with: python3 puppetconfig_bench.py
+#                [--suite all|startup|commands|serializer]
+#                [--machines N] [--latency MS] [--throttle RATE]
+# The startup suite checks the import time of commands that don't use the
+# table. The commands suite runs commands against an in-memory fake table
+# holding a synthetic fleet, and records wall time, requests and peak memory.
+# The serializer suite times writing and reading the fleet's facts file in
+# each format
+# Exits with 1 if any benchmark is over its budget
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import io
+import os
+import sys
+import grp
+import pwd
+import math
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+from puppetconfig_constants import STARTUP_IMPORT_BUDGET_MS, STARTUP_FORBIDDEN_MODULES, STARTUP_HELP_FORBIDDEN_MODULES
+from puppetconfig_constants import DEFAULT_CONCURRENCY
+from puppetconfig_constants import BENCH_ROUND_TRIP_BUDGETS, FAKE_PAGE_SIZE, PUPPETCFG_PK
+import puppetconfig_globals as gbl
+
+# Directory containing puppetconfig.py
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# -----------------------------------------------------------------------------
+# Function to run python with -X importtime
+# Returns a dictionary of module -> (cumulative import time in microseconds,
+# True if imported at the top level rather than by another module)
+# -----------------------------------------------------------------------------
+def get_import_times(arguments):
+
+    command = [sys.executable, '-X', 'importtime'] + arguments
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=BENCH_DIR)
+
+    # Lines are "import time: self [us] | cumulative | imported package", with
+    # the package indented by two spaces for each level of nesting
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        module = fields[2].strip()
+        import_times[module] = (int(fields[1]), not fields[2].startswith('   '))
+
+    return import_times
+
+# -----------------------------------------------------------------------------
+# Function to check the startup cost of commands that don't use the table
+# Returns the number of failures
+# -----------------------------------------------------------------------------
+def bench_startup(config_file):
+
+    # Each command, with the top level packages it must not import
+    commands = [
+        (['--help'], STARTUP_HELP_FORBIDDEN_MODULES),
+        (['--config-file', config_file, 'check-config'], STARTUP_FORBIDDEN_MODULES),
+        (['--config-file', config_file, '--offline', 'list-machines'], STARTUP_FORBIDDEN_MODULES),
+    ]
+
+    # Modules imported by the interpreter itself aren't counted
+    interpreter_modules = get_import_times(['-c', 'pass'])
+
+    failures = 0
+    for arguments, forbidden_modules in commands:
+        import_times = get_import_times([os.path.join(BENCH_DIR, 'puppetconfig.py')] + arguments)
+
+        # Top level imports only - the cumulative times of nested imports are
+        # already included in them
+        total_ms = sum(cumulative for module, (cumulative, top_level) in import_times.items()
+                       if top_level and module not in interpreter_modules) / 1000
+        forbidden = sorted(module for module in import_times if module.split('.')[0] in forbidden_modules)
+
+        result = 'OK'
+        if len(forbidden) > 0:
+            result = f"FAIL - imports {', '.join(forbidden[:3])}"
+            failures += 1
+        elif total_ms > STARTUP_IMPORT_BUDGET_MS:
+            result = f"FAIL - over budget of {STARTUP_IMPORT_BUDGET_MS}ms"
+            failures += 1
+
+        print(f"startup {' '.join(arguments):<60} {total_ms:8.1f}ms  {result}")
+
+    return failures
+
+# -----------------------------------------------------------------------------
+# Function to write the config file used by the benchmarks
+# -----------------------------------------------------------------------------
+def write_bench_config(bench_dir):
+
+    config_file = f'{bench_dir}/puppetconfig.yml'
+    with open(config_file, 'w') as configfile:
+        configfile.write("azure:\n")
+        configfile.write("  table_name: puppetconfig\n")
+        configfile.write("  sas_token: none\n")
+        configfile.write("  endpoint: https://fake.table.core.windows.net\n")
+        configfile.write("  proxy: none\n")
+        configfile.write("generate:\n")
+        configfile.write(f"  facts_dir: {bench_dir}/facts\n")
+        configfile.write("  yaml_file: facts.yaml\n")
+        configfile.write(f"  puppet_user: {pwd.getpwuid(os.getuid()).pw_name}\n")
+        configfile.write(f"  puppet_group: {grp.getgrgid(os.getgid()).gr_name}\n")
+        configfile.write("replica:\n")
+        configfile.write(f"  file: {bench_dir}/replica.sqlite\n")
+
+    return config_file
+
+# -----------------------------------------------------------------------------
+# Function to run one command against the fake table
+# Returns (seconds, peak bytes allocated or None, exit code)
+# -----------------------------------------------------------------------------
+def run_bench_command(table, parser, run_command, arguments, trace_memory):
+
+    args = parser.parse_args(arguments)
+
+    # Each command starts as a new process would
+    gbl.CATALOGUE = None
+
+    if trace_memory:
+        tracemalloc.start()
+
+    status = 0
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            run_command(table, args, parser)
+        except SystemExit as err:
+            status = err.code or 0
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return seconds, peak, status
+
+# -----------------------------------------------------------------------------
+# Function to benchmark commands against a synthetic fleet
+# Returns the number of failures
+# -----------------------------------------------------------------------------
+def bench_commands(config_file, num_machines, latency, throttle_rate, fact_index, trace_memory):
+
+    # Imported here so that the startup suite runs without them
+    from prettytable import PrettyTable
+    from puppetconfig import get_parser, run_command
+    from puppetconfig_fake import FakeTableClient, use_fake_async_client, generate_fleet
+
+    gbl.init()
+    gbl.CONCURRENCY = DEFAULT_CONCURRENCY
+    gbl.FACT_INDEX = fact_index
+
+    use_fake_async_client()
+    table = FakeTableClient(latency=latency, throttle_rate=throttle_rate, throttle_delay=latency)
+
+    start = time.perf_counter()
+    machines = generate_fleet(table, num_machines, fact_index=fact_index)
+    print(f"Generated {num_machines} machines ({len(table.entities)} entities) in {time.perf_counter() - start:.1f}s")
+
+    # Commands are run in this order - diff and the second generate pick up
+    # the change made by set-fact, and the second generate is incremental
+    commands = [
+        ('list-machines', ['list-machines']),
+        ('list-machines-with-fact', ['list-machines-with-fact', 'fact00', '--value', 'fact00-value00']),
+        ('show-machine', ['show-machine', machines[0]]),
+        ('list-valid-fact', ['list-valid-fact']),
+        ('list-valid-fact-value', ['list-valid-fact-value', 'fact00']),
+        ('generate', ['generate']),
+        ('set-fact', ['set-fact', machines[0], 'fact01', 'fact01-value01']),
+        ('diff', ['diff']),
+        ('generate (incremental)', ['generate']),
+        ('validate', ['validate']),
+    ]
+
+    # Full scans of the machines partition take one request per page
+    pages = math.ceil(num_machines / FAKE_PAGE_SIZE)
+
+    parser = get_parser()
+    results = PrettyTable()
+    results.field_names = ['Command', 'Seconds', 'Requests', 'Budget', 'Throttled', 'Entities', 'Peak MB', 'Result']
+    results.align = 'l'
+
+    failures = 0
+    for name, arguments in commands:
+        table.reset_counters()
+        seconds, peak, status = run_bench_command(table, parser, run_command, ['--config-file', config_file] + arguments,
+                                                  trace_memory)
+
+        throttled = table.requests.pop('throttled', 0)
+        requests = sum(table.requests.values())
+        fixed, per_page = BENCH_ROUND_TRIP_BUDGETS[name]
+        budget = fixed + per_page * pages
+
+        result = 'OK'
+        if status != 0:
+            result = f"FAIL - exit {status}"
+            failures += 1
+        elif requests > budget:
+            result = "FAIL - over budget"
+            failures += 1
+
+        peak_mb = '-' if peak is None else f"{peak / 1048576:.1f}"
+        results.add_row([name, f"{seconds:.3f}", requests, budget, throttled, table.entities_returned, peak_mb, result])
+
+    print(results)
+
+    return failures
+
+# -----------------------------------------------------------------------------
+# Function to benchmark writing and reading a facts file in each format
+# Returns the number of failures
+# -----------------------------------------------------------------------------
+def bench_serializers(num_machines):
+
+    # Imported here so that the startup suite runs without them
+    import yaml
+    from prettytable import PrettyTable
+    from puppetconfig_fake import FakeTableClient, generate_fleet
+    from puppetconfig_generate import read_table_nodes
+    from puppetconfig_serializer import SERIALIZERS, YamlSerializer, get_yaml_dumper
+
+    gbl.init()
+
+    table = FakeTableClient()
+    generate_fleet(table, num_machines)
+    nodes = list(read_table_nodes(table, f"PartitionKey eq '{PUPPETCFG_PK}'", {'high_water': None}))
+    expected = {'server::facts': dict(nodes)}
+
+    yaml_name = 'yaml (libyaml)' if get_yaml_dumper() is getattr(yaml, 'CSafeDumper', None) else 'yaml'
+    serializers = [
+        ('yaml (pure python)', YamlSerializer(yaml.SafeDumper, yaml.SafeLoader)),
+        (yaml_name, SERIALIZERS['yaml']),
+        ('json', SERIALIZERS['json']),
+    ]
+
+    results = PrettyTable()
+    results.field_names = ['Format', 'Dump s', 'Load s', 'MB', 'Result']
+    results.align = 'l'
+
+    failures = 0
+    for name, serializer in serializers:
+        start = time.perf_counter()
+        parts = [serializer.node(nodename, record, count == 0) for count, (nodename, record) in enumerate(nodes)]
+        parts.append(serializer.end(len(nodes)))
+        content = ''.join(parts).encode('utf8')
+        dump_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = serializer.load(io.BytesIO(content))
+        load_seconds = time.perf_counter() - start
+
+        result = 'OK'
+        if loaded != expected:
+            result = "FAIL - facts differ after loading"
+            failures += 1
+
+        results.add_row([name, f"{dump_seconds:.3f}", f"{load_seconds:.3f}", f"{len(content) / 1048576:.1f}", result])
+
+    print(f"Facts file for {num_machines} machines")
+    print(results)
+
+    return failures
+
+# -----------------------------------------------------------------------------
+# Main Function
+# -----------------------------------------------------------------------------
+def main():
+
+    parser = argparse.ArgumentParser(description='puppetconfig benchmarks')
+    parser.add_argument('--suite', choices=['all', 'startup', 'commands', 'serializer'], default='all', help='Benchmarks to run')
+    parser.add_argument('--config-file', help='Config file used by the startup benchmarks (default: a generated one)')
+    parser.add_argument('--machines', type=int, default=10000, help='Number of machines in the synthetic fleet')
+    parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds each request to the fake table takes')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Fraction of requests to the fake table that are throttled')
+    parser.add_argument('--fact-index', action='store_true', help='Maintain the fact index')
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace memory use (tracing slows commands down)")
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as bench_dir:
+        config_file = write_bench_config(bench_dir)
+
+        if args.suite in ['all', 'startup']:
+            failures += bench_startup(args.config_file or config_file)
+
+        if args.suite in ['all', 'commands']:
+            failures += bench_commands(config_file, args.machines, args.latency / 1000, args.throttle, args.fact_index,
+                                       not args.no_memory)
+
+        if args.suite in ['all', 'serializer']:
+            failures += bench_serializers(args.machines)
+
+    if failures > 0:
+        sys.exit(1)
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,218 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import re
+import sys
+from os import path
+from puppetconfig_constants import PUPPETCFG_PK, PROPERTY_NAME_PATTERN
+from puppetconfig_functions import get_catalogue, check_catalogue, run_batches
+from puppetconfig_functions import get_fact_index_operations, apply_fact_index_operations
+from puppetconfig_async import run_async, get_entities_async
+from puppetconfig_replica import replica_set_fact, replica_delete_fact
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from azure.core import MatchConditions
+    from azure.core.exceptions import HttpResponseError
+except:
+    print("Module azure.core not instaled [pip3 install azure.core]")
+    sys.exit(2)
+
+try:
+    from prettytable import PrettyTable
+except ModuleNotFoundError:
+    print("Module prettytable not instaled [pip3 install prettytable]")
+    sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Function to read a list of machines from a file, one per line
+# Blank lines and lines starting with # are ignored
+# -----------------------------------------------------------------------------
+def read_machines_file(machines_file):
+
+    if not path.exists(machines_file):
+        print("Machines file", machines_file, "does not exist")
+        sys.exit(2)
+
+    machines = []
+    seen = set()
+    with open(machines_file, "r") as machinesfile:
+        for line in machinesfile:
+            machine = line.strip()
+            if machine == '' or machine.startswith('#') or machine in seen:
+                continue
+            machines.append(machine)
+            seen.add(machine)
+
+    return machines
+
+# -----------------------------------------------------------------------------
+# Function to return the machine records selected by --where or
+# --machines-from. Facts in --where must be valid property names. select
+# is the list of properties needed, or None for the whole record
+# -----------------------------------------------------------------------------
+def select_machines(table_client, where, machines_file, select):
+
+    # Machines matching all of the fact=value selectors
+    if where is not None:
+        query = f"PartitionKey eq '{PUPPETCFG_PK}'"
+        for selector in where:
+            if '=' not in selector:
+                print("Invalid selector", selector, "- expected fact=value")
+                sys.exit(1)
+            fact, value = selector.split('=', 1)
+            # The fact is a property name in the filter, so it can't be quoted
+            if not re.fullmatch(PROPERTY_NAME_PATTERN, fact):
+                print("Invalid fact", fact, "in selector", selector)
+                sys.exit(1)
+            value = value.replace("'", "''")
+            query += f" and {fact} eq '{value}'"
+
+        try:
+            records = list(table_client.query_entities(query, select=select))
+        except HttpResponseError as err:
+            print("Error getting list of machines")
+            print(err)
+            sys.exit(2)
+
+        return records
+
+    # Machines listed in a file, read concurrently
+    machines = read_machines_file(machines_file)
+    try:
+        found = run_async(table_client, get_entities_async, PUPPETCFG_PK, machines, select)
+    except HttpResponseError as err:
+        print("Error getting machines")
+        print(err)
+        sys.exit(2)
+
+    records = []
+    for machine in machines:
+        if found[machine] is None:
+            print("Machine", machine, "does not exist - skipped")
+            continue
+        records.append(found[machine])
+
+    return records
+
+# -----------------------------------------------------------------------------
+# Function to print a summary of each batch
+# Returns the list of operations in batches that succeeded
+# -----------------------------------------------------------------------------
+def print_batch_summary(batch_results):
+
+    table = PrettyTable()
+    table.field_names = ['Batch', 'Machines', 'Result']
+    table.align = 'l'
+
+    succeeded = []
+    num_failed = 0
+    for count, (batch, result) in enumerate(batch_results, 1):
+        if isinstance(result, HttpResponseError):
+            table.add_row([count, len(batch), f"Failed - {str(result).splitlines()[0]}"])
+            num_failed += len(batch)
+        else:
+            table.add_row([count, len(batch), 'Updated'])
+            succeeded += batch
+
+    print(table)
+    print(f"{len(succeeded)} machines updated, {num_failed} failed")
+
+    return succeeded
+
+# -----------------------------------------------------------------------------
+# Function to set a fact on all selected machines
+# The fact and value are validated once, then each machine is updated with a
+# MERGE of the one property, in transactional batches
+# -----------------------------------------------------------------------------
+def do_bulk_set_fact(table_client, where, machines_file, fact, value):
+
+    # Check fact and value against the valid fact catalogue
+    error = check_catalogue(get_catalogue(table_client), fact, value)
+    if error is not None:
+        print(error)
+        sys.exit(2)
+
+    records = select_machines(table_client, where, machines_file, ['RowKey', fact])
+    if len(records) == 0:
+        print("No machines selected")
+        return
+
+    print("Setting fact", fact, "value", value, "on", len(records), "machines")
+
+    old_values = {}
+    operations = []
+    for record in records:
+        old_values[record['RowKey']] = record.get(fact)
+        entity = {}
+        entity['PartitionKey'] = PUPPETCFG_PK
+        entity['RowKey'] = record['RowKey']
+        entity[fact] = value
+        options = {'mode': 'merge'}
+        if gbl.FACT_INDEX:
+            # The fact index is updated from the value read, so guard against
+            # it changing
+            options['etag'] = record.metadata['etag']
+            options['match_condition'] = MatchConditions.IfNotModified
+        operations.append(('update', entity, options))
+
+    succeeded = print_batch_summary(run_batches(table_client, operations))
+
+    # Update the fact index and local replica for machines that were updated
+    index_operations = []
+    for operation in succeeded:
+        machine = operation[1]['RowKey']
+        old_facts = {} if old_values[machine] is None else {fact: old_values[machine]}
+        if gbl.FACT_INDEX:
+            index_operations += get_fact_index_operations(machine, old_facts, {fact: value})
+        replica_set_fact(machine, fact, value)
+
+    apply_fact_index_operations(table_client, index_operations, "selected machines")
+
+    if len(succeeded) < len(operations):
+        sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Function to delete a fact from all selected machines
+# A property can't be removed with a MERGE, so each machine that has the fact
+# is written back without it (REPLACE) in transactional batches. Each write is
+# guarded by the record's ETag, so a batch containing a machine changed by
+# someone else fails rather than overwriting the change
+# -----------------------------------------------------------------------------
+def do_bulk_delete_fact(table_client, where, machines_file, fact):
+
+    records = select_machines(table_client, where, machines_file, None)
+    records = [record for record in records if record.get(fact) is not None]
+    if len(records) == 0:
+        print("No selected machines have fact", fact)
+        return
+
+    print("Deleting fact", fact, "from", len(records), "machines")
+
+    old_values = {}
+    operations = []
+    for record in records:
+        old_values[record['RowKey']] = record[fact]
+        entity = dict(record)
+        del entity[fact]
+        options = {'mode': 'replace', 'etag': record.metadata['etag'], 'match_condition': MatchConditions.IfNotModified}
+        operations.append(('update', entity, options))
+
+    succeeded = print_batch_summary(run_batches(table_client, operations))
+
+    # Update the fact index and local replica for machines that were updated
+    index_operations = []
+    for operation in succeeded:
+        machine = operation[1]['RowKey']
+        if gbl.FACT_INDEX:
+            index_operations += get_fact_index_operations(machine, {fact: old_values[machine]}, {})
+        replica_delete_fact(machine, fact)
+
+    apply_fact_index_operations(table_client, index_operations, "selected machines")
+
+    if len(succeeded) < len(operations):
+        sys.exit(2)
@@ -0,0 +1,169 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import sqlite3
+import datetime
+from puppetconfig_constants import PUPPETVF_PK, PUPPETVFV_PK, CACHE_FILE_NAME, CACHE_SCHEMA_VERSION, KEY_ONLY
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from azure.core.exceptions import HttpResponseError
+except:
+    print("Module azure.core not instaled [pip3 install azure.core]")
+    sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Function to open the cache database
+# Returns None if caching is disabled or the cache can't be opened
+# -----------------------------------------------------------------------------
+def open_cache():
+
+    if gbl.CACHE_DIR is None:
+        return None
+
+    try:
+        os.makedirs(gbl.CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(gbl.CACHE_DIR, CACHE_FILE_NAME))
+
+        # Caches written by an older version are discarded
+        if conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS catalogue")
+                conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+
+        conn.execute("CREATE TABLE IF NOT EXISTS catalogue ("
+                     "cache_key TEXT PRIMARY KEY, catalogue TEXT, high_water TEXT, "
+                     "key_count INTEGER, loaded_at REAL, checked_at REAL)")
+    except (OSError, sqlite3.Error) as err:
+        if gbl.DEBUG:
+            print("Unable to open cache in", gbl.CACHE_DIR, "-", err)
+        return None
+
+    return conn
+
+# -----------------------------------------------------------------------------
+# Function to convert a timestamp to the format used in table queries
+# -----------------------------------------------------------------------------
+def format_timestamp(timestamp):
+
+    timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+# -----------------------------------------------------------------------------
+# Function to check if any valid fact or value has changed since the
+# high water mark. Added and updated records have a later Timestamp. Deleted
+# records (including deletes made from other hosts) are caught by counting
+# the keys in the valid fact and value partitions - a delete followed by an
+# add is caught by the Timestamp of the add
+# -----------------------------------------------------------------------------
+def catalogue_changed_since(table_client, high_water, key_count):
+
+    queries = [f"PartitionKey eq '{partition_key}' and Timestamp gt datetime'{high_water}'"
+               for partition_key in [PUPPETVF_PK, PUPPETVFV_PK]]
+
+    try:
+        for query in queries:
+            data = table_client.query_entities(query, select=KEY_ONLY, results_per_page=1)
+            for record in data:
+                return True
+
+        count = 0
+        for partition_key in [PUPPETVF_PK, PUPPETVFV_PK]:
+            query = f"PartitionKey eq '{partition_key}'"
+            count += sum(1 for record in table_client.query_entities(query, select=KEY_ONLY))
+    except HttpResponseError as err:
+        print("error with query")
+        print(query)
+        print(err)
+        sys.exit(2)
+
+    return count != key_count
+
+# -----------------------------------------------------------------------------
+# Function to read the cached catalogue
+# Returns None if there is no usable cached copy
+# -----------------------------------------------------------------------------
+def read_cached_catalogue(table_client):
+
+    conn = open_cache()
+    if conn is None:
+        return None
+
+    with conn:
+        row = conn.execute("SELECT catalogue, high_water, key_count, loaded_at, checked_at FROM catalogue "
+                           "WHERE cache_key = ?", (gbl.CACHE_KEY,)).fetchone()
+    if row is None:
+        conn.close()
+        return None
+
+    cached, high_water, key_count, loaded_at, checked_at = row
+    now = time.time()
+
+    # Force a full reload once the cache reaches max_age
+    if now - loaded_at > gbl.CACHE_MAX_AGE:
+        conn.close()
+        return None
+
+    # Revalidate cheaply once the ttl has expired
+    if now - checked_at > gbl.CACHE_TTL:
+        if gbl.VERBOSE:
+            print("Revalidating cached valid fact catalogue")
+        if high_water is None or catalogue_changed_since(table_client, high_water, key_count):
+            conn.close()
+            return None
+        with conn:
+            conn.execute("UPDATE catalogue SET checked_at = ? WHERE cache_key = ?", (now, gbl.CACHE_KEY))
+
+    conn.close()
+
+    catalogue = {}
+    for fact, values in json.loads(cached).items():
+        catalogue[fact] = None if values is None else set(values)
+
+    return catalogue
+
+# -----------------------------------------------------------------------------
+# Function to write the catalogue to the cache
+# key_count is the number of valid fact and value records it was built from
+# -----------------------------------------------------------------------------
+def write_cached_catalogue(catalogue, high_water, key_count):
+
+    conn = open_cache()
+    if conn is None:
+        return
+
+    cached = {}
+    for fact, values in catalogue.items():
+        cached[fact] = None if values is None else sorted(values)
+
+    if high_water is not None:
+        high_water = format_timestamp(high_water)
+
+    now = time.time()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO catalogue VALUES (?, ?, ?, ?, ?, ?)",
+                     (gbl.CACHE_KEY, json.dumps(cached), high_water, key_count, now, now))
+    conn.close()
+
+# -----------------------------------------------------------------------------
+# Function to remove the cached catalogue, used after the catalogue changes
+# -----------------------------------------------------------------------------
+def invalidate_cached_catalogue():
+
+    gbl.CATALOGUE = None
+
+    conn = open_cache()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("DELETE FROM catalogue WHERE cache_key = ?", (gbl.CACHE_KEY,))
+    conn.close()
@@ -0,0 +1,155 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import csv
+import sys
+from os import path
+from puppetconfig_constants import PUPPETVF_PK, PUPPETVFV_PK
+from puppetconfig_functions import load_catalogue, submit_batches, valid_value_row_key
+from puppetconfig_cache import invalidate_cached_catalogue
+from puppetconfig_replica import replica_set_valid_fact, replica_add_valid_value, replica_delete_valid_value
+from puppetconfig_serializer import load_yaml
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# Function to read a catalogue file
+# YAML files map each fact to a list of valid values (empty for a fact with no
+# list of valid values), e.g.
+#
+#   datacenter:
+#     - Belfast
+#     - Bristol
+#   env: []
+#
+# CSV files have one fact,value pair per line; a line with only a fact adds
+# the fact with no valid values. An optional fact,value header line is skipped
+# Returns a dictionary of fact -> set of valid values
+# -----------------------------------------------------------------------------
+def read_catalogue_file(catalogue_file):
+
+    if not path.exists(catalogue_file):
+        print("Catalogue file", catalogue_file, "does not exist")
+        sys.exit(2)
+
+    catalogue = {}
+
+    if catalogue_file.endswith('.csv'):
+        with open(catalogue_file, "r", newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                row = [item.strip() for item in row]
+                if len(row) == 0 or row[0] == '' or row[0].startswith('#'):
+                    continue
+                if row[0] == 'fact' and len(row) > 1 and row[1] == 'value':
+                    continue
+                values = catalogue.setdefault(row[0], set())
+                if len(row) > 1 and row[1] != '':
+                    values.add(row[1])
+    else:
+        with open(catalogue_file, "r") as ymlfile:
+            yaml_data = load_yaml(ymlfile)
+
+        if not isinstance(yaml_data, dict):
+            print("Catalogue file", catalogue_file, "must contain a mapping of fact to list of values")
+            sys.exit(2)
+
+        for fact in yaml_data:
+            values = yaml_data[fact]
+            if values is None:
+                values = []
+            elif not isinstance(values, list):
+                values = [values]
+            catalogue[str(fact)] = set(str(value) for value in values)
+
+    return catalogue
+
+# -----------------------------------------------------------------------------
+# Function to import a catalogue of valid facts and values
+# Only the differences between the file and the table are written, using
+# transactional batches
+# -----------------------------------------------------------------------------
+def do_import_catalogue(table_client, catalogue_file, prune):
+
+    # Load wanted and current catalogues
+    wanted = read_catalogue_file(catalogue_file)
+    current = load_catalogue(table_client)
+
+    fact_operations = []
+    value_operations = []
+    facts_added = 0
+    values_added = 0
+    values_removed = 0
+
+    for fact in sorted(wanted):
+        wanted_values = wanted[fact]
+        current_values = current.get(fact)
+
+        if current_values is None:
+            current_values = set()
+
+        # Add fact, or set the ValidValues flag once if it now has values
+        if fact not in current:
+            if gbl.VERBOSE:
+                print("- Adding valid fact", fact)
+            record = {}
+            record['PartitionKey'] = PUPPETVF_PK
+            record['RowKey'] = fact
+            record['ValidValues'] = 'yes' if len(wanted_values) > 0 else 'no'
+            fact_operations.append(('create', record))
+            facts_added += 1
+        elif len(wanted_values - current_values) > 0 and current[fact] is None:
+            record = {}
+            record['PartitionKey'] = PUPPETVF_PK
+            record['RowKey'] = fact
+            record['ValidValues'] = 'yes'
+            fact_operations.append(('update', record, {'mode': 'merge'}))
+
+        # Add missing values
+        for value in sorted(wanted_values - current_values):
+            if gbl.VERBOSE:
+                print("- Adding valid value", value, "to fact", fact)
+            record = {}
+            record['PartitionKey'] = PUPPETVFV_PK
+            record['RowKey'] = valid_value_row_key(fact, value)
+            record['VFVFact'] = fact
+            record['VFVValue'] = value
+            value_operations.append(('create', record))
+            values_added += 1
+
+        # Remove values that are not in the catalogue file
+        if prune and len(current_values - wanted_values) > 0:
+            for value in sorted(current_values - wanted_values):
+                if gbl.VERBOSE:
+                    print("- Removing valid value", value, "from fact", fact)
+                record = {}
+                record['PartitionKey'] = PUPPETVFV_PK
+                record['RowKey'] = valid_value_row_key(fact, value)
+                record['VFVFact'] = fact
+                record['VFVValue'] = value
+                value_operations.append(('delete', record))
+                values_removed += 1
+
+            if len(wanted_values) == 0:
+                record = {}
+                record['PartitionKey'] = PUPPETVF_PK
+                record['RowKey'] = fact
+                record['ValidValues'] = 'no'
+                fact_operations.append(('update', record, {'mode': 'merge'}))
+
+    # Facts are written first so that values never refer to a missing fact
+    num_batches = submit_batches(table_client, fact_operations)
+    num_batches += submit_batches(table_client, value_operations)
+
+    if num_batches > 0:
+        invalidate_cached_catalogue()
+
+    # Apply the same changes to the local replica
+    for operation in fact_operations:
+        replica_set_valid_fact(operation[1]['RowKey'], operation[1]['ValidValues'])
+    for operation in value_operations:
+        if operation[0] == 'create':
+            replica_add_valid_value(operation[1]['VFVFact'], operation[1]['VFVValue'])
+        else:
+            replica_delete_valid_value(operation[1]['VFVFact'], operation[1]['VFVValue'])
+
+    print(f"Catalogue imported - {facts_added} facts added, {values_added} values added, "
+          f"{values_removed} values removed in {num_batches} batches")
@@ -0,0 +1,52 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+from puppetconfig_stats import InstrumentedTableClient
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# Table client that is only created when it is first used
+# Commands that don't read or write the table (or only read the local
+# replica) never create it, and so never import the azure SDK
+# -----------------------------------------------------------------------------
+class LazyTableClient:
+
+    def __init__(self, endpoint, sas_token, table_name):
+
+        self.endpoint = endpoint
+        self.sas_token = sas_token
+        self.table_name = table_name
+        self.client = None
+
+    def __getattr__(self, name):
+
+        if self.client is None:
+            try:
+                from azure.data.tables import TableServiceClient
+            except ModuleNotFoundError:
+                print("Module azure.data.tables not instaled [pip3 install azure.data.tables]")
+                sys.exit(2)
+
+            try:
+                from azure.core.credentials import AzureSasCredential
+            except ModuleNotFoundError:
+                print("Module azure.core not instaled [pip3 install azure.core]")
+                sys.exit(2)
+
+            table_service_client = TableServiceClient(endpoint=self.endpoint, credential=AzureSasCredential(self.sas_token))
+            self.client = table_service_client.get_table_client(table_name=self.table_name)
+
+        return getattr(self.client, name)
+
+# -----------------------------------------------------------------------------
+# Function to return a client for a table, recording its requests if --stats
+# or --trace is set
+# -----------------------------------------------------------------------------
+def get_table_client(endpoint, sas_token, table_name):
+
+    table_client = LazyTableClient(endpoint, sas_token, table_name)
+    if gbl.STATS is not None:
+        table_client = InstrumentedTableClient(table_client)
+
+    return table_client
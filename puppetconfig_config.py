@@ -0,0 +1,91 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import os
+import sys
+from puppetconfig_serializer import load_yaml
+
+# Settings every config file must have, by section
+REQUIRED_SETTINGS = {
+    'azure': ['table_name', 'sas_token', 'endpoint', 'proxy'],
+    'generate': ['facts_dir', 'yaml_file', 'puppet_user', 'puppet_group'],
+}
+
+# Settings every entry in the optional sources list must have
+REQUIRED_SOURCE_SETTINGS = ['name', 'endpoint', 'sas_token', 'table_name']
+
+# -----------------------------------------------------------------------------
+# Function to load configuration from yaml file
+# -----------------------------------------------------------------------------
+def get_config(config_file):
+
+    if not os.path.exists(config_file):
+        print("Config file", config_file, "does not exist")
+        sys.exit(2)
+
+    with open(config_file, "r") as configyml:
+        cfg = load_yaml(configyml)
+
+    return cfg
+
+# -----------------------------------------------------------------------------
+# Function to check a configuration file has the required settings
+# Returns a list of errors, empty if the configuration is valid
+# -----------------------------------------------------------------------------
+def check_config(cfg):
+
+    errors = []
+
+    if not isinstance(cfg, dict):
+        return ["Config file must contain a mapping of sections"]
+
+    for section, settings in REQUIRED_SETTINGS.items():
+        if not isinstance(cfg.get(section), dict):
+            errors.append(f"Missing section {section}")
+            continue
+        for setting in settings:
+            if cfg[section].get(setting) is None:
+                errors.append(f"Missing setting {section}.{setting}")
+
+    errors.extend(check_sources(cfg.get('sources')))
+
+    return errors
+
+# -----------------------------------------------------------------------------
+# Function to check the sources list, if there is one
+# Returns a list of errors
+# -----------------------------------------------------------------------------
+def check_sources(sources):
+
+    errors = []
+
+    if sources is None:
+        return errors
+
+    if not isinstance(sources, list):
+        return ["sources must be a list"]
+
+    names = set()
+    for number, source in enumerate(sources, 1):
+        if not isinstance(source, dict):
+            errors.append(f"Source {number} must be a mapping of settings")
+            continue
+
+        for setting in REQUIRED_SOURCE_SETTINGS:
+            if source.get(setting) is None:
+                errors.append(f"Missing setting {setting} for source {number}")
+
+        name = source.get('name')
+        if name is not None:
+            if not isinstance(name, str) or '/' in name:
+                errors.append(f"Invalid name {name} for source {number}")
+            elif name in names:
+                errors.append(f"Duplicate source name {name}")
+            else:
+                names.add(name)
+
+        priority = source.get('priority')
+        if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool)):
+            errors.append(f"Priority for source {number} must be a whole number")
+
+    return errors
@@ -9,5 +9,158 @@ PUPPETVF_PK = 'PuppetCfgValidFact'
 # Partition Key Valud for Valid Fact Value Records in Azure Table
 PUPPETVFV_PK = 'PuppetCfgValidFactValue'
 
+# Partition Key Value for Fact Index Records in Azure Table
+PUPPETIDX_PK = 'PuppetCfgFactIndex'
+
 # Default configuration file name
-DEFAULT_CONFIG_FILE = '/etc/puppetconfig.yml'
\ No newline at end of file
+DEFAULT_CONFIG_FILE = '/etc/puppetconfig.yml'
+
+# Maximum number of operations in an Azure Table transactional batch
+MAX_BATCH_SIZE = 100
+
+# Separator between the parts of a composite RowKey (e.g. fact|value)
+ROW_KEY_SEPARATOR = '|'
+
+# Property names that can be used in a query filter - a letter or underscore
+# followed by letters, digits and underscores, up to 255 characters
+PROPERTY_NAME_PATTERN = r'[A-Za-z_][A-Za-z0-9_]{0,254}'
+
+# Characters left unencoded in composite RowKey parts - everything else,
+# including the separator, quotes, / \ # ? and %, is percent-encoded
+ROW_KEY_SAFE_CHARS = " !$&()*+,-.:;<=>@[]^_{}~"
+
+# Default catalogue cache settings (cache section of the config file)
+DEFAULT_CACHE_DIR = '/var/cache/puppetconfig'
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_AGE = 86400
+
+# Catalogue cache file name
+CACHE_FILE_NAME = 'catalogue.sqlite'
+
+# Version of the cache file layout - caches with another version are discarded
+CACHE_SCHEMA_VERSION = 2
+
+# Suffix of the generate state file, written next to the yaml file
+STATE_FILE_SUFFIX = '.state'
+
+# Default seconds between full scans of the table by generate
+DEFAULT_FULL_SYNC_INTERVAL = 3600
+
+# Seconds of overlap when reading records changed since the last generate
+SYNC_OVERLAP = 60
+
+# Bytes read from the end of the generate state file to find the sync details
+STATE_TAIL_SIZE = 1024
+
+# Bytes read at a time when hashing files
+HASH_CHUNK_SIZE = 1048576
+
+# Exit status of generate --exit-code when the facts file is unchanged
+EXIT_UNCHANGED = 3
+
+# Exit status of generate --exit-code when another generate is running, and
+# has been asked to do another pass instead
+EXIT_DEFERRED = 4
+
+# Default generate output mode (single, node or group) and shard directory
+DEFAULT_OUTPUT = 'single'
+DEFAULT_SHARD_DIR = 'shards'
+
+# Default format of the facts files written by generate (yaml or json)
+DEFAULT_FORMAT = 'yaml'
+
+# Default priority of a generate source - when sources have the same node,
+# the source with the highest priority wins
+DEFAULT_SOURCE_PRIORITY = 0
+
+# Suffix of the index file written with the shard files. The index is
+# written next to the shard directory, so no shard can have its name
+SHARD_INDEX_SUFFIX = '.index.yaml'
+
+# Most group shard files kept open at once while writing group output
+SHARD_MAX_OPEN_FILES = 128
+
+# Shard name used for nodes that don't have the group fact
+SHARD_NO_GROUP = '_none'
+
+# Number of threads writing shard files
+SHARD_THREADS = 8
+
+# Projection for queries that only need to know which records exist
+KEY_ONLY = ['RowKey']
+
+# Default seconds between polls for generate --watch, and the factor the poll
+# interval can back off to while nothing changes
+DEFAULT_WATCH_INTERVAL = 30
+WATCH_MAX_BACKOFF = 8
+
+# Lock file held by generate, and the marker file used to ask the running
+# generate for another pass - both in facts_dir
+LOCK_FILE_NAME = '.generate.lock'
+DIRTY_FILE_NAME = '.generate.dirty'
+
+# Default local replica file, and the default number of seconds since the
+# last sync that read-only commands will use it for (0 = only with --offline)
+DEFAULT_REPLICA_FILE = '/var/cache/puppetconfig/replica.sqlite'
+DEFAULT_REPLICA_MAX_STALENESS = 0
+
+# Default maximum number of concurrent requests for multi-entity commands
+DEFAULT_CONCURRENCY = 32
+
+# Number of times an update guarded by an ETag is retried if the record
+# changes between reading and writing it
+MAX_ETAG_RETRIES = 5
+
+# Shell prompt, and the shell commands whose first argument is a machine or a
+# fact name (used for tab completion). With one of the selector options the
+# machine argument is omitted
+SHELL_PROMPT = 'puppetconfig> '
+SHELL_SELECTOR_OPTIONS = ['--where', '--machines-from']
+SHELL_MACHINE_COMMANDS = ['show-machine', 'set-fact', 'delete-fact', 'add-machine', 'delete-machine']
+SHELL_FACT_COMMANDS = ['list-machines-with-fact', 'delete-valid-fact', 'add-valid-fact-value', 'list-valid-fact-value',
+                       'delete-valid-fact-value']
+
+# Maximum entities the service returns in one page of query results
+MAX_PAGE_SIZE = 1000
+
+# Number of times a scan resumes from its last page after a throttling or
+# connection error, and the seconds to wait before the first retry (doubled
+# for each retry after that). HTTP status codes that are retried
+SCAN_MAX_RETRIES = 3
+SCAN_RETRY_DELAY = 1
+SCAN_RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+# Output formats for list and show commands (--output)
+OUTPUT_FORMATS = ['table', 'json', 'ndjson', 'csv']
+
+# Startup benchmark - cumulative import time budget in milliseconds for
+# commands that don't use the table, and the modules they must not import.
+# --help reads no config file and prints no tables, so it mustn't import the
+# modules used for those either
+STARTUP_IMPORT_BUDGET_MS = 100
+STARTUP_FORBIDDEN_MODULES = ['azure', 'aiohttp']
+STARTUP_HELP_FORBIDDEN_MODULES = STARTUP_FORBIDDEN_MODULES + ['yaml', 'prettytable']
+
+# Fake table used by the benchmarks - entities per page of query results, and
+# the number of times a throttled request is retried (as the SDK's retry
+# policy does) before it fails. Entities seeded into the fake table are
+# timestamped from FAKE_SEED_AGE days ago
+FAKE_PAGE_SIZE = 1000
+FAKE_MAX_RETRIES = 3
+FAKE_SEED_AGE = 400
+
+# Benchmark round trip budgets - (fixed requests, requests per page of
+# machines) for each benchmarked command. A full scan of the machines
+# partition is one request per page
+BENCH_ROUND_TRIP_BUDGETS = {
+    'list-machines': (0, 1),
+    'list-machines-with-fact': (1, 1),
+    'show-machine': (1, 0),
+    'list-valid-fact': (1, 0),
+    'list-valid-fact-value': (1, 0),
+    'generate': (0, 1),
+    'set-fact': (5, 0),
+    'diff': (0, 1),
+    'generate (incremental)': (1, 1),
+    'validate': (2, 1),
+}
@@ -0,0 +1,161 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import os
+import sys
+from os import path
+from puppetconfig_constants import PUPPETCFG_PK, DEFAULT_OUTPUT, DEFAULT_SHARD_DIR
+from puppetconfig_config import get_config
+from puppetconfig_generate import read_table_nodes, get_sources, read_sources
+from puppetconfig_output import write_rows
+from puppetconfig_serializer import get_serializer
+from puppetconfig_stats import phase
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# Function to load the nodes from a generated facts file
+# Returns a dictionary of node -> facts, empty if the file doesn't exist
+# -----------------------------------------------------------------------------
+def load_facts_file(file_name, serializer):
+
+    if not path.exists(file_name):
+        return {}
+
+    with phase(f'{serializer.name} load'), open(file_name, "rb") as ymlfile:
+        yaml_data = serializer.load(ymlfile)
+
+    if not yaml_data:
+        return {}
+
+    return yaml_data.get('server::facts') or {}
+
+# -----------------------------------------------------------------------------
+# Function to load the nodes generate last wrote, from the single facts file or
+# from the shard files
+# -----------------------------------------------------------------------------
+def load_current_nodes(yaml_file, output, shard_dir, serializer):
+
+    if output == 'single':
+        return load_facts_file(yaml_file, serializer)
+
+    nodes = {}
+    if path.exists(shard_dir):
+        for file_name in sorted(os.listdir(shard_dir)):
+            if file_name.endswith(serializer.extension):
+                nodes.update(load_facts_file(f'{shard_dir}/{file_name}', serializer))
+
+    return nodes
+
+# -----------------------------------------------------------------------------
+# Function to compare the nodes in the table with the nodes in the file
+# table_nodes is a stream of (node, facts) and file_nodes a dictionary, which
+# is emptied as nodes are matched - a single hash join pass
+# Returns rows of [change, machine, fact, old value, new value], where change
+# is added, removed or changed. Added and removed nodes have no fact
+# -----------------------------------------------------------------------------
+def diff_nodes(table_nodes, file_nodes):
+
+    rows = []
+
+    for nodename, record in table_nodes:
+        current = file_nodes.pop(nodename, None)
+
+        if current is None:
+            rows.append(['added', nodename, None, None, None])
+            continue
+
+        if current == record:
+            continue
+
+        for fact in sorted(set(record) | set(current)):
+            old_value = current.get(fact)
+            new_value = record.get(fact)
+            if fact not in current or fact not in record or old_value != new_value:
+                rows.append(['changed', nodename, fact, old_value, new_value])
+
+    # Nodes left in the file are no longer in the table
+    for nodename in sorted(file_nodes):
+        rows.append(['removed', nodename, None, None, None])
+
+    return rows
+
+# -----------------------------------------------------------------------------
+# Function to print a compact summary of the differences
+# -----------------------------------------------------------------------------
+def print_diff_summary(rows, file_name):
+
+    added = 0
+    removed = 0
+    changed_nodes = set()
+
+    for change, machine, fact, old_value, new_value in rows:
+        if change == 'added':
+            print("+", machine)
+            added += 1
+        elif change == 'removed':
+            print("-", machine)
+            removed += 1
+        else:
+            old_text = '(none)' if old_value is None else old_value
+            new_text = '(none)' if new_value is None else new_value
+            print("~", machine, f"{fact}: {old_text} -> {new_text}")
+            changed_nodes.add(machine)
+
+    if len(rows) == 0:
+        print("No differences between the table and", file_name)
+    else:
+        print(f"{added} nodes added, {removed} removed, {len(changed_nodes)} changed "
+              f"({len(rows) - added - removed} facts)")
+
+# -----------------------------------------------------------------------------
+# Function to show what generate would change in the facts file
+# Reads the table (or each source) in one scan and compares it with the file
+# generate last wrote, without writing anything
+# Returns True if there are differences
+# -----------------------------------------------------------------------------
+def do_diff(table_client, config_file):
+
+    # Load settings from configuration file
+    with phase('config'):
+        cfg = get_config(config_file)
+
+    # Initialize Variables
+    puppet_facts_dir = cfg['generate']['facts_dir']
+    yaml_file_name = cfg['generate']['yaml_file']
+    yaml_file = f'{puppet_facts_dir}/{yaml_file_name}'
+    output = cfg['generate'].get('output', DEFAULT_OUTPUT)
+    shard_dir_name = cfg['generate'].get('shard_dir', DEFAULT_SHARD_DIR)
+    shard_dir = f'{puppet_facts_dir}/{shard_dir_name}'
+
+    if output not in ['single', 'node', 'group']:
+        print("Invalid generate output", output, "- must be single, node or group")
+        sys.exit(2)
+
+    serializer = get_serializer(cfg)
+    file_name = yaml_file if output == 'single' else shard_dir
+
+    if gbl.VERBOSE:
+        print("Loading", file_name)
+
+    file_nodes = load_current_nodes(yaml_file, output, shard_dir, serializer)
+
+    if gbl.VERBOSE:
+        print("Loaded", len(file_nodes), "nodes - getting data from Azure Table")
+
+    # The high water mark isn't used, as nothing is saved
+    sources = get_sources(cfg)
+    if sources is None:
+        sync = {'high_water': None}
+        table_nodes = read_table_nodes(table_client, f"PartitionKey eq '{PUPPETCFG_PK}'", sync)
+    else:
+        table_nodes = read_sources(sources)
+
+    with phase('diff'):
+        rows = diff_nodes(table_nodes, file_nodes)
+
+    if gbl.OUTPUT == 'table':
+        print_diff_summary(rows, file_name)
+    else:
+        write_rows(None, ['change', 'machine', 'fact', 'old', 'new'], [rows])
+
+    return len(rows) > 0
@@ -0,0 +1,606 @@
+# -----------------------------------------------------------------------------
+# In-memory fake of the azure.data.tables TableClient
+# Used by puppetconfig_bench.py to measure commands without a storage
+# account. Implements the TableClient methods and the subset of the OData
+# filter syntax used by puppetconfig, with configurable per-request latency
+# and throttling, and counts the requests made
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import re
+import sys
+import time
+import random
+import asyncio
+import datetime
+from collections import Counter
+from puppetconfig_constants import PUPPETCFG_PK, PUPPETVF_PK, PUPPETVFV_PK
+from puppetconfig_constants import FAKE_PAGE_SIZE, FAKE_MAX_RETRIES, FAKE_SEED_AGE
+from puppetconfig_stats import InstrumentedTableClient
+import puppetconfig_async
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from azure.data.tables import TableEntity
+except ModuleNotFoundError:
+    print("Module azure.data.tables not instaled [pip3 install azure.data.tables]")
+    sys.exit(2)
+
+try:
+    from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError, ResourceModifiedError
+except ModuleNotFoundError:
+    print("Module azure.core not instaled [pip3 install azure.core]")
+    sys.exit(2)
+
+# Tokens in a filter - brackets, quoted strings, datetime literals and words
+FILTER_TOKEN = re.compile(r"\s*(\(|\)|datetime'[^']*'|'(?:[^']|'')*'|[\w.-]+)")
+
+# Comparison operators supported in filters
+FILTER_OPERATORS = {
+    'eq': lambda left, right: left == right,
+    'ne': lambda left, right: left != right,
+    'gt': lambda left, right: left > right,
+    'ge': lambda left, right: left >= right,
+    'lt': lambda left, right: left < right,
+    'le': lambda left, right: left <= right,
+}
+
+# -----------------------------------------------------------------------------
+# Function to return the error raised for a request the service rejects
+# -----------------------------------------------------------------------------
+def get_http_error(status_code, message):
+
+    err = HttpResponseError(message=message)
+    err.status_code = status_code
+    err.reason = message
+
+    return err
+
+# -----------------------------------------------------------------------------
+# Function to compile a query filter into a function that takes an entity and
+# returns True if it matches
+# Supports comparisons of a property with a string, number or datetime
+# literal, combined with and, or, not and brackets
+# -----------------------------------------------------------------------------
+def compile_filter(query_filter):
+
+    tokens = FILTER_TOKEN.findall(query_filter)
+    if ''.join(tokens).replace(' ', '') != query_filter.replace(' ', ''):
+        raise get_http_error(400, f"InvalidInput - unsupported filter {query_filter}")
+
+    position = 0
+
+    def next_token():
+        nonlocal position
+        if position >= len(tokens):
+            raise get_http_error(400, f"InvalidInput - incomplete filter {query_filter}")
+        position += 1
+        return tokens[position - 1]
+
+    def peek_token():
+        return tokens[position] if position < len(tokens) else None
+
+    def literal(token):
+        if token.startswith("datetime'"):
+            return datetime.datetime.fromisoformat(token[9:-1].replace('Z', '+00:00'))
+        if token.startswith("'"):
+            return token[1:-1].replace("''", "'")
+        if token in ['true', 'false']:
+            return token == 'true'
+        try:
+            return float(token) if '.' in token else int(token)
+        except ValueError:
+            raise get_http_error(400, f"InvalidInput - unsupported literal {token}")
+
+    def comparison():
+        token = next_token()
+        if token == '(':
+            match = disjunction()
+            if next_token() != ')':
+                raise get_http_error(400, f"InvalidInput - unbalanced brackets in {query_filter}")
+            return match
+        if token == 'not':
+            inner = comparison()
+            return lambda entity: not inner(entity)
+
+        name = token
+        operator = next_token()
+        if operator not in FILTER_OPERATORS:
+            raise get_http_error(400, f"InvalidInput - unsupported operator {operator}")
+        value = literal(next_token())
+        compare = FILTER_OPERATORS[operator]
+
+        def match(entity):
+            # Entities without the property, or with a value of another type,
+            # never match
+            if name not in entity:
+                return False
+            try:
+                return compare(entity[name], value)
+            except TypeError:
+                return False
+
+        return match
+
+    def conjunction():
+        terms = [comparison()]
+        while peek_token() == 'and':
+            next_token()
+            terms.append(comparison())
+        return terms[0] if len(terms) == 1 else lambda entity: all(term(entity) for term in terms)
+
+    def disjunction():
+        terms = [conjunction()]
+        while peek_token() == 'or':
+            next_token()
+            terms.append(conjunction())
+        return terms[0] if len(terms) == 1 else lambda entity: any(term(entity) for term in terms)
+
+    match = disjunction()
+    if position != len(tokens):
+        raise get_http_error(400, f"InvalidInput - unexpected {tokens[position]} in {query_filter}")
+
+    return match
+
+# -----------------------------------------------------------------------------
+# Results of a query, returned a page at a time like azure.core's ItemPaged
+# Each page is a separate request to the fake table. Continuation tokens are
+# the PartitionKey and RowKey of the next entity, as in the real service
+# -----------------------------------------------------------------------------
+class FakePager:
+
+    def __init__(self, table, entities, select, page_size):
+
+        self.table = table
+        self.entities = entities
+        self.select = select
+        self.page_size = page_size or FAKE_PAGE_SIZE
+
+    def __iter__(self):
+
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token=None):
+
+        return FakePageIterator(self, continuation_token)
+
+class FakePageIterator:
+
+    def __init__(self, pager, continuation_token):
+
+        self.pager = pager
+        self.continuation_token = continuation_token
+        self.start = 0
+        self.requested = False
+
+        if continuation_token is not None:
+            next_key = (continuation_token['PartitionKey'], continuation_token['RowKey'])
+            while self.start < len(pager.entities) and \
+                  (pager.entities[self.start]['PartitionKey'], pager.entities[self.start]['RowKey']) < next_key:
+                self.start += 1
+
+    def __iter__(self):
+
+        return self
+
+    def __next__(self):
+
+        # The first page is always requested, even if the result is empty
+        if self.requested and self.continuation_token is None:
+            raise StopIteration
+
+        pager = self.pager
+        pager.table.request('query')
+        self.requested = True
+
+        page = pager.entities[self.start:self.start + pager.page_size]
+        self.start += pager.page_size
+        self.continuation_token = None
+        if self.start < len(pager.entities):
+            next_entity = pager.entities[self.start]
+            self.continuation_token = {'PartitionKey': next_entity['PartitionKey'], 'RowKey': next_entity['RowKey']}
+
+        pager.table.entities_returned += len(page)
+
+        return iter([pager.table.get_result(entity, pager.select) for entity in page])
+
+# -----------------------------------------------------------------------------
+# In-memory table client
+# latency is the seconds each request takes, throttle_rate the fraction of
+# requests rejected with 503 Server Busy. Throttled requests are retried after
+# throttle_delay seconds, as the SDK's retry policy does, up to
+# FAKE_MAX_RETRIES times
+# -----------------------------------------------------------------------------
+class FakeTableClient:
+
+    def __init__(self, table_name='puppetconfig', latency=0.0, throttle_rate=0.0, throttle_delay=0.0, seed=0):
+
+        self.url = 'https://fake.table.core.windows.net'
+        self.table_name = table_name
+        self.credential = None
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_delay = throttle_delay
+        self.random = random.Random(seed)
+        self.entities = {}
+        self.clock = datetime.datetime.now(datetime.timezone.utc)
+        self.seed_clock = self.clock - datetime.timedelta(days=FAKE_SEED_AGE)
+        self.reset_counters()
+
+    # -------------------------------------------------------------------------
+    # Request counting, latency and throttling
+    # -------------------------------------------------------------------------
+    def reset_counters(self):
+
+        self.requests = Counter()
+        self.entities_returned = 0
+
+    def get_delay(self, operation):
+
+        # Returns the seconds the request takes, including retries. Retries
+        # are only counted as throttled requests
+        self.requests[operation] += 1
+        delay = self.latency
+        for attempt in range(FAKE_MAX_RETRIES + 1):
+            if self.random.random() >= self.throttle_rate:
+                return delay
+            self.requests['throttled'] += 1
+            delay += self.throttle_delay + self.latency
+
+        raise get_http_error(503, "ServerBusy - the server is busy")
+
+    def request(self, operation):
+
+        delay = self.get_delay(operation)
+        if delay > 0:
+            time.sleep(delay)
+
+    # -------------------------------------------------------------------------
+    # Entity storage
+    # -------------------------------------------------------------------------
+    def get_timestamp(self):
+
+        # Timestamps follow the real clock, and are unique
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.clock = max(now, self.clock + datetime.timedelta(microseconds=1))
+        return self.clock
+
+    def store(self, entity, timestamp=None):
+
+        entity = dict(entity)
+        entity['Timestamp'] = timestamp or self.get_timestamp()
+        self.entities[(entity['PartitionKey'], entity['RowKey'])] = entity
+
+    def load_entities(self, entities):
+
+        # Adds entities directly, without counting requests - for seeding.
+        # Seeded entities are timestamped a second apart, starting
+        # FAKE_SEED_AGE days ago, as if they had been written over time
+        for entity in entities:
+            self.seed_clock += datetime.timedelta(seconds=1)
+            self.store(entity, self.seed_clock)
+
+    def get_result(self, entity, select):
+
+        # Timestamp and ETag are returned as metadata, as the SDK does
+        if select is None:
+            result = TableEntity({key: value for key, value in entity.items() if key != 'Timestamp'})
+        else:
+            result = TableEntity({key: entity[key] for key in select if key in entity and key != 'Timestamp'})
+        result._metadata = {'etag': f"W/\"datetime'{entity['Timestamp'].isoformat()}'\"", 'timestamp': entity['Timestamp']}
+
+        return result
+
+    def get_stored(self, partition_key, row_key):
+
+        entity = self.entities.get((partition_key, row_key))
+        if entity is None:
+            raise ResourceNotFoundError(message=f"ResourceNotFound - {partition_key} {row_key}")
+
+        return entity
+
+    def check_etag(self, entity, etag, match_condition):
+
+        if etag is not None and match_condition is not None:
+            if etag != self.get_result(entity, []).metadata['etag']:
+                raise ResourceModifiedError(message="UpdateConditionNotSatisfied")
+
+    def find(self, query_filter):
+
+        # Entities are returned in PartitionKey, RowKey order
+        match = compile_filter(query_filter)
+
+        return [self.entities[key] for key in sorted(self.entities) if match(self.entities[key])]
+
+    # -------------------------------------------------------------------------
+    # TableClient methods
+    # -------------------------------------------------------------------------
+    def query_entities(self, query_filter, select=None, results_per_page=None, **kwargs):
+
+        if isinstance(select, str):
+            select = [name.strip() for name in select.split(',')]
+
+        return FakePager(self, self.find(query_filter), select, results_per_page)
+
+    def list_entities(self, select=None, results_per_page=None, **kwargs):
+
+        entities = [self.entities[key] for key in sorted(self.entities)]
+
+        return FakePager(self, entities, select, results_per_page)
+
+    def get_entity(self, partition_key, row_key, select=None, **kwargs):
+
+        self.request('get')
+        entity = self.get_stored(partition_key, row_key)
+        self.entities_returned += 1
+
+        return self.get_result(entity, select)
+
+    def create_entity(self, entity, **kwargs):
+
+        self.request('create')
+        self.create(entity)
+
+        return {}
+
+    def update_entity(self, entity, mode='merge', etag=None, match_condition=None, **kwargs):
+
+        self.request('update')
+        self.update(entity, mode, etag, match_condition)
+
+        return {}
+
+    def upsert_entity(self, entity, mode='merge', **kwargs):
+
+        self.request('upsert')
+        self.upsert(entity, mode)
+
+        return {}
+
+    def delete_entity(self, partition_key=None, row_key=None, etag=None, match_condition=None, **kwargs):
+
+        self.request('delete')
+        try:
+            self.delete(partition_key, row_key, etag, match_condition)
+        except ResourceNotFoundError:
+            pass
+
+    def submit_transaction(self, operations, **kwargs):
+
+        self.request('transaction')
+
+        return self.transaction(operations)
+
+    # -------------------------------------------------------------------------
+    # Operations shared by the sync and async methods and transactions
+    # -------------------------------------------------------------------------
+    def transaction(self, operations):
+
+        operations = list(operations)
+
+        # A transaction has at most 100 operations on one partition, and is
+        # applied completely or not at all
+        if len(operations) > 100 or len(set(operation[1]['PartitionKey'] for operation in operations)) > 1:
+            raise get_http_error(400, "InvalidInput - transaction must be up to 100 entities in one partition")
+
+        saved = dict(self.entities)
+        try:
+            for operation in operations:
+                action, entity = str(getattr(operation[0], 'value', operation[0])).lower(), operation[1]
+                options = operation[2] if len(operation) > 2 else {}
+                if action == 'create':
+                    self.create(entity)
+                elif action == 'delete':
+                    self.delete(entity['PartitionKey'], entity['RowKey'], options.get('etag'), options.get('match_condition'))
+                elif action == 'update':
+                    self.update(entity, options.get('mode', 'merge'), options.get('etag'), options.get('match_condition'))
+                else:
+                    self.upsert(entity, options.get('mode', 'merge'))
+        except HttpResponseError as err:
+            self.entities = saved
+            raise get_http_error(getattr(err, 'status_code', None) or 400, f"Transaction failed - {err.message}")
+
+        return [{} for operation in operations]
+
+    def create(self, entity):
+
+        if (entity['PartitionKey'], entity['RowKey']) in self.entities:
+            raise ResourceExistsError(message="EntityAlreadyExists")
+        self.store(entity)
+
+    def update(self, entity, mode, etag, match_condition):
+
+        stored = self.get_stored(entity['PartitionKey'], entity['RowKey'])
+        self.check_etag(stored, etag, match_condition)
+        self.upsert(entity, mode)
+
+    def upsert(self, entity, mode):
+
+        stored = self.entities.get((entity['PartitionKey'], entity['RowKey']))
+        if stored is not None and str(getattr(mode, 'value', mode)).lower() == 'merge':
+            entity = dict(stored, **entity)
+        self.store(entity)
+
+    def delete(self, partition_key, row_key, etag, match_condition):
+
+        # Deleting an entity that doesn't exist is an error in a transaction
+        # only - delete_entity ignores it, as the SDK does
+        entity = self.entities.get((partition_key, row_key))
+        if entity is None:
+            raise ResourceNotFoundError(message=f"ResourceNotFound - {partition_key} {row_key}")
+        self.check_etag(entity, etag, match_condition)
+        del self.entities[(partition_key, row_key)]
+
+# -----------------------------------------------------------------------------
+# Async client for a fake table, used by puppetconfig_async
+# Requests sleep without blocking the event loop, so concurrent requests
+# overlap as they do against the real service
+# -----------------------------------------------------------------------------
+class FakeAsyncTableClient:
+
+    def __init__(self, table):
+
+        self.table = table
+
+    async def __aenter__(self):
+
+        return self
+
+    async def __aexit__(self, *args):
+
+        pass
+
+    async def request(self, operation):
+
+        await asyncio.sleep(self.table.get_delay(operation))
+
+    def query_entities(self, query_filter, select=None, results_per_page=None, **kwargs):
+
+        async def entities():
+            entities = self.table.find(query_filter)
+            page_size = results_per_page or FAKE_PAGE_SIZE
+            start = 0
+            while True:
+                await self.request('query')
+                page = entities[start:start + page_size]
+                self.table.entities_returned += len(page)
+                for entity in page:
+                    yield self.table.get_result(entity, select)
+                start += page_size
+                if start >= len(entities):
+                    break
+
+        return entities()
+
+    async def get_entity(self, partition_key, row_key, select=None, **kwargs):
+
+        await self.request('get')
+        entity = self.table.get_stored(partition_key, row_key)
+        self.table.entities_returned += 1
+
+        return self.table.get_result(entity, select)
+
+    async def create_entity(self, entity, **kwargs):
+
+        await self.request('create')
+        self.table.create(entity)
+
+        return {}
+
+    async def update_entity(self, entity, mode='merge', etag=None, match_condition=None, **kwargs):
+
+        await self.request('update')
+        self.table.update(entity, mode, etag, match_condition)
+
+        return {}
+
+    async def upsert_entity(self, entity, mode='merge', **kwargs):
+
+        await self.request('upsert')
+        self.table.upsert(entity, mode)
+
+        return {}
+
+    async def delete_entity(self, partition_key=None, row_key=None, etag=None, match_condition=None, **kwargs):
+
+        await self.request('delete')
+        try:
+            self.table.delete(partition_key, row_key, etag, match_condition)
+        except ResourceNotFoundError:
+            pass
+
+    async def submit_transaction(self, operations, **kwargs):
+
+        await self.request('transaction')
+
+        return self.table.transaction(operations)
+
+# -----------------------------------------------------------------------------
+# Function to make puppetconfig_async use fake async clients for fake tables
+# -----------------------------------------------------------------------------
+def use_fake_async_client():
+
+    get_async_table_client = puppetconfig_async.get_async_table_client
+
+    def get_fake_async_table_client(table_client):
+        if isinstance(table_client, InstrumentedTableClient):
+            table_client = table_client.table_client
+        if isinstance(table_client, FakeTableClient):
+            return FakeAsyncTableClient(table_client)
+        return get_async_table_client(table_client)
+
+    puppetconfig_async.get_async_table_client = get_fake_async_table_client
+
+# -----------------------------------------------------------------------------
+# Function to make generate read its sources from fake tables
+# tables is a dictionary of table name -> FakeTableClient
+# -----------------------------------------------------------------------------
+def use_fake_sources(tables):
+
+    # Imported here so that puppetconfig_fake can be imported by modules that
+    # puppetconfig_generate imports
+    import puppetconfig_generate
+
+    def get_fake_table_client(endpoint, sas_token, table_name):
+        return tables[table_name]
+
+    puppetconfig_generate.get_table_client = get_fake_table_client
+
+# -----------------------------------------------------------------------------
+# Function to fill a fake table with a synthetic fleet
+# Creates num_facts valid facts (every fifth without a list of valid values),
+# num_values valid values for each fact with a list, and num_machines machines
+# with a value for most facts. The fact index is created if fact_index is set
+# Returns the list of machine names
+# -----------------------------------------------------------------------------
+def generate_fleet(table, num_machines, num_facts=10, num_values=10, fact_index=False, seed=0):
+
+    # Imported here so that puppetconfig_fake can be imported by modules that
+    # puppetconfig_functions imports
+    from puppetconfig_functions import valid_value_row_key, get_fact_index_record
+
+    generator = random.Random(seed)
+
+    facts = {}
+    entities = []
+    for count in range(num_facts):
+        fact = f"fact{count:02d}"
+        if count % 5 == 4:
+            facts[fact] = None
+            entities.append({'PartitionKey': PUPPETVF_PK, 'RowKey': fact, 'ValidValues': 'no'})
+            continue
+
+        facts[fact] = [f"{fact}-value{value:02d}" for value in range(num_values)]
+        entities.append({'PartitionKey': PUPPETVF_PK, 'RowKey': fact, 'ValidValues': 'yes'})
+        for value in facts[fact]:
+            entities.append({'PartitionKey': PUPPETVFV_PK, 'RowKey': valid_value_row_key(fact, value),
+                             'VFVFact': fact, 'VFVValue': value})
+
+    table.load_entities(entities)
+
+    machines = []
+    width = len(str(num_machines))
+    for count in range(num_machines):
+        machine = f"node{count:0{width}d}"
+        machines.append(machine)
+        entity = {'PartitionKey': PUPPETCFG_PK, 'RowKey': machine}
+        for fact, values in facts.items():
+            if generator.random() < 0.1:
+                continue
+            if values is None:
+                entity[fact] = f"{machine}-{fact}"
+            else:
+                entity[fact] = generator.choice(values)
+
+        if fact_index:
+            table.load_entities(get_fact_index_record(machine, fact, entity[fact])
+                                for fact in facts if fact in entity)
+        table.load_entities([entity])
+
+    return machines
@@ -2,19 +2,25 @@
 # Import Modules
 # -----------------------------------------------------------------------------
 import sys
-import os
-import uuid
-from puppetconfig_constants import PUPPETCFG_PK, PUPPETVF_PK, PUPPETVFV_PK
+import json
+import time
+import base64
+import binascii
+from urllib.parse import quote
+from puppetconfig_constants import PUPPETCFG_PK, PUPPETVF_PK, PUPPETVFV_PK, MAX_BATCH_SIZE
+from puppetconfig_constants import ROW_KEY_SEPARATOR, ROW_KEY_SAFE_CHARS, KEY_ONLY, PUPPETIDX_PK, MAX_ETAG_RETRIES
+from puppetconfig_constants import MAX_PAGE_SIZE, SCAN_MAX_RETRIES, SCAN_RETRY_DELAY, SCAN_RETRY_STATUS
+from puppetconfig_cache import read_cached_catalogue, write_cached_catalogue, invalidate_cached_catalogue
+from puppetconfig_replica import write_replica, replica_set_machine, replica_delete_machine, replica_set_valid_fact
+from puppetconfig_replica import replica_set_fact, replica_delete_fact
+from puppetconfig_replica import replica_delete_valid_fact, replica_add_valid_value, replica_delete_valid_value
+from puppetconfig_async import run_async, query_entities_async, submit_transactions_async, apply_operations_async
+from puppetconfig_output import print_machines, print_machines_with_fact, print_machine, print_valid_facts
+from puppetconfig_output import print_valid_values
 import puppetconfig_globals as gbl
 
 # External Modules
 
-try:
-    import yaml
-except ModuleNotFoundError:
-    print("Module PyYAML not instaled [pip3 install PyYAML]")
-    sys.exit(2)
-
 try:
     from azure.data.tables import UpdateMode
 except ModuleNotFoundError:
@@ -22,107 +28,543 @@ except ModuleNotFoundError:
     sys.exit(2)
 
 try:
-    from azure.core.exceptions import ResourceExistsError, HttpResponseError
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, ResourceModifiedError, HttpResponseError
+    from azure.core.exceptions import ServiceRequestError, ServiceResponseError
 except:
     print("Module azure.core not instaled [pip3 install azure.core]")
     sys.exit(2)
 
-try:
-    from prettytable import PrettyTable
-except ModuleNotFoundError:
-    print("Module prettytable not instaled [pip3 install prettytable]")
-    sys.exit(2)
+# -----------------------------------------------------------------------------
+# Function to split a list of operations into transactional batches
+# Operations are grouped by PartitionKey (a batch may only contain a single
+# partition) and split into batches of up to MAX_BATCH_SIZE operations. The
+# batches are submitted concurrently, so they must not depend on each other
+# Returns a list of (batch, result) where result is the exception raised by
+# a batch that failed, or the batch response
+# -----------------------------------------------------------------------------
+def run_batches(table_client, operations):
+
+    partitions = {}
+    for operation in operations:
+        partition_key = operation[1]['PartitionKey']
+        partitions.setdefault(partition_key, []).append(operation)
+
+    batches = []
+    for partition_key, partition_ops in partitions.items():
+        for start in range(0, len(partition_ops), MAX_BATCH_SIZE):
+            batch = partition_ops[start:start + MAX_BATCH_SIZE]
+            if gbl.DEBUG:
+                print("Submitting batch of", len(batch), "operations to partition", partition_key)
+            batches.append(batch)
+
+    if len(batches) == 0:
+        return []
+
+    results = run_async(table_client, submit_transactions_async, batches)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, HttpResponseError):
+            raise result
+
+    return list(zip(batches, results))
 
 # -----------------------------------------------------------------------------
-# Function to load configuration from yaml file
+# Function to submit a list of operations as transactional batches (see
+# run_batches), exiting if any batch fails
+# Returns the number of batches submitted
 # -----------------------------------------------------------------------------
-def get_config(config_file):
-    
-    if not os.path.exists(config_file):
-        print("Config file", config_file, "does not exist")
+def submit_batches(table_client, operations):
+
+    batch_results = run_batches(table_client, operations)
+
+    failed = False
+    for batch, result in batch_results:
+        if isinstance(result, HttpResponseError):
+            print("Error submitting batch to partition", batch[0][1]['PartitionKey'])
+            print(result)
+            failed = True
+
+    if failed:
         sys.exit(2)
-        
-    with open(config_file, "r") as configyml:
-        cfg = yaml.safe_load(configyml)
 
-    return cfg
+    return len(batch_results)
 
 # -----------------------------------------------------------------------------
-# Function to list the machines in the Azure table
+# Paged scan of a query
+# Iterates over the entities, or over pages with by_page(). After each page
+# continuation_token is the token for the next page, or None once the scan is
+# complete. If reading a page fails with a throttling or connection error the
+# scan resumes from the last page read, up to SCAN_MAX_RETRIES times. limit
+# stops the scan after that many entities, with a continuation token for the
+# entity after the last one returned
 # -----------------------------------------------------------------------------
-def do_list_machines(table_client):
+class TableScan:
+
+    def __init__(self, table_client, query, select=None, page_size=None, limit=None, continuation_token=None):
+
+        self.table_client = table_client
+        self.query = query
+        self.select = select
+        self.page_size = page_size
+        self.limit = limit
+        self.continuation_token = continuation_token
+        self.count = 0
+
+    def __iter__(self):
+
+        for page in self.by_page():
+            yield from page
+
+    def get_pages(self, page_size):
+
+        data = self.table_client.query_entities(self.query, select=self.select, results_per_page=page_size)
+
+        return data.by_page(continuation_token=self.continuation_token)
+
+    def by_page(self):
+
+        page_size = self.page_size
+        pages = None
+        retries = 0
+
+        while True:
+            # Ask for no more than the limit, so the continuation token is for
+            # the next entity not returned
+            if self.limit is not None:
+                if self.count >= self.limit:
+                    return
+                remaining = self.limit - self.count
+                if remaining < (page_size or MAX_PAGE_SIZE):
+                    page_size = remaining
+                    pages = None
+
+            if pages is None:
+                pages = self.get_pages(page_size)
+
+            try:
+                page = list(next(pages))
+            except StopIteration:
+                self.continuation_token = None
+                return
+            except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+                status_code = getattr(err, 'status_code', None)
+                if isinstance(err, HttpResponseError) and status_code not in SCAN_RETRY_STATUS:
+                    raise
+                if retries >= SCAN_MAX_RETRIES:
+                    raise
+                if gbl.VERBOSE:
+                    print("Error reading page -", str(err).splitlines()[0], "- resuming scan", file=sys.stderr)
+                time.sleep(SCAN_RETRY_DELAY * 2 ** retries)
+                retries += 1
+                pages = None
+                continue
+
+            retries = 0
+            self.count += len(page)
+            self.continuation_token = pages.continuation_token
+            yield iter(page)
+
+            if self.continuation_token is None:
+                return
+
+# -----------------------------------------------------------------------------
+# Function to return a continuation token as text for --continue-from
+# -----------------------------------------------------------------------------
+def encode_continuation_token(continuation_token):
+
+    return base64.urlsafe_b64encode(json.dumps(continuation_token).encode('utf8')).decode('ascii')
+
+# -----------------------------------------------------------------------------
+# Function to read a continuation token given with --continue-from
+# -----------------------------------------------------------------------------
+def decode_continuation_token(text):
+
+    if text is None:
+        return None
 
-    # Get data from Azure Table
-    query = f"PartitionKey eq '{PUPPETCFG_PK}'"
     try:
-        data = table_client.query_entities(query)
-    except HttpResponseError as err:
-        print("Error getting list of machines")
-        print(err)
-        sys.exit(2)
+        return json.loads(base64.urlsafe_b64decode(text.encode('ascii')))
+    except (ValueError, binascii.Error):
+        print("Invalid continuation token", text)
+        sys.exit(1)
 
-    table = PrettyTable()
-    table.field_names = ['Machine List']
-    table.align = 'l'
-   
-    for record in data:
-        machine = record['RowKey']
-        table.add_row([machine])
+# -----------------------------------------------------------------------------
+# Function to report how to continue a list that stopped at --limit
+# Written to stderr so that it isn't mixed with json or csv output
+# -----------------------------------------------------------------------------
+def print_continuation(scan):
 
-    print(table)
+    if scan.continuation_token is not None:
+        print("More results - continue with --continue-from", encode_continuation_token(scan.continuation_token),
+              file=sys.stderr)
 
 # -----------------------------------------------------------------------------
-# Function to return machines that have a specific fact associate with them
-# Optionally, also filter by the value of that fact
+# Function to run several queries concurrently
+# queries is a list of (query, select, description) and the records from
+# each query are returned as a list
+# -----------------------------------------------------------------------------
+def query_concurrently(table_client, queries):
+
+    results = run_async(table_client, query_entities_async, [(query, select) for query, select, description in queries])
+
+    for (query, select, description), result in zip(queries, results):
+        if isinstance(result, HttpResponseError):
+            print("Error getting list of", description)
+            print(result)
+            sys.exit(2)
+        elif isinstance(result, Exception):
+            raise result
+
+    return results
+
+# -----------------------------------------------------------------------------
+# Function to load the list of machines into a set, and the valid fact
+# catalogue, reading the table partitions concurrently
+# -----------------------------------------------------------------------------
+def load_machines_and_catalogue(table_client):
+
+    queries = [(f"PartitionKey eq '{PUPPETCFG_PK}'", KEY_ONLY, "machines")]
+
+    catalogue = gbl.CATALOGUE
+    if catalogue is None:
+        catalogue = read_cached_catalogue(table_client)
+    if catalogue is None:
+        queries += get_catalogue_queries()
+    elif gbl.DEBUG:
+        print("Using cached valid fact catalogue")
+
+    results = query_concurrently(table_client, queries)
+    machines = set(record['RowKey'] for record in results[0])
+
+    if catalogue is None:
+        catalogue, high_water, key_count = build_catalogue(results[1], results[2])
+        write_cached_catalogue(catalogue, high_water, key_count)
+
+    gbl.CATALOGUE = catalogue
+
+    return machines, catalogue
+
+# -----------------------------------------------------------------------------
+# Function to return the last modified time of an entity
+# -----------------------------------------------------------------------------
+def get_entity_timestamp(record):
+
+    metadata = getattr(record, 'metadata', None)
+    if metadata and metadata.get('timestamp') is not None:
+        return metadata['timestamp']
+
+    return record.get('Timestamp')
+
+# -----------------------------------------------------------------------------
+# Function to return the queries that read the valid fact catalogue, in the
+# form used by query_concurrently
+# -----------------------------------------------------------------------------
+def get_catalogue_queries():
+
+    return [(f"PartitionKey eq '{PUPPETVF_PK}'", ['RowKey', 'ValidValues', 'Timestamp'], "valid facts"),
+            (f"PartitionKey eq '{PUPPETVFV_PK}'", ['VFVFact', 'VFVValue', 'Timestamp'], "valid fact values")]
+
+# -----------------------------------------------------------------------------
+# Function to build the valid fact catalogue from the valid fact and valid
+# fact value records
+# Returns a dictionary of fact -> set of valid values, or fact -> None if the
+# fact does not have a list of valid values, the latest Timestamp of the
+# records read (the high water mark) and the number of records read
+# -----------------------------------------------------------------------------
+def build_catalogue(fact_records, value_records):
+
+    catalogue = {}
+    high_water = None
+    key_count = 0
+
+    # Valid facts
+    for record in fact_records:
+        if record['ValidValues'] == 'yes':
+            catalogue[record['RowKey']] = set()
+        else:
+            catalogue[record['RowKey']] = None
+        key_count += 1
+        timestamp = get_entity_timestamp(record)
+        if timestamp is not None and (high_water is None or timestamp > high_water):
+            high_water = timestamp
+
+    # Valid fact values
+    for record in value_records:
+        fact = record['VFVFact']
+        if catalogue.get(fact) is not None:
+            catalogue[fact].add(record['VFVValue'])
+        key_count += 1
+        timestamp = get_entity_timestamp(record)
+        if timestamp is not None and (high_water is None or timestamp > high_water):
+            high_water = timestamp
+
+    return catalogue, high_water, key_count
+
+# -----------------------------------------------------------------------------
+# Function to load the valid fact catalogue into memory, reading the valid
+# fact and valid fact value partitions concurrently
+# Returns the catalogue, its high water mark and record count (see
+# build_catalogue)
+# -----------------------------------------------------------------------------
+def load_catalogue_with_timestamp(table_client):
+
+    fact_records, value_records = query_concurrently(table_client, get_catalogue_queries())
+
+    return build_catalogue(fact_records, value_records)
+
+# -----------------------------------------------------------------------------
+# Function to load the valid fact catalogue into memory from the table
+# Returns a dictionary of fact -> set of valid values, or fact -> None if the
+# fact does not have a list of valid values
+# -----------------------------------------------------------------------------
+def load_catalogue(table_client):
+
+    catalogue, high_water, key_count = load_catalogue_with_timestamp(table_client)
+
+    return catalogue
+
+# -----------------------------------------------------------------------------
+# Function to return the valid fact catalogue, using the copy already in
+# memory, or the local cache when it is enabled and up to date
+# -----------------------------------------------------------------------------
+def get_catalogue(table_client):
+
+    if gbl.CATALOGUE is not None:
+        return gbl.CATALOGUE
+
+    catalogue = read_cached_catalogue(table_client)
+    if catalogue is not None:
+        if gbl.DEBUG:
+            print("Using cached valid fact catalogue")
+    else:
+        catalogue, high_water, key_count = load_catalogue_with_timestamp(table_client)
+        write_cached_catalogue(catalogue, high_water, key_count)
+
+    gbl.CATALOGUE = catalogue
+
+    return catalogue
+
+# -----------------------------------------------------------------------------
+# Function to check a fact/value against the valid fact catalogue
+# Returns an error message, or None if the fact/value is valid
 # -----------------------------------------------------------------------------
-def do_list_machines_with_fact(table_client, fact, value):
-    
+def check_catalogue(catalogue, fact, value):
+
+    if fact not in catalogue:
+        return f"Invalid fact - {fact}"
+
+    valid_values = catalogue[fact]
+    if valid_values is not None and str(value) not in valid_values:
+        return f"Value {value} for fact {fact} is not valid"
+
+    return None
+
+# -----------------------------------------------------------------------------
+# Function to return the facts from a machine record
+# -----------------------------------------------------------------------------
+def get_record_facts(record):
+
+    noderecord = {}
+
+    # Iterate round all properties in this record
+    for key in record.keys():
+
+        # Exclude unwanted properties
+        if key == 'PartitionKey' or key == 'Timestamp' or key == 'etag' or key == 'RowKey':
+            continue
+
+        noderecord[key] = record[key]
+
+    return noderecord
+
+# -----------------------------------------------------------------------------
+# Function to return the fact index record for a machine's fact value
+# The RowKey is fact|value|machine so that machines with a fact, or with a
+# fact/value, are a RowKey prefix range
+# -----------------------------------------------------------------------------
+def get_fact_index_record(machine, fact, value):
+
+    record = {}
+    record['PartitionKey'] = PUPPETIDX_PK
+    record['RowKey'] = valid_value_row_key(fact, value) + ROW_KEY_SEPARATOR + quote(str(machine), safe=ROW_KEY_SAFE_CHARS)
+    record['Machine'] = machine
+    record['Fact'] = fact
+    record['Value'] = str(value)
+
+    return record
+
+# -----------------------------------------------------------------------------
+# Function to return the fact index operations needed when a machine's facts
+# change from old_facts to new_facts
+# -----------------------------------------------------------------------------
+def get_fact_index_operations(machine, old_facts, new_facts):
+
+    operations = []
+
+    for fact in old_facts:
+        if fact not in new_facts or str(new_facts[fact]) != str(old_facts[fact]):
+            operations.append(('delete', get_fact_index_record(machine, fact, old_facts[fact])))
+
+    for fact in new_facts:
+        if fact not in old_facts or str(new_facts[fact]) != str(old_facts[fact]):
+            operations.append(('upsert', get_fact_index_record(machine, fact, new_facts[fact])))
+
+    return operations
+
+# -----------------------------------------------------------------------------
+# Function to update the fact index after a machine's facts have changed
+# -----------------------------------------------------------------------------
+def update_fact_index(table_client, machine, old_facts, new_facts):
+
+    if not gbl.FACT_INDEX:
+        return
+
+    operations = get_fact_index_operations(machine, old_facts, new_facts)
+    apply_fact_index_operations(table_client, operations, machine)
+
+# -----------------------------------------------------------------------------
+# Function to apply fact index operations
+# The index partition is updated in batches where possible. If a batch fails
+# (e.g. an index record to delete is missing) its operations are applied to
+# each record concurrently, ignoring missing records
+# -----------------------------------------------------------------------------
+def apply_fact_index_operations(table_client, operations, description):
+
+    failed = []
+    for batch, result in run_batches(table_client, operations):
+        if isinstance(result, HttpResponseError):
+            if gbl.DEBUG:
+                print("Fact index batch failed, applying operations individually")
+                print(result)
+            failed += batch
+
+    if len(failed) == 0:
+        return
+
+    for result in run_async(table_client, apply_operations_async, failed):
+        if isinstance(result, HttpResponseError):
+            print("Error updating fact index for", description, "- run reindex to rebuild it")
+            print(result)
+            sys.exit(2)
+        elif isinstance(result, Exception):
+            raise result
+
+# -----------------------------------------------------------------------------
+# Function to list machines with a fact, and optionally a value, using the
+# fact index
+# -----------------------------------------------------------------------------
+def do_list_machines_with_fact_index(table_client, fact, value, page_size=None, limit=None, continue_from=None):
+
     if not value:
-        query = f"PartitionKey eq '{PUPPETCFG_PK}' and {fact} ne ''"
+        prefix = valid_value_row_key(fact, '')
     else:
-        query = f"PartitionKey eq '{PUPPETCFG_PK}' and {fact} eq '{value}'"
+        prefix = valid_value_row_key(fact, value) + ROW_KEY_SEPARATOR
+
+    query = prefix_query(PUPPETIDX_PK, prefix)
 
+    # Results are read as they are displayed
+    scan = TableScan(table_client, query, ['Machine', 'Value'], page_size, limit, decode_continuation_token(continue_from))
     try:
-        data = table_client.query_entities(query)
+        print_machines_with_fact(scan, fact, machine_key='Machine', value_key='Value')
+    except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+        print("Error getting list of machines", file=sys.stderr)
+        print(err, file=sys.stderr)
+        sys.exit(2)
+
+    print_continuation(scan)
+
+# -----------------------------------------------------------------------------
+# Function to rebuild the fact index from the machine records
+# Only the differences between the index and the machine records are written
+# -----------------------------------------------------------------------------
+def do_reindex(table_client):
+
+    # Index records wanted
+    wanted = {}
+    query = f"PartitionKey eq '{PUPPETCFG_PK}'"
+    try:
+        for record in TableScan(table_client, query):
+            facts = get_record_facts(record)
+            for fact in facts:
+                index_record = get_fact_index_record(record['RowKey'], fact, facts[fact])
+                wanted[index_record['RowKey']] = index_record
     except HttpResponseError as err:
         print("Error getting list of machines")
         print(err)
         sys.exit(2)
 
-    table = PrettyTable()
-    table.field_names = ['Machine', fact]
-    table.align = 'l'
+    # Index records that exist
+    existing = set()
+    query = f"PartitionKey eq '{PUPPETIDX_PK}'"
+    try:
+        for record in TableScan(table_client, query, KEY_ONLY):
+            existing.add(record['RowKey'])
+    except HttpResponseError as err:
+        print("Error getting fact index")
+        print(err)
+        sys.exit(2)
+
+    operations = []
+    for row_key in sorted(set(wanted) - existing):
+        operations.append(('upsert', wanted[row_key]))
+    for row_key in sorted(existing - set(wanted)):
+        operations.append(('delete', {'PartitionKey': PUPPETIDX_PK, 'RowKey': row_key}))
 
-    for record in data:
-        machine = record['RowKey']
-        value = record[fact]
-        table.add_row([machine, value])
+    num_batches = submit_batches(table_client, operations)
 
-    print(table)
+    print(f"Fact index rebuilt - {len(set(wanted) - existing)} records added, "
+          f"{len(existing - set(wanted))} records removed in {num_batches} batches")
 
 # -----------------------------------------------------------------------------
-# Functon to check if machine exists
+# Function to list the machines in the Azure table
 # -----------------------------------------------------------------------------
-def check_machine_exists(table_client, machine):
+def do_list_machines(table_client, page_size=None, limit=None, continue_from=None):
+
+    # Get data from Azure Table
+    query = f"PartitionKey eq '{PUPPETCFG_PK}'"
+    # Results are read as they are displayed
+    scan = TableScan(table_client, query, KEY_ONLY, page_size, limit, decode_continuation_token(continue_from))
+    try:
+        print_machines(scan)
+    except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+        print("Error getting list of machines", file=sys.stderr)
+        print(err, file=sys.stderr)
+        sys.exit(2)
 
-    machine_exists = True
+    print_continuation(scan)
 
-    # Get data for this machine from Azure Table
+# -----------------------------------------------------------------------------
+# Function to return machines that have a specific fact associate with them
+# Optionally, also filter by the value of that fact
+# -----------------------------------------------------------------------------
+def do_list_machines_with_fact(table_client, fact, value, page_size=None, limit=None, continue_from=None):
+
+    # Use the fact index if there is one
+    if gbl.FACT_INDEX:
+        do_list_machines_with_fact_index(table_client, fact, value, page_size, limit, continue_from)
+        return
+
+    if not value:
+        query = f"PartitionKey eq '{PUPPETCFG_PK}' and {fact} ne ''"
+    else:
+        query = f"PartitionKey eq '{PUPPETCFG_PK}' and {fact} eq '{value}'"
+
+    # Results are read as they are displayed
+    scan = TableScan(table_client, query, ['RowKey', fact], page_size, limit, decode_continuation_token(continue_from))
     try:
-        record = table_client.get_entity(PUPPETCFG_PK, machine)
-    except HttpResponseError as err:
-        machine_exists = False
-    
-    return machine_exists
+        print_machines_with_fact(scan, fact)
+    except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+        print("Error getting list of machines", file=sys.stderr)
+        print(err, file=sys.stderr)
+        sys.exit(2)
+
+    print_continuation(scan)
 
 # -----------------------------------------------------------------------------
 # Function to list the facts for a specific machine
 # -----------------------------------------------------------------------------
 def do_show_machine(table_client, machine):
 
-    # Initialise Variables
-    excluded_keys = ['PartitionKey', 'Timestanp', 'etag', 'RowKey']
-
     # Get data for this machine from Azure Table
     try:
         record = table_client.get_entity(PUPPETCFG_PK, machine)
@@ -130,121 +572,133 @@ def do_show_machine(table_client, machine):
         print("Machine", machine, "does not exist")
         sys.exit(1)
 
-    print("")
-    print("Facts for machine", machine)
-    print("")
+    print_machine(machine, record)
 
-    table = PrettyTable()
-    table.field_names = ['Fact', 'Value']
-    table.align = 'l'
+# -----------------------------------------------------------------------------
+# Function to update a machine record, guarded by its ETag
+# The record is read (only the select properties if specified), change
+# returns the entity to write and the write is made conditional on the record
+# not having changed since it was read. If it has, the read and write are
+# retried. Returns the record as read before the update
+# -----------------------------------------------------------------------------
+def update_machine_with_etag(table_client, machine, select, change, mode):
 
-    for key in record.keys():
-        # Ignore non-fact related data
-        if key in excluded_keys:
-            continue
+    for attempt in range(MAX_ETAG_RETRIES):
+        try:
+            record = table_client.get_entity(PUPPETCFG_PK, machine, select=select)
+        except ResourceNotFoundError:
+            print("Machine", machine, "does not exist")
+            sys.exit(1)
+        except HttpResponseError as err:
+            print("Error getting record for", machine)
+            print(err)
+            sys.exit(2)
 
-        value = record[key]
-        table.add_row([key, value])
+        entity = change(record)
 
-    print(table)
+        try:
+            table_client.update_entity(mode=mode, entity=entity, etag=record.metadata['etag'],
+                                       match_condition=MatchConditions.IfNotModified)
+            return record
+        except ResourceModifiedError:
+            if gbl.VERBOSE:
+                print("Record for", machine, "changed while updating it, retrying")
+        except HttpResponseError as err:
+            print("Error updating record for", machine)
+            print(err)
+            sys.exit(2)
+
+    print("Record for", machine, "changed", MAX_ETAG_RETRIES, "times while updating it, giving up")
+    sys.exit(2)
 
 # -----------------------------------------------------------------------------
 # Function to add/set a fact for a machine
+# The one property is MERGEd into the record, so facts set by someone else at
+# the same time are not lost
 # -----------------------------------------------------------------------------
 def do_set_fact(table_client, machine, fact, value):
 
-    # Get existing data for this machine
-    try:
-        record = table_client.get_entity(PUPPETCFG_PK, machine)
-    except HttpResponseError:
-        print("Machine", machine, "does not exist")
-        sys.exit(1)
-
-    # Is this a valid fact
-    if check_fact_exists(table_client, fact) == False:
-        print("Invalid fact -", fact)
+    # Check fact and value against the valid fact catalogue
+    error = check_catalogue(get_catalogue(table_client), fact, value)
+    if error is not None:
+        print(error)
         sys.exit(2)
 
-    # Is there a list of valid values for this fact?
-    has_valid_values = check_fact_has_valid_values(table_client, fact)
-    if has_valid_values == True:
-
-        # Check value is valid
-        value_is_valid = check_value(table_client, fact, value)
-
-        if value_is_valid == False:
-            print('Value', value, "for fact", fact, "is not valid")
+    entity = {}
+    entity['PartitionKey'] = PUPPETCFG_PK
+    entity['RowKey'] = machine
+    entity[fact] = value
+
+    if gbl.FACT_INDEX:
+        # The old value is needed for the fact index, so the MERGE is guarded
+        # by the ETag of the record it was read from
+        record = update_machine_with_etag(table_client, machine, [fact], lambda record: entity, UpdateMode.MERGE)
+        old_facts = {} if record.get(fact) is None else {fact: record[fact]}
+        update_fact_index(table_client, machine, old_facts, {fact: value})
+    else:
+        # A single MERGE, which fails if the machine does not exist
+        try:
+            table_client.update_entity(mode=UpdateMode.MERGE, entity=entity)
+        except ResourceNotFoundError:
+            print("Machine", machine, "does not exist")
+            sys.exit(1)
+        except HttpResponseError as err:
+            print("Error updating record for", machine)
+            print(err)
             sys.exit(2)
-        
-    # Add the fact to the record
-    record[fact] = value
 
-    # Update the table
-    try:
-        table_client.update_entity(mode=UpdateMode.REPLACE, entity=record)
-    except HttpResponseError as err:
-        print("Error updating record for", machine)
-        print(err)
-        sys.exit(2)
+    replica_set_fact(machine, fact, value)
 
     print("Added fact", fact, "value", value, "to machine", machine)
 
 # -----------------------------------------------------------------------------
 # Function to delete a fact for a machine
+# A property can't be removed with a MERGE, so the record is written back
+# without it, guarded by its ETag so a concurrent change is not overwritten
 # -----------------------------------------------------------------------------
 def do_delete_fact(table_client, machine, fact):
 
-    # Get existing data for this machine
-    try:
-        record = table_client.get_entity(PUPPETCFG_PK, machine)
-    except HttpResponseError:
-        print("Machine", machine, "does not exist")
-        sys.exit(1)
+    def remove_fact(record):
+        # Check if fact exists
+        if not fact in record:
+            print("fact", fact, "does not exist for", machine)
+            sys.exit(1)
 
-    # Check if fact exists
-    if not fact in record:
-        print("fact", fact, "does not exist for", machine)
-        sys.exit(1)
+        entity = dict(record)
+        del entity[fact]
+        return entity
 
-    # Delete fact from record
-    del record[fact]
+    record = update_machine_with_etag(table_client, machine, None, remove_fact, UpdateMode.REPLACE)
 
-    # Update table
-    try:
-        table_client.update_entity(mode=UpdateMode.REPLACE, entity=record)
-    except HttpResponseError as err:
-        print("Error updating record for", machine)
-        print(err)
-        sys.exit(2)
+    update_fact_index(table_client, machine, {fact: record[fact]}, {})
+    replica_delete_fact(machine, fact)
 
     print("Delted fact", fact, "from machine", machine)
 
 # -----------------------------------------------------------------------------
 # Function to add a new machine
+# The machine is created with all of its facts in a single request
 # -----------------------------------------------------------------------------
 def do_add_machine(table_client, machine, facts_values):
 
+    # Create new entity
+    record = {}
+    record['PartitionKey'] = PUPPETCFG_PK
+    record['RowKey'] = machine
+
     # Validate facts/values if specifed
     if facts_values != None:
+        catalogue = get_catalogue(table_client)
         for item in facts_values:
-            fact, value = item.split(':', 2)
+            fact, value = item.split(':', 1)
 
-            # Check if this is a valid fact
-            if check_fact_exists(table_client, fact) == False:
-                print(f"Error: fact {fact} is not valid")
+            # Check fact and value against the valid fact catalogue
+            error = check_catalogue(catalogue, fact, value)
+            if error is not None:
+                print(f"Error: {error}")
                 sys.exit(1)
 
-            # Check if this fact has a list of valid values
-            if check_fact_has_valid_values(table_client, fact) == True:
-                # If so, check if the value specified is valid
-                if check_value(table_client, fact, value) == False:
-                    print(f"Error: value {value} is invalid for fact {fact}")
-                    sys.exit(1)
-
-    # Create new entity
-    record = {}
-    record['PartitionKey'] = PUPPETCFG_PK
-    record['RowKey'] = machine
+            record[fact] = value
 
     try:
         response = table_client.create_entity(entity=record)
@@ -252,21 +706,27 @@ def do_add_machine(table_client, machine, facts_values):
         print("Machine", machine, "already exists")
         sys.exit(1)
 
-    print("Machine", machine, "added to configuration")
+    facts = get_record_facts(record)
+    update_fact_index(table_client, machine, {}, facts)
+    replica_set_machine(machine, facts)
 
-    # Set facts
-    if facts_values != None:
-        for item in facts_values:
-            fact, value = item.split(':', 2)
-            do_set_fact(table_client, machine, fact, value)
+    print("Machine", machine, "added to configuration")
+    for fact in facts:
+        print("Added fact", fact, "value", facts[fact], "to machine", machine)
 
 # -----------------------------------------------------------------------------
 # Function to delete a machine
 # -----------------------------------------------------------------------------
 def do_delete_machine(table_client, machine):
 
+    # The facts are only needed to remove the machine from the fact index
+    if gbl.FACT_INDEX:
+        select = None
+    else:
+        select = KEY_ONLY
+
     try:
-        data = table_client.get_entity(PUPPETCFG_PK, machine)
+        data = table_client.get_entity(PUPPETCFG_PK, machine, select=select)
     except HttpResponseError as err:
         print("Machine", machine, "does not exist")
         sys.exit(1)
@@ -278,6 +738,9 @@ def do_delete_machine(table_client, machine):
         print(err)
         sys.exit(2)
 
+    update_fact_index(table_client, machine, get_record_facts(data), {})
+    replica_delete_machine(machine)
+
     print("Machine", machine, "deleted")
 
 # -----------------------------------------------------------------------------
@@ -298,51 +761,55 @@ def do_add_valid_fact(table_client, fact):
         print("Valid Fact", fact, "already exists")
         sys.exit(1)
 
+    invalidate_cached_catalogue()
+    replica_set_valid_fact(fact, 'no')
+
     print("Valid Fact", fact, "added to configuration")
 
 # -----------------------------------------------------------------------------
 # Function to list valid facts
 # -----------------------------------------------------------------------------
-def do_list_valid_fact(table_client):
+def do_list_valid_fact(table_client, page_size=None, limit=None, continue_from=None):
 
     # Get data from Azure Table
     query = f"PartitionKey eq '{PUPPETVF_PK}'"
 
+    # Results are read as they are displayed
+    scan = TableScan(table_client, query, ['RowKey', 'ValidValues'], page_size, limit,
+                     decode_continuation_token(continue_from))
     try:
-        data = table_client.query_entities(query)
-    except HttpResponseError as err:
-        print("Error getting list of valid facts")
-        print(err)
+        print_valid_facts(scan)
+    except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+        print("Error getting list of valid facts", file=sys.stderr)
+        print(err, file=sys.stderr)
         sys.exit(2)
 
-    # Create table to display data
-    table = PrettyTable()
-    table.field_names = ['Valid Facts', 'Has List Of Valid Values']
-    table.align = 'l'
-
-    # Add data to table
-    for record in data:
-        fact = record['RowKey']
-        valid_values = record['ValidValues']
-        table.add_row([fact, valid_values])
-
-    # Display table
-    print(table)
+    print_continuation(scan)
 
 # -----------------------------------------------------------------------------
-# Functiom to delete valid fact
-# - will need functionality to remove valid fact values if they exist
+# Functiom to delete valid fact, and its valid values
 # - will need functionality to check if this is being used by any machines
 # -----------------------------------------------------------------------------
 def do_delete_valid_fact(table_client, fact):
 
     # Check if fact exists
     try:
-        data = table_client.get_entity(PUPPETVF_PK, fact)
+        data = table_client.get_entity(PUPPETVF_PK, fact, select=KEY_ONLY)
     except HttpResponseError as err:
         print("Valid Fact", fact, "does not exist")
         sys.exit(1)
 
+    # Delete the valid values first, so that none are left without a fact
+    query = prefix_query(PUPPETVFV_PK, valid_value_row_key(fact, ''))
+    try:
+        operations = [('delete', record) for record in table_client.query_entities(query, select=['PartitionKey', 'RowKey'])]
+    except HttpResponseError as err:
+        print("Error getting valid values for fact", fact)
+        print(err)
+        sys.exit(2)
+
+    submit_batches(table_client, operations)
+
     # Delete fact from Azure table
     try:
         table_client.delete_entity(partition_key=PUPPETVF_PK, row_key=fact)
@@ -351,61 +818,36 @@ def do_delete_valid_fact(table_client, fact):
         print(err)
         sys.exit(2)
 
-    print("Valid Fact", fact, "deleted")
-
-# -----------------------------------------------------------------------------
-# Check if a fact exists
-# -----------------------------------------------------------------------------
-def check_fact_exists(table_client, fact):
-
-    fact_exists = True
+    invalidate_cached_catalogue()
+    replica_delete_valid_fact(fact)
 
-    # Check if fact exists
-    try:
-        data = table_client.get_entity(PUPPETVF_PK, fact)
-    except HttpResponseError as err:
-        fact_exists = False
-    
-    return fact_exists
+    if len(operations) > 0:
+        print("Valid Fact", fact, "deleted, with", len(operations), "valid values")
+    else:
+        print("Valid Fact", fact, "deleted")
 
 # -----------------------------------------------------------------------------
-# Check if a fact has a list of valid values
+# Function to return the RowKey for a valid fact value
+# The fact and value are percent-encoded so that the separator and characters
+# not allowed in a RowKey (/ \ # ? and control characters) can't appear
 # -----------------------------------------------------------------------------
-def check_fact_has_valid_values(table_client, fact):
-
-    has_valid_values = False
+def valid_value_row_key(fact, value):
 
-    try:
-        fact_entity = table_client.get_entity(PUPPETVF_PK, fact)
-    except HttpResponseError as err:
-        print(err)
-        sys.exit(2)
+    fact_key = quote(str(fact), safe=ROW_KEY_SAFE_CHARS)
+    value_key = quote(str(value), safe=ROW_KEY_SAFE_CHARS)
 
-    if fact_entity['ValidValues'] == 'yes':
-        has_valid_values = True
-
-    return has_valid_values
+    return f"{fact_key}{ROW_KEY_SEPARATOR}{value_key}"
 
 # -----------------------------------------------------------------------------
-# Function to check if a fact value is valid
+# Function to return a query for all records in a partition whose RowKey
+# starts with the specified prefix
 # -----------------------------------------------------------------------------
-def check_value(table_client, fact, value):
+def prefix_query(partition_key, prefix):
 
-    valid_value = False
+    # The upper bound is the prefix with its last character incremented
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
-    query = f"PartitionKey eq '{PUPPETVFV_PK}' and VFVFact eq '{fact}' and VFVValue eq '{value}'"
-    try:
-        data = table_client.query_entities(query)
-    except HttpResponseError as err:
-        print("error with query")
-        print(query)
-        print(err)
-        sys.exit(2)
-
-    if get_record_count(data) > 0:
-        valid_value = True
-    
-    return valid_value
+    return f"PartitionKey eq '{partition_key}' and RowKey ge '{prefix}' and RowKey lt '{upper}'"
 
 # -----------------------------------------------------------------------------
 # Function to add a valid fact value
@@ -413,39 +855,39 @@ def check_value(table_client, fact, value):
 def do_add_valid_fact_value(table_client, fact, value):
 
     # Check if this is a valid fact
-
-    if not check_fact_exists(table_client, fact):
+    try:
+        fact_entity = table_client.get_entity(PUPPETVF_PK, fact)
+    except HttpResponseError:
         print("Fact", fact, "does not exist")
         sys.exit(1)
 
     # Create new entity
     record = {}
     record['PartitionKey'] = PUPPETVFV_PK
-    record['RowKey'] = str(uuid.uuid4())
+    record['RowKey'] = valid_value_row_key(fact, value)
     record['VFVFact'] = fact
     record['VFVValue'] = value
 
-    # Check if fact/value combination already exists
-    if check_valid_fact_value_exists(table_client, fact, value) == True:
-        print("Value", value, "for fact", fact, "already exists")
-        sys.exit(1)
-
-    # Add record to Azure table
+    # Add record to Azure table - the RowKey makes fact/value combinations unique
     try:
         response = table_client.create_entity(entity=record)
     except ResourceExistsError:
-        print("Something has gone wrong")
+        print("Value", value, "for fact", fact, "already exists")
         sys.exit(1)
 
     # Update fact record to indicate it has valid values
-    data = table_client.get_entity(PUPPETVF_PK, fact)
-    data['ValidValues'] = 'yes'
-    try:
-        table_client.update_entity(mode=UpdateMode.REPLACE, entity=data)
-    except HttpResponseError as err:
-        print("Error updating record for", fact)
-        print(err)
-        sys.exit(2)
+    if fact_entity['ValidValues'] != 'yes':
+        fact_entity['ValidValues'] = 'yes'
+        try:
+            table_client.update_entity(mode=UpdateMode.REPLACE, entity=fact_entity)
+        except HttpResponseError as err:
+            print("Error updating record for", fact)
+            print(err)
+            sys.exit(2)
+
+    invalidate_cached_catalogue()
+    replica_add_valid_value(fact, value)
+    replica_set_valid_fact(fact, 'yes')
 
     print("Valid Fact Value", value, "added to fact", fact)
 
@@ -454,69 +896,49 @@ def do_add_valid_fact_value(table_client, fact, value):
 # -----------------------------------------------------------------------------
 def check_valid_fact_value_exists(table_client, fact, value):
 
-    # Get data from Azure Table
-    query = f"PartitionKey eq '{PUPPETVFV_PK}' and VFVFact eq '{fact}' and VFVValue eq '{value}'"
+    fact_value_exists = True
 
     try:
-        data = table_client.query_entities(query)
+        record = table_client.get_entity(PUPPETVFV_PK, valid_value_row_key(fact, value), select=KEY_ONLY)
     except HttpResponseError as err:
-        print("error with query")
-        print(query)
-        print(err)
-        sys.exit(2)
-
-    record_count = get_record_count(data)
-    if record_count == 0:
         fact_value_exists = False
-    else:
-        fact_value_exists = True
 
     return fact_value_exists
 
 # -----------------------------------------------------------------------------
 # Function to return number of records
+# Stops counting at limit if one is specified, so get_record_count(data, 1)
+# only reads the first record to check if there are any
 # -----------------------------------------------------------------------------
-def get_record_count(item):
+def get_record_count(item, limit=None):
 
     record_count = 0
     for entity in item:
         record_count += 1
+        if limit is not None and record_count >= limit:
+            break
 
     return record_count
 
 # -----------------------------------------------------------------------------
 # Function to return list of valid values for specified fact
 # -----------------------------------------------------------------------------
-def do_list_valid_fact_value(table_client, fact):
+def do_list_valid_fact_value(table_client, fact, page_size=None, limit=None, continue_from=None):
 
     # Get data from Azure Table
-    query = f"PartitionKey eq '{PUPPETVFV_PK}' and VFVFact eq '{fact}'"
+    query = prefix_query(PUPPETVFV_PK, valid_value_row_key(fact, ''))
 
+    # Results are read as they are displayed
+    scan = TableScan(table_client, query, ['VFVValue'], page_size, limit, decode_continuation_token(continue_from))
     try:
-        data = table_client.query_entities(query)
-    except HttpResponseError as err:
-        print("error with query")
-        print(query)
-        print(err)
+        print_valid_values(fact, scan)
+    except (HttpResponseError, ServiceRequestError, ServiceResponseError) as err:
+        print("error with query", file=sys.stderr)
+        print(query, file=sys.stderr)
+        print(err, file=sys.stderr)
         sys.exit(2)
 
-    # Create table to display data
-    table = PrettyTable()
-    table.field_names = [f'Valid Values for fact {fact}']
-    table.align = 'l'
-    record_count = 0
-
-    # Add data to table
-    for record in data:
-        record_count += 1
-        value = record['VFVValue']
-        table.add_row([value])
-
-    # Display table
-    if record_count > 0:
-        print(table)
-    else:
-        print("No valid values for fact", fact)
+    print_continuation(scan)
 
   
 # -----------------------------------------------------------------------------
@@ -530,29 +952,16 @@ def do_delete_valid_fact_value(table_client, fact, value):
         print("Value", value, "for fact", fact, "does not exist")
         sys.exit(1)
 
-    # Get data from Azure Table
-    query = f"PartitionKey eq '{PUPPETVFV_PK}' and VFVFact eq '{fact}' and VFVValue eq '{value}'"
-
+    # Delete Record
     try:
-        data = table_client.query_entities(query)
+        table_client.delete_entity(partition_key=PUPPETVFV_PK, row_key=valid_value_row_key(fact, value))
     except HttpResponseError as err:
-        print("error with query")
-        print(query)
+        print("Error deleting valid fact", fact)
         print(err)
         sys.exit(2)
 
-    # Delete Record
-    for record in data:
-        row_key = record['RowKey']
-        try:
-            table_client.delete_entity(partition_key=PUPPETVFV_PK, row_key=row_key)
-        except HttpResponseError as err:
-            print("Error deleting valid fact", fact)
-            print(err)
-            sys.exit(2)
-
-    # How many valid values for this fact
-    num_valid_values = get_num_valid_values(table_client, fact)
+    # Are there any valid values left for this fact
+    num_valid_values = get_num_valid_values(table_client, fact, 1)
 
     # Update fact record if no valid values
     if num_valid_values == 0:
@@ -572,24 +981,111 @@ def do_delete_valid_fact_value(table_client, fact, value):
             print(err)
             sys.exit(2)
 
+        replica_set_valid_fact(fact, 'no')
+
+    invalidate_cached_catalogue()
+    replica_delete_valid_value(fact, value)
+
     print("Value", value, "removed from fact", fact)
 
 # -----------------------------------------------------------------------------
-# Function to return number of valid values for specified fact
+# Function to return number of valid values for specified fact, counting up
+# to limit values if one is specified
 # -----------------------------------------------------------------------------
-def get_num_valid_values(table_client, fact):
+def get_num_valid_values(table_client, fact, limit=None):
 
-    query = f"PartitionKey eq '{PUPPETVFV_PK}' and VFVFact eq '{fact}'"
+    query = prefix_query(PUPPETVFV_PK, valid_value_row_key(fact, ''))
     try:
-        data = table_client.query_entities(query)
+        data = table_client.query_entities(query, select=KEY_ONLY, results_per_page=limit)
+        num_values = get_record_count(data, limit)
     except HttpResponseError as err:
         print("error with query")
         print(query)
         print(err)
         sys.exit(2)
 
-    num_values = 0
-    for record in data:
-        num_values += 1
+    return num_values
+
+# -----------------------------------------------------------------------------
+# Function to migrate valid fact values stored under random (uuid) RowKeys to
+# fact|value RowKeys. Duplicate fact/value records are collapsed into one
+# The new records are all written before any old record is deleted, so a
+# failed batch never leaves a value without a record
+# -----------------------------------------------------------------------------
+def do_migrate_valid_values(table_client):
+
+    query = f"PartitionKey eq '{PUPPETVFV_PK}'"
+    try:
+        data = table_client.query_entities(query, select=['PartitionKey', 'RowKey', 'VFVFact', 'VFVValue'])
+        records = list(data)
+    except HttpResponseError as err:
+        print("Error getting list of valid fact values")
+        print(err)
+        sys.exit(2)
+
+    existing_keys = set(record['RowKey'] for record in records)
+    new_keys = set()
+    upserts = []
+    deletes = []
+    num_migrated = 0
+    num_duplicates = 0
+
+    for record in records:
+        fact = record['VFVFact']
+        value = record['VFVValue']
+        row_key = valid_value_row_key(fact, value)
+
+        if record['RowKey'] == row_key:
+            continue
+
+        # Create the record under its new key, once per fact/value
+        if row_key in existing_keys or row_key in new_keys:
+            num_duplicates += 1
+        else:
+            new_record = {}
+            new_record['PartitionKey'] = PUPPETVFV_PK
+            new_record['RowKey'] = row_key
+            new_record['VFVFact'] = fact
+            new_record['VFVValue'] = value
+            upserts.append(('upsert', new_record))
+            new_keys.add(row_key)
+            num_migrated += 1
+
+        if gbl.VERBOSE:
+            print("- Migrating", record['RowKey'], "to", row_key)
+
+        deletes.append(('delete', record))
+
+    # submit_batches exits if a batch fails, before the deletes are submitted
+    num_batches = submit_batches(table_client, upserts)
+    num_batches += submit_batches(table_client, deletes)
+
+    print(f"Migrated {num_migrated} valid fact values, removed {num_duplicates} duplicates in {num_batches} batches")
+
+# -----------------------------------------------------------------------------
+# Function to refresh the local replica from the Azure table
+# Each partition is read in a single paged scan and the replica is replaced
+# in one transaction, so readers never see a partial sync
+# -----------------------------------------------------------------------------
+def do_sync(table_client):
+
+    def read_partition(partition_key, select, description):
+        query = f"PartitionKey eq '{partition_key}'"
+        try:
+            yield from TableScan(table_client, query, select)
+        except HttpResponseError as err:
+            print("Error getting list of", description)
+            print(err)
+            sys.exit(2)
+
+    machines = ((record['RowKey'], get_record_facts(record))
+                for record in read_partition(PUPPETCFG_PK, None, "machines"))
+    valid_facts = ((record['RowKey'], record['ValidValues'])
+                   for record in read_partition(PUPPETVF_PK, ['RowKey', 'ValidValues'], "valid facts"))
+    valid_values = ((record['VFVFact'], record['VFVValue'])
+                    for record in read_partition(PUPPETVFV_PK, ['VFVFact', 'VFVValue'], "valid fact values"))
+
+    counts = write_replica(machines, valid_facts, valid_values)
 
-    return num_values
\ No newline at end of file
+    print(f"Replica synced - {counts['machines']} machines, {counts['valid_facts']} valid facts, "
+          f"{counts['valid_values']} valid fact values")
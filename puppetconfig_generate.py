@@ -2,27 +2,41 @@
 # Import Modules
 # -----------------------------------------------------------------------------
 import io
+import os
+import stat
+import fcntl
+import heapq
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import json
+import time
 import pwd
 import grp
 import sys
 import datetime
+from collections import OrderedDict
 from os import chown, mkdir, path
 from shutil import copyfile
 from time import strftime
-from puppetconfig_constants import PUPPETCFG_PK
-from puppetconfig_functions import get_config
+from puppetconfig_constants import PUPPETCFG_PK, STATE_FILE_SUFFIX, STATE_TAIL_SIZE, HASH_CHUNK_SIZE, DEFAULT_FULL_SYNC_INTERVAL, SYNC_OVERLAP
+from puppetconfig_constants import LOCK_FILE_NAME, DIRTY_FILE_NAME, DEFAULT_SOURCE_PRIORITY
+from puppetconfig_constants import KEY_ONLY, DEFAULT_OUTPUT, DEFAULT_SHARD_DIR, SHARD_INDEX_SUFFIX, SHARD_THREADS, SHARD_NO_GROUP
+from puppetconfig_constants import SHARD_MAX_OPEN_FILES
+from puppetconfig_config import get_config, check_sources
+from puppetconfig_client import get_table_client
+from puppetconfig_functions import get_entity_timestamp, get_record_facts, TableScan
+from puppetconfig_cache import format_timestamp
+from puppetconfig_serializer import get_serializer, dump_yaml, SHARD_EXTENSIONS
+from puppetconfig_stats import phase
 import puppetconfig_globals as gbl
 
 # -----------------------------------------------------------------------------
 # External Modules
 # -----------------------------------------------------------------------------
 
-try:
-    import yaml
-except ModuleNotFoundError:
-    print("Module PyYAML not instaled [pip3 install PyYAML]")
-    sys.exit(2)
-
 try:
     from azure.core.exceptions import HttpResponseError
 except:
@@ -30,112 +44,703 @@ except:
     sys.exit(2)
 
 # -----------------------------------------------------------------------------
-# Function to generate facts.yaml file
+# Function to read the sync details from the generate state file
+# The state file has one [node, facts] line per node, sorted by node, followed
+# by a line with the sync details. Returns None if there is no usable state
 # -----------------------------------------------------------------------------
-def do_generate(table_client, config_file):
+def load_state(state_file):
 
-    # Load settings from configuration file
-    cfg = get_config(config_file)
+    if not path.exists(state_file):
+        return None
 
-    # Initialize Variables
-    puppet_facts_dir = cfg['generate']['facts_dir']
-    yaml_file_name = cfg['generate']['yaml_file']
-    yaml_file = f'{puppet_facts_dir}/{yaml_file_name}'
+    try:
+        # The sync details are on the last line of the file
+        with open(state_file, "rb") as statefile:
+            statefile.seek(0, os.SEEK_END)
+            position = max(statefile.tell() - STATE_TAIL_SIZE, 0)
+            statefile.seek(position)
+            last_line = statefile.read().splitlines()[-1]
+        state = json.loads(last_line)
+        state['high_water'] = datetime.datetime.fromisoformat(state['high_water'])
+        state['last_full_sync'] = float(state['last_full_sync'])
+    except (OSError, ValueError, KeyError, TypeError, IndexError) as err:
+        print("Ignoring invalid state file", state_file, "-", err)
+        return None
 
-    now = datetime.datetime.now()
-    timestamp = now.strftime('%d-%m-%Y-%H-%M-%S')
-    backup_yaml_file = f'{puppet_facts_dir}/{yaml_file_name}.{timestamp}'
+    return state
 
-    puppet_user = cfg['generate']['puppet_user']
-    puppet_group = cfg['generate']['puppet_group']
-    puppet_uid = pwd.getpwnam(puppet_user).pw_uid
-    puppet_gid = grp.getgrnam(puppet_group).gr_gid
+# -----------------------------------------------------------------------------
+# Function to read the nodes from the generate state file, in node order
+# -----------------------------------------------------------------------------
+def read_state_nodes(state_file):
 
-    if gbl.VERBOSE:
-        print("yaml file is", yaml_file)
-        print("backup yaml file is", backup_yaml_file)
+    with open(state_file, "r", encoding='utf8') as statefile:
+        for line in statefile:
+            item = json.loads(line)
+            if isinstance(item, list):
+                yield item[0], item[1]
 
-    yamldata = {
-        'server::facts': {}
-    }
+# -----------------------------------------------------------------------------
+# Function to read machine records from the Azure Table, page by page
+# Records are returned in RowKey (node) order by the table service. The latest
+# Timestamp seen is kept in sync['high_water']
+# -----------------------------------------------------------------------------
+def read_table_nodes(table_client, query, sync):
 
-    nodelist = []
-    nodedata = {}
+    try:
+        for record in TableScan(table_client, query):
+            timestamp = get_entity_timestamp(record)
+            if timestamp is not None and (sync['high_water'] is None or timestamp > sync['high_water']):
+                sync['high_water'] = timestamp
+            yield record['RowKey'], get_record_facts(record)
+    except HttpResponseError as err:
+        print("Error getting list of machines")
+        print(err)
+        sys.exit(2)
 
-    # Create puppet facts directory id it doesn't exist
-    if not path.exists(puppet_facts_dir):
-        if gbl.VERBOSE:
-            print("Cresting puppet facts directory", puppet_facts_dir)
-        mkdir(puppet_facts_dir)
-        chown(puppet_facts_dir, puppet_uid, puppet_gid)
+# -----------------------------------------------------------------------------
+# Function to read the machine names from the Azure Table, in node order
+# -----------------------------------------------------------------------------
+def read_table_machines(table_client):
 
-    # Get data from Azure Table
     query = f"PartitionKey eq '{PUPPETCFG_PK}'"
-
-    if gbl.VERBOSE:
-        print("Getting data from Azure Table")
-
     try:
-        data = table_client.query_entities(query)
+        for record in TableScan(table_client, query, KEY_ONLY):
+            yield record['RowKey']
     except HttpResponseError as err:
         print("Error getting list of machines")
         print(err)
         sys.exit(2)
 
-    # Loop round all records
-    for record in data:
-        noderecord = {}
+# -----------------------------------------------------------------------------
+# Function to merge the nodes from the last run with changed records
+# All three inputs are in node order, so this is a single merge pass: the
+# machine list decides which nodes exist (dropping deleted machines), changed
+# records replace the saved facts
+# -----------------------------------------------------------------------------
+def merge_nodes(table_client, state_nodes, changed, machines):
 
-        # Iterate round all properties in this record
-        for key in record.keys():
+    state_node = next(state_nodes, None)
 
-            # Exclude unwanted properties
-            if key == 'PartitionKey' or key == 'Timestamp' or key == 'etag':
+    for machine in machines:
+
+        # Skip saved nodes that are no longer in the table
+        while state_node is not None and state_node[0] < machine:
+            if gbl.VERBOSE:
+                print("Removing deleted node", state_node[0])
+            state_node = next(state_nodes, None)
+
+        saved_node = None
+        if state_node is not None and state_node[0] == machine:
+            saved_node = state_node
+            state_node = next(state_nodes, None)
+
+        if machine in changed:
+            yield machine, changed[machine]
+        elif saved_node is not None:
+            yield saved_node
+        else:
+            # Not in the saved state or the changes - read it directly
+            try:
+                record = table_client.get_entity(PUPPETCFG_PK, machine)
+            except HttpResponseError:
                 continue
+            yield machine, get_record_facts(record)
+
+    while state_node is not None:
+        if gbl.VERBOSE:
+            print("Removing deleted node", state_node[0])
+        state_node = next(state_nodes, None)
+
+# -----------------------------------------------------------------------------
+# Function to return the nodes to write, in node order, and the sync details
+# Runs after the first only read records changed since the last high water
+# mark and merge them with the saved nodes, using a key-only scan to catch
+# deleted machines. A full scan is done when there is no state, when
+# full_sync is set or every full_sync_interval
+# -----------------------------------------------------------------------------
+def get_node_data(table_client, state_file, full_sync_interval, full_sync):
+
+    state = None
+    if not full_sync:
+        state = load_state(state_file)
+
+    now = time.time()
+
+    if state is None or now - state['last_full_sync'] > full_sync_interval:
+
+        if gbl.VERBOSE:
+            print("Getting data from Azure Table")
+
+        sync = {'high_water': None, 'last_full_sync': now}
+        query = f"PartitionKey eq '{PUPPETCFG_PK}'"
+        return read_table_nodes(table_client, query, sync), sync
+
+    sync = {'high_water': state['high_water'], 'last_full_sync': state['last_full_sync']}
+
+    # Changed records - the overlap allows for writes that become visible
+    # after a later Timestamp has already been seen
+    since = format_timestamp(state['high_water'] - datetime.timedelta(seconds=SYNC_OVERLAP))
+    query = f"PartitionKey eq '{PUPPETCFG_PK}' and Timestamp gt datetime'{since}'"
+
+    if gbl.VERBOSE:
+        print("Getting changes since", since, "from Azure Table")
 
-            # If this is the nodename property (RowKey) add it to the list of nodes
-            # otherwise add the property name & value to the noderecord dictionary
-            this_value = record[key]
-            if key == 'RowKey':
-                nodename = this_value
-                nodelist.append(this_value)
-            else:
-                noderecord[key] = this_value
+    changed = dict(read_table_nodes(table_client, query, sync))
 
-        nodedata[nodename] = noderecord
+    if gbl.VERBOSE:
+        print(len(changed), "changed nodes")
+
+    nodes = merge_nodes(table_client, read_state_nodes(state_file), changed, read_table_machines(table_client))
+
+    return nodes, sync
+
+# -----------------------------------------------------------------------------
+# Function to return the sources listed in the configuration, highest priority
+# first. Sources with the same priority keep their order in the file
+# Returns None if the configuration has no sources, and the azure table is
+# the only source
+# -----------------------------------------------------------------------------
+def get_sources(cfg):
+
+    sources = cfg.get('sources')
+    if not sources:
+        return None
+
+    errors = check_sources(sources)
+    if len(errors) > 0:
+        for error in errors:
+            print(error)
+        sys.exit(2)
+
+    return sorted(sources, key=lambda source: -source.get('priority', DEFAULT_SOURCE_PRIORITY))
+
+# -----------------------------------------------------------------------------
+# Function to return the client for a source
+# -----------------------------------------------------------------------------
+def get_source_client(source):
+
+    return get_table_client(source['endpoint'], source['sas_token'], source['table_name'])
+
+# -----------------------------------------------------------------------------
+# Function to return the state file a source's nodes are saved to
+# -----------------------------------------------------------------------------
+def get_source_state_file(yaml_file, source):
+
+    return f"{yaml_file}.{source['name']}{STATE_FILE_SUFFIX}"
+
+# -----------------------------------------------------------------------------
+# Function to read the nodes from one source, with the node prefix added
+# When yaml_file is set the source is read incrementally, as a single table
+# is, and its nodes are saved to its own state file for the next run.
+# Otherwise the whole source is read
+# Returns a list of (node, facts) in node order
+# -----------------------------------------------------------------------------
+def read_source(source, yaml_file, full_sync_interval, full_sync):
+
+    if gbl.VERBOSE:
+        print("Reading source", source['name'])
+
+    table_client = get_source_client(source)
+
+    if yaml_file is None:
+        sync = {'high_water': None}
+        nodes = list(read_table_nodes(table_client, f"PartitionKey eq '{PUPPETCFG_PK}'", sync))
+    else:
+        state_file = get_source_state_file(yaml_file, source)
+        temp_state_file = f'{state_file}.tmp'
+        nodes, sync = get_node_data(table_client, state_file, full_sync_interval, full_sync)
+        nodes = list(nodes)
+
+        with phase('state'), io.open(temp_state_file, 'w', encoding='utf8') as statefile:
+            for nodename, record in nodes:
+                statefile.write(json.dumps([nodename, record]))
+                statefile.write('\n')
+            write_sync_details(statefile, sync)
+        os.replace(temp_state_file, state_file)
+
+    # Adding the same prefix to every node keeps them in node order
+    prefix = source.get('node_prefix') or ''
+    if prefix != '':
+        nodes = [(prefix + nodename, record) for nodename, record in nodes]
 
-    # Build yaml data structure
     if gbl.VERBOSE:
-        print("Building yaml data structure")
+        print("Read", len(nodes), "nodes from source", source['name'])
+
+    return nodes
 
-    for nodename in nodelist:
+# -----------------------------------------------------------------------------
+# Function to merge the nodes from several sources, in node order
+# sources are in priority order, and source_nodes holds each source's nodes
+# in node order. When a node comes from more than one source, the source
+# with the highest priority wins and the node is ignored in the others
+# -----------------------------------------------------------------------------
+def merge_sources(sources, source_nodes):
+
+    # The source's position breaks ties between nodes with the same name
+    streams = [[(nodename, rank, record) for nodename, record in nodes] for rank, nodes in enumerate(source_nodes)]
+
+    last_node = None
+    for nodename, rank, record in heapq.merge(*streams):
+        if nodename == last_node:
+            if gbl.VERBOSE:
+                print("Ignoring node", nodename, "from source", sources[rank]['name'])
+            continue
+        last_node = nodename
+        yield nodename, record
+
+# -----------------------------------------------------------------------------
+# Function to read all the sources and merge their nodes
+# Each source is read by its own thread, so this takes as long as the slowest
+# source rather than the sum of all of them
+# Returns the merged nodes, in node order
+# -----------------------------------------------------------------------------
+def read_sources(sources, yaml_file=None, full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL, full_sync=False):
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [executor.submit(read_source, source, yaml_file, full_sync_interval, full_sync) for source in sources]
+        source_nodes = [future.result() for future in futures]
+
+    return merge_sources(sources, source_nodes)
+
+# -----------------------------------------------------------------------------
+# Function to pass a stream of nodes to write_node and save them to the state
+# file, followed by the sync details. write_node is passed the node name, its
+# facts and True for the first node
+# Returns the number of nodes written
+# -----------------------------------------------------------------------------
+def write_nodes(nodes, sync, statefile, write_node):
+
+    node_count = 0
+
+    for nodename, record in nodes:
         if gbl.VERBOSE:
             print("Adding node", nodename)
+            for key in sorted(record):
+                print("- Adding fact", key, "value", record[key])
+
+        write_node(nodename, record, node_count == 0)
+
+        with phase('state'):
+            statefile.write(json.dumps([nodename, record]))
+            statefile.write('\n')
+
+        node_count += 1
+
+    write_sync_details(statefile, sync)
+
+    return node_count
+
+# -----------------------------------------------------------------------------
+# Function to write the sync details line that ends a state file
+# -----------------------------------------------------------------------------
+def write_sync_details(statefile, sync):
+
+    if sync['high_water'] is None:
+        sync['high_water'] = datetime.datetime.now(datetime.timezone.utc)
+
+    statefile.write(json.dumps({'high_water': sync['high_water'].isoformat(),
+                                'last_full_sync': sync['last_full_sync']}))
+    statefile.write('\n')
+
+# -----------------------------------------------------------------------------
+# Function to return the sha256 hash of a file
+# -----------------------------------------------------------------------------
+def get_file_hash(file_name):
+
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as hashfile:
+        for chunk in iter(lambda: hashfile.read(HASH_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
 
-        record = nodedata[nodename]
-        yamldata['server::facts'][nodename] = {}
-        for key in record.keys():
-            value = record[key]
+    return file_hash.hexdigest()
+
+# -----------------------------------------------------------------------------
+# Function to replace a file with a newly written temporary file
+# Nothing is done if the content is unchanged. Otherwise the existing file is
+# backed up and the temporary file is renamed over it, so readers see either
+# the old or the new file and never a partly written one
+# Returns True if the file was replaced
+# -----------------------------------------------------------------------------
+def publish_file(temp_file, target_file, backup_file, uid, gid):
+
+    if path.exists(target_file):
+        with phase('compare'):
+            unchanged = path.getsize(temp_file) == path.getsize(target_file) and \
+                        get_file_hash(temp_file) == get_file_hash(target_file)
+        if unchanged:
+            return False
+
+        # Backup existing file
+        if backup_file is not None:
             if gbl.VERBOSE:
-                print("- Adding fact", key, "value", value)
+                print("Backing up", target_file, "to", backup_file)
 
-            yamldata['server::facts'][nodename][key] = value
+            with phase('backup'):
+                copyfile(target_file, backup_file)
 
-    # Backup existing yaml file
-    if path.exists(yaml_file):
-        if gbl.VERBOSE:
-            print("Backing up", yaml_file, "to", backup_yaml_file)
+        mode = stat.S_IMODE(os.stat(target_file).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
 
-        copyfile(yaml_file, backup_yaml_file)
+    with phase('chown'):
+        os.chmod(temp_file, mode)
+        chown(temp_file, uid, gid)
+    os.rename(temp_file, target_file)
+
+    # Make sure the rename is on disk
+    dir_fd = os.open(path.dirname(target_file) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
-    # Create yaml file
+    return True
+
+# -----------------------------------------------------------------------------
+# Function to write content to a file, unless the file already has exactly
+# that content. The file is written to a temporary file and renamed into place
+# Returns True if the file was written
+# -----------------------------------------------------------------------------
+def publish_content(content, target_file, uid, gid):
+
+    content = content.encode('utf8')
+
+    if path.exists(target_file) and path.getsize(target_file) == len(content):
+        with open(target_file, "rb") as currentfile:
+            if currentfile.read() == content:
+                return False
+
+    temp_fd, temp_file = tempfile.mkstemp(prefix=f'.{path.basename(target_file)}.', dir=path.dirname(target_file))
+    try:
+        with io.open(temp_fd, 'wb') as outfile:
+            outfile.write(content)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        publish_file(temp_file, target_file, None, uid, gid)
+    finally:
+        if path.exists(temp_file):
+            os.remove(temp_file)
+
+    return True
+
+# -----------------------------------------------------------------------------
+# Function to write all nodes to a single facts file
+# Returns True if the facts file changed
+# -----------------------------------------------------------------------------
+def write_single_file(nodes, sync, statefile, yaml_file, backup_yaml_file, uid, gid, serializer):
+
+    # Create facts file in a temporary file, writing each node as it is read
     if gbl.VERBOSE:
         print("Creating", yaml_file, "file")
 
-    with io.open(yaml_file, 'w', encoding='utf8') as outfile:
-        yaml.dump(yamldata, outfile, default_flow_style=False, allow_unicode=True)
+    temp_fd, temp_yaml_file = tempfile.mkstemp(prefix=f'.{path.basename(yaml_file)}.', dir=path.dirname(yaml_file))
+
+    try:
+        with io.open(temp_fd, 'w', encoding='utf8') as outfile:
+            node_count = write_nodes(nodes, sync, statefile,
+                                     lambda nodename, record, first: outfile.write(serializer.node(nodename, record, first)))
+            outfile.write(serializer.end(node_count))
+            with phase('write'):
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+        changed = publish_file(temp_yaml_file, yaml_file, backup_yaml_file, uid, gid)
+    finally:
+        if path.exists(temp_yaml_file):
+            os.remove(temp_yaml_file)
+
+    return changed
+
+# -----------------------------------------------------------------------------
+# Function to return the shard file name for a node or group
+# -----------------------------------------------------------------------------
+def get_shard_file_name(name, extension):
+
+    return quote(str(name), safe='-_.@+,=') + extension
+
+# -----------------------------------------------------------------------------
+# Function to open a temporary file next to a file that is being replaced
+# -----------------------------------------------------------------------------
+def open_temp_file(target_file):
+
+    temp_fd, temp_file = tempfile.mkstemp(prefix=f'.{path.basename(target_file)}.', dir=path.dirname(target_file))
+
+    return io.open(temp_fd, 'w', encoding='utf8'), temp_file
+
+# -----------------------------------------------------------------------------
+# Function to write the facts as one file per node, or one file per value of
+# group_fact, plus an index file (next to the shard directory) mapping each
+# node to its shard file
+# Shards are written by a thread pool and only rewritten if their content has
+# changed. Shard files for nodes or groups that no longer exist are removed.
+# At most SHARD_MAX_OPEN_FILES group files are kept open - the least recently
+# written is closed and reopened when it is next needed
+# Returns True if any shard changed
+# -----------------------------------------------------------------------------
+def write_shards(nodes, sync, statefile, shard_dir, group_fact, uid, gid, serializer):
+
+    if gbl.VERBOSE:
+        print("Creating shard files in", shard_dir)
+
+    index_file = f'{shard_dir}{SHARD_INDEX_SUFFIX}'
+    shard_files = set()
+    futures = []
+
+    # Temporary file for each group shard, and the ones that are open, least
+    # recently written first
+    group_files = {}
+    open_files = OrderedDict()
+
+    # Limit the number of node shards waiting for the thread pool
+    slots = threading.BoundedSemaphore(SHARD_THREADS * 4)
+
+    def publish_node_shard(content, shard_file):
+        try:
+            return publish_content(content, f'{shard_dir}/{shard_file}', uid, gid)
+        finally:
+            slots.release()
+
+    def publish_temp_file(temp_file, shard_file):
+        try:
+            return publish_file(temp_file, f'{shard_dir}/{shard_file}', None, uid, gid)
+        finally:
+            if path.exists(temp_file):
+                os.remove(temp_file)
+
+    def get_group_file(shard_file):
+        groupfile = open_files.get(shard_file)
+        if groupfile is not None:
+            open_files.move_to_end(shard_file)
+            return groupfile
+
+        if shard_file in group_files:
+            groupfile = io.open(group_files[shard_file], 'a', encoding='utf8')
+        else:
+            groupfile, group_files[shard_file] = open_temp_file(f'{shard_dir}/{shard_file}')
+        open_files[shard_file] = groupfile
+
+        if len(open_files) > SHARD_MAX_OPEN_FILES:
+            open_files.popitem(last=False)[1].close()
+
+        return groupfile
+
+    indexfile, temp_index_file = open_temp_file(index_file)
+
+    def write_node(nodename, record, first):
+        if group_fact is None:
+            shard_file = get_shard_file_name(nodename, serializer.extension)
+            slots.acquire()
+            content = serializer.node(nodename, record, True) + serializer.end(1)
+            futures.append(executor.submit(publish_node_shard, content, shard_file))
+        else:
+            # Group shards are written as the nodes arrive, so are in node order
+            shard_file = get_shard_file_name(record.get(group_fact, SHARD_NO_GROUP), serializer.extension)
+            first_in_group = shard_file not in group_files
+            get_group_file(shard_file).write(serializer.node(nodename, record, first_in_group))
+
+        shard_files.add(shard_file)
+        indexfile.write(dump_yaml({nodename: shard_file}))
+
+    try:
+        with ThreadPoolExecutor(max_workers=SHARD_THREADS) as executor:
+            node_count = write_nodes(nodes, sync, statefile, write_node)
+
+            for shard_file, temp_file in group_files.items():
+                groupfile = get_group_file(shard_file)
+                groupfile.write(serializer.end(1))
+                groupfile.flush()
+                os.fsync(groupfile.fileno())
+                groupfile.close()
+                del open_files[shard_file]
+                futures.append(executor.submit(publish_temp_file, temp_file, shard_file))
+
+            changed = False
+            for future in futures:
+                if future.result():
+                    changed = True
+
+        # Index file
+        if node_count == 0:
+            indexfile.write("{}\n")
+        indexfile.flush()
+        os.fsync(indexfile.fileno())
+        indexfile.close()
+        if publish_file(temp_index_file, index_file, None, uid, gid):
+            changed = True
+    finally:
+        indexfile.close()
+        for groupfile in open_files.values():
+            groupfile.close()
+        for temp_file in group_files.values():
+            if path.exists(temp_file):
+                os.remove(temp_file)
+        if path.exists(temp_index_file):
+            os.remove(temp_index_file)
+
+    # Remove shards that are no longer needed, including any in another format
+    for file_name in os.listdir(shard_dir):
+        if file_name.endswith(SHARD_EXTENSIONS) and file_name not in shard_files:
+            if gbl.VERBOSE:
+                print("Removing shard", file_name)
+            os.remove(f'{shard_dir}/{file_name}')
+            changed = True
+
+    return changed
+
+# -----------------------------------------------------------------------------
+# Function to take an exclusive lock on a lock file without waiting
+# Returns the open lock file descriptor, or None if the lock is already held
+# -----------------------------------------------------------------------------
+def acquire_lock(lock_file):
+
+    lock_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        return None
+
+    return lock_fd
+
+# -----------------------------------------------------------------------------
+# Function to release a lock taken by acquire_lock
+# -----------------------------------------------------------------------------
+def release_lock(lock_fd):
+
+    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    os.close(lock_fd)
+
+# -----------------------------------------------------------------------------
+# Function to generate facts.yaml file
+# Returns True if the facts changed, False if they didn't, and None if
+# another generate is running and has been asked to do another pass
+# -----------------------------------------------------------------------------
+def do_generate(table_client, config_file, full_sync=False):
 
-    chown(yaml_file, puppet_uid, puppet_gid)
+    # Load settings from configuration file
+    with phase('config'):
+        cfg = get_config(config_file)
+
+    # Initialize Variables
+    puppet_facts_dir = cfg['generate']['facts_dir']
+    yaml_file_name = cfg['generate']['yaml_file']
+    yaml_file = f'{puppet_facts_dir}/{yaml_file_name}'
+
+    state_file = f'{yaml_file}{STATE_FILE_SUFFIX}'
+    lock_file = f'{puppet_facts_dir}/{LOCK_FILE_NAME}'
+    dirty_file = f'{puppet_facts_dir}/{DIRTY_FILE_NAME}'
+    temp_state_file = f'{state_file}.tmp'
+    full_sync_interval = cfg['generate'].get('full_sync_interval', DEFAULT_FULL_SYNC_INTERVAL)
+
+    # Output mode - single yaml file, one file per node or one file per value
+    # of group_fact
+    output = cfg['generate'].get('output', DEFAULT_OUTPUT)
+    group_fact = cfg['generate'].get('group_fact')
+    shard_dir_name = cfg['generate'].get('shard_dir', DEFAULT_SHARD_DIR)
+    shard_dir = f'{puppet_facts_dir}/{shard_dir_name}'
+
+    if output not in ['single', 'node', 'group']:
+        print("Invalid generate output", output, "- must be single, node or group")
+        sys.exit(2)
+
+    # Format of the facts files - yaml or json
+    serializer = get_serializer(cfg)
+
+    # Tables to read - the azure table, or the sources listed in the config
+    sources = get_sources(cfg)
+
+    if output == 'node':
+        group_fact = None
+    elif output == 'group' and not group_fact:
+        print("generate group_fact must be set for group output")
+        sys.exit(2)
+
+    puppet_user = cfg['generate']['puppet_user']
+    puppet_group = cfg['generate']['puppet_group']
+    puppet_uid = pwd.getpwnam(puppet_user).pw_uid
+    puppet_gid = grp.getgrnam(puppet_group).gr_gid
+
+    if gbl.VERBOSE:
+        print("yaml file is", yaml_file)
+
+    # Create puppet facts directory id it doesn't exist
+    if not path.exists(puppet_facts_dir):
+        if gbl.VERBOSE:
+            print("Cresting puppet facts directory", puppet_facts_dir)
+        mkdir(puppet_facts_dir)
+        chown(puppet_facts_dir, puppet_uid, puppet_gid)
+
+    if output != 'single' and not path.exists(shard_dir):
+        mkdir(shard_dir)
+        chown(shard_dir, puppet_uid, puppet_gid)
+
+    # Only one generate runs at a time. If one is already running, ask it to
+    # do another pass once it has finished the current one
+    lock_fd = acquire_lock(lock_file)
+    if lock_fd is None:
+        open(dirty_file, 'a').close()
+        lock_fd = acquire_lock(lock_file)
+        if lock_fd is None:
+            print("generate already running - another pass has been requested")
+            return None
+
+    changed = False
+
+    while lock_fd is not None:
+        try:
+            while True:
+                if path.exists(dirty_file):
+                    os.remove(dirty_file)
+
+                # Get data from Azure Table, incrementally if there is a usable state file.
+                # Each source has its own state file, as the merged nodes can't be read
+                # incrementally - a later run without sources does a full sync
+                if sources is None:
+                    nodes, sync = get_node_data(table_client, state_file, full_sync_interval, full_sync)
+                else:
+                    nodes = read_sources(sources, yaml_file, full_sync_interval, full_sync)
+                    sync = {'high_water': None, 'last_full_sync': 0}
+                full_sync = False
+
+                # Write the facts, either to one file or to one file per shard
+                timestamp = datetime.datetime.now().strftime('%d-%m-%Y-%H-%M-%S')
+                backup_yaml_file = f'{puppet_facts_dir}/{yaml_file_name}.{timestamp}'
+
+                with io.open(temp_state_file, 'w', encoding='utf8') as statefile:
+                    if output == 'single':
+                        pass_changed = write_single_file(nodes, sync, statefile, yaml_file, backup_yaml_file, puppet_uid, puppet_gid,
+                                                        serializer)
+                    else:
+                        pass_changed = write_shards(nodes, sync, statefile, shard_dir, group_fact, puppet_uid, puppet_gid,
+                                                    serializer)
+
+                if pass_changed:
+                    changed = True
+
+                # Save sync state for the next run
+                os.replace(temp_state_file, state_file)
+
+                if not path.exists(dirty_file):
+                    break
+
+                if gbl.VERBOSE:
+                    print("Another generate was requested while running - running again")
+        finally:
+            release_lock(lock_fd)
+
+        # Catch a request made after the last check but before the release
+        lock_fd = None
+        if path.exists(dirty_file):
+            lock_fd = acquire_lock(lock_file)
 
     if gbl.VERBOSE:
+        if changed:
+            print("Facts changed")
+        else:
+            print("Facts unchanged")
         print("Completed")
+
+    return changed
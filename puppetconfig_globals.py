@@ -6,6 +6,62 @@ def init():
     global DEBUG
     DEBUG = False
 
+    # Output format for list and show commands (--output switch)
+    global OUTPUT
+    OUTPUT = 'table'
+
     # Global verbose flag (--verbose switch)
     global VERBOSE
-    VERBOSE = False
\ No newline at end of file
+    VERBOSE = False
+
+    # Maintain and use the fact index partition (fact_index in config file)
+    global FACT_INDEX
+    FACT_INDEX = False
+
+    # Catalogue cache directory, None if the cache is disabled (--no-cache)
+    global CACHE_DIR
+    CACHE_DIR = None
+
+    # Catalogue cache key (table endpoint and table name)
+    global CACHE_KEY
+    CACHE_KEY = None
+
+    # Seconds before the cached catalogue is revalidated against the table
+    global CACHE_TTL
+    CACHE_TTL = 0
+
+    # Seconds before the cached catalogue is reloaded in full
+    global CACHE_MAX_AGE
+    CACHE_MAX_AGE = 0
+
+    # Read-only commands must use the local replica (--offline switch)
+    global OFFLINE
+    OFFLINE = False
+
+    # Local replica file, None if no replica is configured
+    global REPLICA_FILE
+    REPLICA_FILE = None
+
+    # Seconds since the last sync that read-only commands will use the
+    # replica for without --offline (0 to only use it with --offline)
+    global REPLICA_MAX_STALENESS
+    REPLICA_MAX_STALENESS = 0
+
+    # Maximum number of concurrent requests for multi-entity commands
+    global CONCURRENCY
+    CONCURRENCY = 1
+
+    # Valid fact catalogue loaded by this process, None until it is loaded.
+    # Kept for the life of the process (e.g. the shell) until the catalogue
+    # is changed or refreshed
+    global CATALOGUE
+    CATALOGUE = None
+
+    # Requests and phases recorded for --stats and --trace, None if they are
+    # not being recorded
+    global STATS
+    STATS = None
+
+    # Open --trace file, None if requests are not being traced
+    global TRACE
+    TRACE = None
@@ -0,0 +1,159 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import csv
+import json
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from prettytable import PrettyTable
+except ModuleNotFoundError:
+    print("Module prettytable not instaled [pip3 install prettytable]")
+    sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Display functions for the list/show commands
+# These take records shaped like the table entities, whether they came from
+# the table or the local replica, and don't need the azure SDK
+# The output format is set by --output (gbl.OUTPUT). The table format has to
+# read every row before printing anything; the json, ndjson and csv formats
+# write each page of rows as soon as it has been read
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Function to return the pages of a query result
+# Query results are read a page at a time, so that each page can be written
+# as soon as it arrives. Other data (e.g. from the replica) is one page
+# -----------------------------------------------------------------------------
+def get_pages(data):
+
+    if hasattr(data, 'by_page'):
+        return data.by_page()
+
+    return [data]
+
+# -----------------------------------------------------------------------------
+# Function to write rows in the output format
+# headings are the table column headings and keys the names used for the
+# columns in the other formats. pages is an iterable of pages, each an
+# iterable of rows (lists of values)
+# Returns the number of rows written
+# -----------------------------------------------------------------------------
+def write_rows(headings, keys, pages):
+
+    row_count = 0
+
+    if gbl.OUTPUT == 'table':
+        table = PrettyTable()
+        table.field_names = headings
+        table.align = 'l'
+
+        for page in pages:
+            for row in page:
+                table.add_row(row)
+                row_count += 1
+
+        print(table)
+
+        return row_count
+
+    if gbl.OUTPUT == 'csv':
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(keys)
+
+    if gbl.OUTPUT == 'json':
+        sys.stdout.write('[')
+
+    # If reading a page fails the array is still closed, so that what has been
+    # written is valid json. The error is reported on stderr by the caller
+    try:
+        for page in pages:
+            for row in page:
+                if gbl.OUTPUT == 'csv':
+                    writer.writerow(row)
+                elif gbl.OUTPUT == 'json':
+                    sys.stdout.write(',\n' if row_count > 0 else '\n')
+                    sys.stdout.write(json.dumps(dict(zip(keys, row)), default=str))
+                else:
+                    sys.stdout.write(json.dumps(dict(zip(keys, row)), default=str))
+                    sys.stdout.write('\n')
+                row_count += 1
+            sys.stdout.flush()
+    finally:
+        if gbl.OUTPUT == 'json':
+            sys.stdout.write('\n]\n' if row_count > 0 else ']\n')
+            sys.stdout.flush()
+
+    return row_count
+
+# -----------------------------------------------------------------------------
+# Function to display a list of machines
+# -----------------------------------------------------------------------------
+def print_machines(data):
+
+    pages = (([record['RowKey']] for record in page) for page in get_pages(data))
+    write_rows(['Machine List'], ['machine'], pages)
+
+# -----------------------------------------------------------------------------
+# Function to display machines and their value for a fact
+# machine_key and value_key are the properties of each record holding the
+# machine name and the value (by default RowKey and the fact itself)
+# -----------------------------------------------------------------------------
+def print_machines_with_fact(data, fact, machine_key='RowKey', value_key=None):
+
+    if value_key is None:
+        value_key = fact
+
+    pages = (([record[machine_key], record[value_key]] for record in page) for page in get_pages(data))
+    write_rows(['Machine', fact], ['machine', fact], pages)
+
+# -----------------------------------------------------------------------------
+# Function to display the facts for a machine
+# -----------------------------------------------------------------------------
+def print_machine(machine, record):
+
+    # Initialise Variables
+    excluded_keys = ['PartitionKey', 'Timestanp', 'etag', 'RowKey']
+
+    rows = [[key, record[key]] for key in record.keys() if key not in excluded_keys]
+
+    if gbl.OUTPUT != 'table':
+        write_rows(None, ['fact', 'value'], [rows])
+        return
+
+    print("")
+    print("Facts for machine", machine)
+    print("")
+
+    write_rows(['Fact', 'Value'], None, [rows])
+
+# -----------------------------------------------------------------------------
+# Function to display valid facts
+# -----------------------------------------------------------------------------
+def print_valid_facts(data):
+
+    pages = (([record['RowKey'], record['ValidValues']] for record in page) for page in get_pages(data))
+    write_rows(['Valid Facts', 'Has List Of Valid Values'], ['fact', 'valid_values'], pages)
+
+# -----------------------------------------------------------------------------
+# Function to display the valid values for a fact
+# -----------------------------------------------------------------------------
+def print_valid_values(fact, data):
+
+    pages = (([record['VFVValue']] for record in page) for page in get_pages(data))
+
+    if gbl.OUTPUT != 'table':
+        write_rows(None, ['value'], pages)
+        return
+
+    # The table is only displayed if there are valid values
+    rows = [row for page in pages for row in page]
+    if len(rows) > 0:
+        write_rows([f'Valid Values for fact {fact}'], None, [rows])
+    else:
+        print("No valid values for fact", fact)
@@ -0,0 +1,304 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import os
+import sys
+import time
+import sqlite3
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# Local read replica of the machine, valid fact and valid fact value records
+# Records for each table are kept under its cache key (endpoint/table name)
+# -----------------------------------------------------------------------------
+
+REPLICA_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS replica_info (cache_key TEXT PRIMARY KEY, synced_at REAL)",
+    "CREATE TABLE IF NOT EXISTS machines (cache_key TEXT, machine TEXT, PRIMARY KEY (cache_key, machine))",
+    "CREATE TABLE IF NOT EXISTS machine_facts (cache_key TEXT, machine TEXT, fact TEXT, value TEXT, "
+    "PRIMARY KEY (cache_key, machine, fact))",
+    "CREATE INDEX IF NOT EXISTS machine_facts_fact ON machine_facts (cache_key, fact, value)",
+    "CREATE TABLE IF NOT EXISTS valid_facts (cache_key TEXT, fact TEXT, valid_values TEXT, "
+    "PRIMARY KEY (cache_key, fact))",
+    "CREATE TABLE IF NOT EXISTS valid_values (cache_key TEXT, fact TEXT, value TEXT, "
+    "PRIMARY KEY (cache_key, fact, value))",
+]
+
+# Open replica connection, shared by all calls in this process
+replica_conn = None
+
+# -----------------------------------------------------------------------------
+# Function to open the replica database
+# Returns None if there is no replica configured or it can't be opened. If
+# create is False, None is also returned if the table has never been synced
+# -----------------------------------------------------------------------------
+def open_replica(create=False):
+
+    global replica_conn
+
+    if gbl.REPLICA_FILE is None:
+        return None
+
+    if replica_conn is None:
+        if not create and not os.path.exists(gbl.REPLICA_FILE):
+            return None
+        try:
+            os.makedirs(os.path.dirname(gbl.REPLICA_FILE) or '.', exist_ok=True)
+            replica_conn = sqlite3.connect(gbl.REPLICA_FILE)
+            for statement in REPLICA_SCHEMA:
+                replica_conn.execute(statement)
+        except (OSError, sqlite3.Error) as err:
+            if gbl.DEBUG:
+                print("Unable to open replica", gbl.REPLICA_FILE, "-", err)
+            replica_conn = None
+            return None
+
+    if not create and get_replica_sync_time(replica_conn) is None:
+        return None
+
+    return replica_conn
+
+# -----------------------------------------------------------------------------
+# Function to return when the replica was last synced, or None if never
+# -----------------------------------------------------------------------------
+def get_replica_sync_time(conn):
+
+    row = conn.execute("SELECT synced_at FROM replica_info WHERE cache_key = ?", (gbl.CACHE_KEY,)).fetchone()
+    if row is None:
+        return None
+
+    return row[0]
+
+# -----------------------------------------------------------------------------
+# Function to decide if read-only commands should use the replica
+# With --offline the replica must exist. Otherwise it is used if it was
+# synced within max_staleness seconds
+# -----------------------------------------------------------------------------
+def use_replica():
+
+    conn = open_replica()
+
+    if gbl.OFFLINE:
+        if conn is None:
+            print("No local replica - run puppetconfig sync first")
+            sys.exit(2)
+        return True
+
+    if conn is None or gbl.REPLICA_MAX_STALENESS <= 0:
+        return False
+
+    return time.time() - get_replica_sync_time(conn) <= gbl.REPLICA_MAX_STALENESS
+
+# -----------------------------------------------------------------------------
+# Function to replace the replica contents for this table
+# Each argument is an iterable - machines yields (machine, facts), valid_facts
+# yields (fact, ValidValues) and valid_values yields (fact, value)
+# -----------------------------------------------------------------------------
+def write_replica(machines, valid_facts, valid_values):
+
+    conn = open_replica(create=True)
+    if conn is None:
+        print("Unable to open replica", gbl.REPLICA_FILE)
+        sys.exit(2)
+
+    counts = {'machines': 0, 'valid_facts': 0, 'valid_values': 0}
+
+    def machine_rows():
+        for machine, facts in machines:
+            counts['machines'] += 1
+            conn.execute("INSERT INTO machines VALUES (?, ?)", (gbl.CACHE_KEY, machine))
+            for fact in facts:
+                yield (gbl.CACHE_KEY, machine, fact, str(facts[fact]))
+
+    def valid_fact_rows():
+        for fact, flag in valid_facts:
+            counts['valid_facts'] += 1
+            yield (gbl.CACHE_KEY, fact, flag)
+
+    def valid_value_rows():
+        for fact, value in valid_values:
+            counts['valid_values'] += 1
+            yield (gbl.CACHE_KEY, fact, value)
+
+    with conn:
+        for table in ['machines', 'machine_facts', 'valid_facts', 'valid_values']:
+            conn.execute(f"DELETE FROM {table} WHERE cache_key = ?", (gbl.CACHE_KEY,))
+        conn.executemany("INSERT INTO machine_facts VALUES (?, ?, ?, ?)", machine_rows())
+        conn.executemany("INSERT OR REPLACE INTO valid_facts VALUES (?, ?, ?)", valid_fact_rows())
+        conn.executemany("INSERT OR REPLACE INTO valid_values VALUES (?, ?, ?)", valid_value_rows())
+        conn.execute("INSERT OR REPLACE INTO replica_info VALUES (?, ?)", (gbl.CACHE_KEY, time.time()))
+
+    return counts
+
+# -----------------------------------------------------------------------------
+# Function to list machines from the replica
+# The read functions return records shaped like the table entities the
+# list/show commands read, so the same display code handles both
+# -----------------------------------------------------------------------------
+def replica_list_machines():
+
+    conn = open_replica()
+    for (machine,) in conn.execute("SELECT machine FROM machines WHERE cache_key = ? ORDER BY machine",
+                                   (gbl.CACHE_KEY,)):
+        yield {'RowKey': machine}
+
+# -----------------------------------------------------------------------------
+# Function to list machines with a fact, and optionally a value, from the
+# replica
+# -----------------------------------------------------------------------------
+def replica_list_machines_with_fact(fact, value):
+
+    conn = open_replica()
+    if not value:
+        rows = conn.execute("SELECT machine, value FROM machine_facts WHERE cache_key = ? AND fact = ? "
+                            "AND value != '' ORDER BY machine", (gbl.CACHE_KEY, fact))
+    else:
+        rows = conn.execute("SELECT machine, value FROM machine_facts WHERE cache_key = ? AND fact = ? "
+                            "AND value = ? ORDER BY machine", (gbl.CACHE_KEY, fact, value))
+    for machine, fact_value in rows:
+        yield {'RowKey': machine, fact: fact_value}
+
+# -----------------------------------------------------------------------------
+# Function to return a machine record from the replica, or None if the
+# machine does not exist
+# -----------------------------------------------------------------------------
+def replica_get_machine(machine):
+
+    conn = open_replica()
+    row = conn.execute("SELECT machine FROM machines WHERE cache_key = ? AND machine = ?",
+                       (gbl.CACHE_KEY, machine)).fetchone()
+    if row is None:
+        return None
+
+    record = {'PartitionKey': None, 'RowKey': machine}
+    for fact, value in conn.execute("SELECT fact, value FROM machine_facts WHERE cache_key = ? AND machine = ? "
+                                    "ORDER BY fact", (gbl.CACHE_KEY, machine)):
+        record[fact] = value
+
+    return record
+
+# -----------------------------------------------------------------------------
+# Function to list valid facts from the replica
+# -----------------------------------------------------------------------------
+def replica_list_valid_facts():
+
+    conn = open_replica()
+    for fact, flag in conn.execute("SELECT fact, valid_values FROM valid_facts WHERE cache_key = ? ORDER BY fact",
+                                   (gbl.CACHE_KEY,)):
+        yield {'RowKey': fact, 'ValidValues': flag}
+
+# -----------------------------------------------------------------------------
+# Function to list the valid values for a fact from the replica
+# -----------------------------------------------------------------------------
+def replica_list_valid_values(fact):
+
+    conn = open_replica()
+    for (value,) in conn.execute("SELECT value FROM valid_values WHERE cache_key = ? AND fact = ? ORDER BY value",
+                                 (gbl.CACHE_KEY, fact)):
+        yield {'VFVValue': value}
+
+# -----------------------------------------------------------------------------
+# Function to set the facts for a machine in the replica
+# The write-through functions are called by the write commands after the
+# table has been updated, and do nothing if there is no replica
+# -----------------------------------------------------------------------------
+def replica_set_machine(machine, facts):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO machines VALUES (?, ?)", (gbl.CACHE_KEY, machine))
+        conn.execute("DELETE FROM machine_facts WHERE cache_key = ? AND machine = ?", (gbl.CACHE_KEY, machine))
+        conn.executemany("INSERT INTO machine_facts VALUES (?, ?, ?, ?)",
+                         [(gbl.CACHE_KEY, machine, fact, str(facts[fact])) for fact in facts])
+
+# -----------------------------------------------------------------------------
+# Function to set one fact for a machine in the replica
+# -----------------------------------------------------------------------------
+def replica_set_fact(machine, fact, value):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO machine_facts VALUES (?, ?, ?, ?)",
+                     (gbl.CACHE_KEY, machine, fact, str(value)))
+
+# -----------------------------------------------------------------------------
+# Function to delete one fact for a machine from the replica
+# -----------------------------------------------------------------------------
+def replica_delete_fact(machine, fact):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("DELETE FROM machine_facts WHERE cache_key = ? AND machine = ? AND fact = ?",
+                     (gbl.CACHE_KEY, machine, fact))
+
+# -----------------------------------------------------------------------------
+# Function to delete a machine from the replica
+# -----------------------------------------------------------------------------
+def replica_delete_machine(machine):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("DELETE FROM machines WHERE cache_key = ? AND machine = ?", (gbl.CACHE_KEY, machine))
+        conn.execute("DELETE FROM machine_facts WHERE cache_key = ? AND machine = ?", (gbl.CACHE_KEY, machine))
+
+# -----------------------------------------------------------------------------
+# Function to add or update a valid fact in the replica
+# -----------------------------------------------------------------------------
+def replica_set_valid_fact(fact, flag):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO valid_facts VALUES (?, ?, ?)", (gbl.CACHE_KEY, fact, flag))
+
+# -----------------------------------------------------------------------------
+# Function to delete a valid fact, and its valid values, from the replica
+# -----------------------------------------------------------------------------
+def replica_delete_valid_fact(fact):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("DELETE FROM valid_facts WHERE cache_key = ? AND fact = ?", (gbl.CACHE_KEY, fact))
+        conn.execute("DELETE FROM valid_values WHERE cache_key = ? AND fact = ?", (gbl.CACHE_KEY, fact))
+
+# -----------------------------------------------------------------------------
+# Function to add a valid fact value to the replica
+# -----------------------------------------------------------------------------
+def replica_add_valid_value(fact, value):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO valid_values VALUES (?, ?, ?)", (gbl.CACHE_KEY, fact, value))
+
+# -----------------------------------------------------------------------------
+# Function to delete a valid fact value from the replica
+# -----------------------------------------------------------------------------
+def replica_delete_valid_value(fact, value):
+
+    conn = open_replica()
+    if conn is None:
+        return
+
+    with conn:
+        conn.execute("DELETE FROM valid_values WHERE cache_key = ? AND fact = ? AND value = ?",
+                     (gbl.CACHE_KEY, fact, value))
@@ -0,0 +1,151 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import json
+from puppetconfig_constants import DEFAULT_FORMAT
+from puppetconfig_stats import phase
+
+# -----------------------------------------------------------------------------
+# Function to import PyYAML
+# yaml is only imported when a yaml file is read or written, so commands that
+# don't (e.g. --help) don't load it
+# -----------------------------------------------------------------------------
+def import_yaml():
+
+    try:
+        import yaml
+    except ModuleNotFoundError:
+        print("Module PyYAML not instaled [pip3 install PyYAML]")
+        sys.exit(2)
+
+    return yaml
+
+# -----------------------------------------------------------------------------
+# Functions to return the yaml loader and dumper
+# The C loader and dumper (PyYAML built against libyaml) are several times
+# faster than the pure python ones, and give the same results
+# -----------------------------------------------------------------------------
+def get_yaml_loader():
+
+    yaml = import_yaml()
+
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def get_yaml_dumper():
+
+    yaml = import_yaml()
+
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# -----------------------------------------------------------------------------
+# Function to load yaml from a file or string
+# -----------------------------------------------------------------------------
+def load_yaml(stream):
+
+    return import_yaml().load(stream, Loader=get_yaml_loader())
+
+# -----------------------------------------------------------------------------
+# Function to dump data as block style yaml
+# -----------------------------------------------------------------------------
+def dump_yaml(data):
+
+    return import_yaml().dump(data, Dumper=get_yaml_dumper(), default_flow_style=False, allow_unicode=True)
+
+# -----------------------------------------------------------------------------
+# Serializers for the facts files written by generate
+# Files are written a node at a time, in node order: node() returns the text
+# for one node (with the start of the file for the first node) and end()
+# returns the text that finishes the file. load() reads a whole file
+# -----------------------------------------------------------------------------
+class YamlSerializer:
+
+    name = 'yaml'
+    extension = '.yaml'
+
+    # The dumper and loader default to the fastest available, chosen when
+    # they are first used
+    def __init__(self, dumper=None, loader=None):
+
+        self.dumper = dumper
+        self.loader = loader
+
+    def node(self, nodename, record, first):
+
+        if self.dumper is None:
+            self.dumper = get_yaml_dumper()
+
+        # Each node's block is dumped on its own, which gives the same output
+        # as dumping the whole server::facts structure at once as long as the
+        # nodes are written in sorted order. The server::facts line is dropped
+        with phase('yaml dump'):
+            block = import_yaml().dump({'server::facts': {nodename: record}}, Dumper=self.dumper,
+                                       default_flow_style=False, allow_unicode=True)
+
+        block = block[block.index('\n') + 1:]
+        if first:
+            return "server::facts:\n" + block
+
+        return block
+
+    def end(self, node_count):
+
+        if node_count == 0:
+            return "server::facts: {}\n"
+
+        return ""
+
+    def load(self, stream):
+
+        if self.loader is None:
+            self.loader = get_yaml_loader()
+
+        return import_yaml().load(stream, Loader=self.loader)
+
+class JsonSerializer:
+
+    name = 'json'
+    extension = '.json'
+
+    def node(self, nodename, record, first):
+
+        # One node per line. Facts are sorted, as they are in the yaml
+        with phase('json dump'):
+            block = json.dumps(nodename) + ": " + json.dumps(record, sort_keys=True, ensure_ascii=False, default=str)
+
+        if first:
+            return '{"server::facts": {\n' + block
+
+        return ",\n" + block
+
+    def end(self, node_count):
+
+        if node_count == 0:
+            return '{"server::facts": {}}\n'
+
+        return "\n}}\n"
+
+    def load(self, stream):
+
+        return json.load(stream)
+
+SERIALIZERS = {
+    'yaml': YamlSerializer(),
+    'json': JsonSerializer(),
+}
+
+# Extensions of shard files written in any format
+SHARD_EXTENSIONS = tuple(serializer.extension for serializer in SERIALIZERS.values())
+
+# -----------------------------------------------------------------------------
+# Function to return the serializer for the generate format setting
+# -----------------------------------------------------------------------------
+def get_serializer(cfg):
+
+    facts_format = cfg['generate'].get('format', DEFAULT_FORMAT)
+
+    if facts_format not in SERIALIZERS:
+        print("Invalid generate format", facts_format, "- must be", " or ".join(SERIALIZERS))
+        sys.exit(2)
+
+    return SERIALIZERS[facts_format]
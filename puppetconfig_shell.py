@@ -0,0 +1,273 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import cmd
+import time
+import shlex
+import argparse
+from puppetconfig_constants import SHELL_PROMPT, SHELL_MACHINE_COMMANDS, SHELL_FACT_COMMANDS, SHELL_SELECTOR_OPTIONS
+from puppetconfig_replica import use_replica, replica_list_machines, replica_list_valid_facts, replica_list_valid_values
+import puppetconfig_globals as gbl
+
+# readline is optional - without it the shell works but has no completion
+try:
+    import readline
+except ImportError:
+    readline = None
+
+# -----------------------------------------------------------------------------
+# Function to check if an exception is an Azure SDK error (e.g. a failed
+# request or a connection error). The SDK is only loaded when the table is
+# used, so if it isn't loaded the exception can't be one of its errors
+# -----------------------------------------------------------------------------
+def is_azure_error(err):
+
+    azure_exceptions = sys.modules.get('azure.core.exceptions')
+
+    return azure_exceptions is not None and isinstance(err, azure_exceptions.AzureError)
+
+# -----------------------------------------------------------------------------
+# Interactive shell
+# Each line is parsed with the same parser as the command line and run with
+# the table client created at startup, so its connection pool and the
+# catalogue in memory are reused by every command
+# -----------------------------------------------------------------------------
+class PuppetConfigShell(cmd.Cmd):
+
+    identchars = cmd.Cmd.identchars + '-'
+    prompt = SHELL_PROMPT
+    intro = "puppetconfig shell - help for commands, refresh to reload names, exit to leave"
+
+    def __init__(self, table_client, parser, run_command):
+
+        super().__init__()
+        self.table_client = table_client
+        self.parser = parser
+        self.run_command = run_command
+        self.machines = None
+        self.replica_catalogue = None
+
+        self.subparsers = {}
+        for action in parser._actions:
+            if isinstance(action, argparse._SubParsersAction):
+                self.subparsers = dict(action.choices)
+        del self.subparsers['shell']
+
+    # -------------------------------------------------------------------------
+    # Load the machine and fact names used for completion
+    # -------------------------------------------------------------------------
+    def load_names(self):
+
+        if use_replica():
+            self.machines = set(record['RowKey'] for record in replica_list_machines())
+            self.replica_catalogue = {}
+            for record in replica_list_valid_facts():
+                fact = record['RowKey']
+                self.replica_catalogue[fact] = set(value['VFVValue'] for value in replica_list_valid_values(fact))
+        else:
+            from puppetconfig_functions import load_machines_and_catalogue
+            self.machines, catalogue = load_machines_and_catalogue(self.table_client)
+
+    # -------------------------------------------------------------------------
+    # Return the catalogue used for completion
+    # -------------------------------------------------------------------------
+    def get_catalogue(self):
+
+        if self.replica_catalogue is not None:
+            return self.replica_catalogue
+
+        from puppetconfig_functions import get_catalogue
+        return get_catalogue(self.table_client)
+
+    # -------------------------------------------------------------------------
+    # Run a puppetconfig command
+    # -------------------------------------------------------------------------
+    def default(self, line):
+
+        try:
+            words = shlex.split(line)
+        except ValueError as err:
+            print(err)
+            return
+
+        if words[0] not in self.subparsers:
+            print("Unknown command", words[0], "- help for a list of commands")
+            return
+
+        # argparse exits on errors and -h
+        try:
+            args = self.parser.parse_args(words)
+        except SystemExit:
+            return
+
+        start = time.time()
+        try:
+            self.run_command(self.table_client, args, self.parser)
+            status = 0
+        except SystemExit as err:
+            status = err.code
+        except KeyboardInterrupt:
+            print("Interrupted")
+            status = 1
+        except Exception as err:
+            # Errors the command didn't handle, such as a lost connection,
+            # end the command but not the shell
+            if not is_azure_error(err):
+                raise
+            print("Error running", words[0])
+            print(err)
+            status = 2
+
+        # Keep the machine names used for completion up to date
+        if status in [0, None] and self.machines is not None:
+            if args.command_type == 'add-machine':
+                self.machines.add(args.machine)
+            elif args.command_type == 'delete-machine':
+                self.machines.discard(args.machine)
+
+        if gbl.VERBOSE:
+            print(f"({time.time() - start:.3f}s)")
+
+    def emptyline(self):
+
+        # Don't repeat the last command
+        pass
+
+    def do_refresh(self, arg):
+        """Reload the catalogue and machine names from the table"""
+
+        gbl.CATALOGUE = None
+        try:
+            self.load_names()
+        except Exception as err:
+            if not is_azure_error(err):
+                raise
+            print("Error loading names from the table")
+            print(err)
+            return
+        print("Loaded", len(self.machines), "machines and", len(self.get_catalogue()), "valid facts")
+
+    def do_help(self, arg):
+        """Show help for all commands, or help <command>"""
+
+        if arg:
+            self.default(f"{arg} -h")
+            return
+
+        self.parser.print_help()
+        print("")
+        print("Shell commands: refresh, exit")
+
+    def do_exit(self, arg):
+        """Leave the shell"""
+
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, arg):
+
+        print("")
+        return True
+
+    # -------------------------------------------------------------------------
+    # Completion
+    # -------------------------------------------------------------------------
+    def completenames(self, text, *ignored):
+
+        names = list(self.subparsers) + ['help', 'refresh', 'exit']
+
+        return sorted(name for name in names if name.startswith(text))
+
+    def completedefault(self, text, line, begidx, endidx):
+
+        try:
+            words = shlex.split(line[:begidx])
+        except ValueError:
+            return []
+
+        subparser = self.subparsers.get(words[0])
+        if subparser is None:
+            return []
+
+        # Options for this command
+        if text.startswith('-'):
+            options = [option for action in subparser._actions for option in action.option_strings]
+            return sorted(option for option in options if option.startswith(text))
+
+        if self.machines is None:
+            self.load_names()
+
+        catalogue = self.get_catalogue()
+
+        # Options that take a value (e.g. --where x=y), whose value is not a
+        # positional argument unless given as --option=value
+        value_options = set(option for action in subparser._actions if action.nargs != 0
+                            for option in action.option_strings)
+
+        positionals = []
+        selected = False
+        skip = False
+        for word in words[1:]:
+            if skip:
+                skip = False
+            elif word.startswith('-'):
+                skip = word in value_options
+                selected = selected or word.split('=', 1)[0] in SHELL_SELECTOR_OPTIONS
+            else:
+                positionals.append(word)
+
+        # Work out which of machine, fact or value is being completed
+        if words[0] in SHELL_MACHINE_COMMANDS and not selected:
+            slots = ['machine', 'fact', 'value']
+        elif words[0] in SHELL_MACHINE_COMMANDS:
+            slots = ['fact', 'value']
+        elif words[0] in SHELL_FACT_COMMANDS:
+            slots = ['fact', 'value']
+        else:
+            return []
+
+        if len(positionals) >= len(slots):
+            return []
+
+        slot = slots[len(positionals)]
+        if slot == 'machine':
+            candidates = self.machines
+        elif slot == 'fact':
+            candidates = catalogue.keys()
+        else:
+            candidates = catalogue.get(positionals[slots.index('fact')]) or []
+
+        return sorted(candidate for candidate in candidates if candidate.startswith(text))
+
+# -----------------------------------------------------------------------------
+# Function to run the interactive shell
+# -----------------------------------------------------------------------------
+def do_shell(table_client, parser, run_command):
+
+    shell = PuppetConfigShell(table_client, parser, run_command)
+
+    # Command, machine and fact names contain - which readline treats as a
+    # word separator by default
+    if readline is not None:
+        readline.set_completer_delims(readline.get_completer_delims().replace('-', ''))
+
+    # Warm up the connection and load the names used for completion. If the
+    # table can't be reached the shell exits, as the other commands do
+    try:
+        shell.load_names()
+    except Exception as err:
+        if not is_azure_error(err):
+            raise
+        print("Error loading names from the table")
+        print(err)
+        sys.exit(2)
+
+    while True:
+        try:
+            shell.cmdloop()
+            break
+        except KeyboardInterrupt:
+            print("")
+            shell.intro = None
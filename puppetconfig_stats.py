@@ -0,0 +1,386 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import json
+import time
+import threading
+import contextlib
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# Instrumentation for --stats and --trace
+# The table client is wrapped so that every request records its operation,
+# filter, latency, pages, entities and (approximate) bytes returned. Local
+# phases such as building and writing the yaml are timed with phase().
+# Nothing is recorded unless start_stats() has been called
+# -----------------------------------------------------------------------------
+
+# Used for phases when instrumentation is off
+NO_PHASE = contextlib.nullcontext()
+
+# -----------------------------------------------------------------------------
+# Function to start recording requests and phases
+# trace_file is a file to write one JSON line per request to, or None
+# -----------------------------------------------------------------------------
+def start_stats(trace_file):
+
+    gbl.STATS = {'lock': threading.Lock(), 'operations': {}, 'phases': {}}
+
+    if trace_file is not None:
+        try:
+            gbl.TRACE = open(trace_file, 'w')
+        except OSError as err:
+            print("Unable to open trace file", trace_file, "-", err)
+            sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Function to return the approximate size of an entity in a response
+# -----------------------------------------------------------------------------
+def get_entity_size(entity):
+
+    return len(json.dumps(entity, default=str))
+
+# -----------------------------------------------------------------------------
+# Function to record a request
+# -----------------------------------------------------------------------------
+def record_request(operation, detail, start, seconds, pages, entities, size, error):
+
+    with gbl.STATS['lock']:
+        totals = gbl.STATS['operations'].setdefault(operation, {'requests': 0, 'errors': 0, 'pages': 0, 'entities': 0,
+                                                                'bytes': 0, 'seconds': 0.0, 'max': 0.0})
+        totals['requests'] += 1
+        totals['pages'] += pages
+        totals['entities'] += entities
+        totals['bytes'] += size
+        totals['seconds'] += seconds
+        totals['max'] = max(totals['max'], seconds)
+        if error is not None:
+            totals['errors'] += 1
+
+        if gbl.TRACE is not None:
+            trace = {'time': round(start, 6), 'operation': operation, 'seconds': round(seconds, 6), 'pages': pages,
+                     'entities': entities, 'bytes': size, 'error': error}
+            trace.update(detail)
+            gbl.TRACE.write(json.dumps(trace, default=str))
+            gbl.TRACE.write('\n')
+
+# -----------------------------------------------------------------------------
+# Function to return the error recorded for a failed request
+# -----------------------------------------------------------------------------
+def get_error(err):
+
+    status_code = getattr(err, 'status_code', None)
+    if status_code is not None:
+        return f"{status_code} {type(err).__name__}"
+
+    return type(err).__name__
+
+# -----------------------------------------------------------------------------
+# Function to time a local phase, for use in a with statement
+# -----------------------------------------------------------------------------
+def phase(name):
+
+    if gbl.STATS is None:
+        return NO_PHASE
+
+    return timed_phase(name)
+
+@contextlib.contextmanager
+def timed_phase(name):
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with gbl.STATS['lock']:
+            totals = gbl.STATS['phases'].setdefault(name, {'count': 0, 'seconds': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+
+# -----------------------------------------------------------------------------
+# Query results, recording a request for each page as it is read
+# -----------------------------------------------------------------------------
+class InstrumentedPager:
+
+    def __init__(self, pager, operation, detail):
+
+        self.pager = pager
+        self.operation = operation
+        self.detail = detail
+
+    def __getattr__(self, name):
+
+        return getattr(self.pager, name)
+
+    def __iter__(self):
+
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token=None):
+
+        return InstrumentedPageIterator(self.pager.by_page(continuation_token=continuation_token), self.operation,
+                                        self.detail)
+
+class InstrumentedPageIterator:
+
+    def __init__(self, pages, operation, detail):
+
+        self.pages = pages
+        self.operation = operation
+        self.detail = detail
+
+    @property
+    def continuation_token(self):
+
+        return self.pages.continuation_token
+
+    def __iter__(self):
+
+        return self
+
+    def __next__(self):
+
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            page = list(next(self.pages))
+        except StopIteration:
+            raise
+        except Exception as err:
+            record_request(self.operation, self.detail, start, time.perf_counter() - begin, 0, 0, 0, get_error(err))
+            raise
+
+        size = sum(get_entity_size(entity) for entity in page)
+        record_request(self.operation, self.detail, start, time.perf_counter() - begin, 1, len(page), size, None)
+
+        return iter(page)
+
+# -----------------------------------------------------------------------------
+# Table client that records every request it makes
+# -----------------------------------------------------------------------------
+class InstrumentedTableClient:
+
+    def __init__(self, table_client):
+
+        self.table_client = table_client
+
+    def __getattr__(self, name):
+
+        return getattr(self.table_client, name)
+
+    def call(self, operation, detail, function, *args, **kwargs):
+
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as err:
+            record_request(operation, detail, start, time.perf_counter() - begin, 0, 0, 0, get_error(err))
+            raise
+
+        entities = 1 if operation == 'get' else 0
+        size = get_entity_size(result) if operation == 'get' else 0
+        record_request(operation, detail, start, time.perf_counter() - begin, 0, entities, size, None)
+
+        return result
+
+    def query_entities(self, query_filter, **kwargs):
+
+        detail = {'filter': query_filter, 'select': kwargs.get('select')}
+
+        return InstrumentedPager(self.table_client.query_entities(query_filter, **kwargs), 'query', detail)
+
+    def list_entities(self, **kwargs):
+
+        return InstrumentedPager(self.table_client.list_entities(**kwargs), 'list', {'select': kwargs.get('select')})
+
+    def get_entity(self, partition_key, row_key, **kwargs):
+
+        detail = {'partition_key': partition_key, 'row_key': row_key, 'select': kwargs.get('select')}
+
+        return self.call('get', detail, self.table_client.get_entity, partition_key, row_key, **kwargs)
+
+    def create_entity(self, entity, **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return self.call('create', detail, self.table_client.create_entity, entity, **kwargs)
+
+    def update_entity(self, entity, mode='merge', **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return self.call('update', detail, self.table_client.update_entity, entity, mode, **kwargs)
+
+    def upsert_entity(self, entity, mode='merge', **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return self.call('upsert', detail, self.table_client.upsert_entity, entity, mode, **kwargs)
+
+    def delete_entity(self, partition_key, row_key, **kwargs):
+
+        detail = {'partition_key': partition_key, 'row_key': row_key}
+
+        return self.call('delete', detail, self.table_client.delete_entity, partition_key, row_key, **kwargs)
+
+    def submit_transaction(self, operations, **kwargs):
+
+        operations = list(operations)
+        detail = {'partition_key': operations[0][1]['PartitionKey'] if operations else None, 'operations': len(operations)}
+
+        return self.call('transaction', detail, self.table_client.submit_transaction, operations, **kwargs)
+
+# -----------------------------------------------------------------------------
+# Async table client that records every request it makes
+# -----------------------------------------------------------------------------
+class InstrumentedAsyncTableClient:
+
+    def __init__(self, client):
+
+        self.client = client
+
+    async def __aenter__(self):
+
+        await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+
+        return await self.client.__aexit__(*args)
+
+    async def call(self, operation, detail, function, *args, **kwargs):
+
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as err:
+            record_request(operation, detail, start, time.perf_counter() - begin, 0, 0, 0, get_error(err))
+            raise
+
+        entities = 1 if operation == 'get' else 0
+        size = get_entity_size(result) if operation == 'get' else 0
+        record_request(operation, detail, start, time.perf_counter() - begin, 0, entities, size, None)
+
+        return result
+
+    def query_entities(self, query_filter, **kwargs):
+
+        detail = {'filter': query_filter, 'select': kwargs.get('select')}
+
+        # Async results are timed as a whole, as one request per query
+        async def entities():
+            start = time.time()
+            begin = time.perf_counter()
+            count = 0
+            size = 0
+            error = None
+            try:
+                async for entity in self.client.query_entities(query_filter, **kwargs):
+                    count += 1
+                    size += get_entity_size(entity)
+                    yield entity
+            except Exception as err:
+                error = get_error(err)
+                raise
+            finally:
+                record_request('query', detail, start, time.perf_counter() - begin, 1, count, size, error)
+
+        return entities()
+
+    async def get_entity(self, partition_key, row_key, **kwargs):
+
+        detail = {'partition_key': partition_key, 'row_key': row_key, 'select': kwargs.get('select')}
+
+        return await self.call('get', detail, self.client.get_entity, partition_key, row_key, **kwargs)
+
+    async def create_entity(self, entity, **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return await self.call('create', detail, self.client.create_entity, entity=entity, **kwargs)
+
+    async def update_entity(self, entity, **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return await self.call('update', detail, self.client.update_entity, entity=entity, **kwargs)
+
+    async def upsert_entity(self, entity, **kwargs):
+
+        detail = {'partition_key': entity['PartitionKey'], 'row_key': entity['RowKey']}
+
+        return await self.call('upsert', detail, self.client.upsert_entity, entity=entity, **kwargs)
+
+    async def delete_entity(self, partition_key, row_key, **kwargs):
+
+        detail = {'partition_key': partition_key, 'row_key': row_key}
+
+        return await self.call('delete', detail, self.client.delete_entity, partition_key=partition_key,
+                               row_key=row_key, **kwargs)
+
+    async def submit_transaction(self, operations, **kwargs):
+
+        operations = list(operations)
+        detail = {'partition_key': operations[0][1]['PartitionKey'] if operations else None, 'operations': len(operations)}
+
+        return await self.call('transaction', detail, self.client.submit_transaction, operations, **kwargs)
+
+# -----------------------------------------------------------------------------
+# Function to finish recording - prints the summary if print_summary is set,
+# and closes the trace file
+# -----------------------------------------------------------------------------
+def finish_stats(print_summary):
+
+    if gbl.STATS is None:
+        return
+
+    if gbl.TRACE is not None:
+        for name, totals in gbl.STATS['phases'].items():
+            gbl.TRACE.write(json.dumps({'phase': name, 'count': totals['count'], 'seconds': round(totals['seconds'], 6)}))
+            gbl.TRACE.write('\n')
+        gbl.TRACE.close()
+        gbl.TRACE = None
+
+    if print_summary:
+        print_stats()
+
+# -----------------------------------------------------------------------------
+# Function to print a summary of the requests and phases recorded
+# The summary goes to stderr, so it doesn't mix with the command's output
+# prettytable is only loaded here, as every command imports this module
+# -----------------------------------------------------------------------------
+def print_stats():
+
+    try:
+        from prettytable import PrettyTable
+    except ModuleNotFoundError:
+        print("Module prettytable not instaled [pip3 install prettytable]")
+        sys.exit(2)
+
+    table = PrettyTable()
+    table.field_names = ['Operation', 'Requests', 'Errors', 'Pages', 'Entities', 'KB (approx)', 'Total s', 'Mean ms',
+                         'Max ms']
+    table.align = 'l'
+
+    for operation, totals in sorted(gbl.STATS['operations'].items()):
+        table.add_row([operation, totals['requests'], totals['errors'], totals['pages'], totals['entities'],
+                       round(totals['bytes'] / 1024, 1), f"{totals['seconds']:.3f}",
+                       f"{totals['seconds'] * 1000 / totals['requests']:.1f}", f"{totals['max'] * 1000:.1f}"])
+
+    print("", file=sys.stderr)
+    print(table, file=sys.stderr)
+
+    if len(gbl.STATS['phases']) > 0:
+        table = PrettyTable()
+        table.field_names = ['Phase', 'Count', 'Total s']
+        table.align = 'l'
+
+        for name, totals in gbl.STATS['phases'].items():
+            table.add_row([name, totals['count'], f"{totals['seconds']:.3f}"])
+
+        print(table, file=sys.stderr)
@@ -3,19 +3,21 @@
 # -----------------------------------------------------------------------------
 
 import sys
-from puppetconfig_functions import get_config, check_machine_exists, check_fact_exists, check_fact_has_valid_values, check_value
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+from puppetconfig_constants import PUPPETCFG_PK, KEY_ONLY, DEFAULT_OUTPUT, DEFAULT_SHARD_DIR
+from puppetconfig_config import get_config
+from puppetconfig_functions import load_machines_and_catalogue, query_concurrently, get_catalogue_queries, build_catalogue
+from puppetconfig_generate import get_sources, get_source_client
+from puppetconfig_diff import load_current_nodes
+from puppetconfig_serializer import get_serializer
+from puppetconfig_stats import phase
 import puppetconfig_globals as gbl
 
 # -----------------------------------------------------------------------------
 # External Modules
 # -----------------------------------------------------------------------------
 
-try:
-    import yaml
-except ModuleNotFoundError:
-    print("Module PyYAML not instaled [pip3 install PyYAML]")
-    sys.exit(2)
-
 try:
     from azure.core.exceptions import HttpResponseError
 except:
@@ -29,58 +31,119 @@ except ModuleNotFoundError:
     sys.exit(2)
 
 # -----------------------------------------------------------------------------
-# Function to validate contents of facts.yaml
+# Function to load the machines in one source, with the source's node prefix
+# added, and the valid fact catalogue if with_catalogue is set
+# The catalogue is read from the table rather than the local cache, which
+# holds the catalogue of the azure table
+# Returns the set of machines, and the catalogue or None
+# -----------------------------------------------------------------------------
+def load_source_machines(source, with_catalogue):
+
+    table_client = get_source_client(source)
+
+    queries = [(f"PartitionKey eq '{PUPPETCFG_PK}'", KEY_ONLY, f"machines in source {source['name']}")]
+    if with_catalogue:
+        queries += get_catalogue_queries()
+
+    results = query_concurrently(table_client, queries)
+
+    prefix = source.get('node_prefix') or ''
+    machines = set(prefix + record['RowKey'] for record in results[0])
+
+    catalogue = None
+    if with_catalogue:
+        catalogue, high_water, key_count = build_catalogue(results[1], results[2])
+
+    return machines, catalogue
+
+# -----------------------------------------------------------------------------
+# Function to load the machines in all the sources, reading each source in
+# its own thread, and the catalogue of the highest priority source
+# -----------------------------------------------------------------------------
+def load_sources_machines_and_catalogue(sources):
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [executor.submit(load_source_machines, source, rank == 0) for rank, source in enumerate(sources)]
+        results = [future.result() for future in futures]
+
+    machines = set()
+    for source_machines, source_catalogue in results:
+        machines |= source_machines
+
+    return machines, results[0][1]
+
+# -----------------------------------------------------------------------------
+# Function to validate contents of facts.yaml, or of the shard files when
+# generate writes a file per node or group
 # -----------------------------------------------------------------------------
 def do_validate(table_client, config_file):
 
    # Load settings from configuration file
-    cfg = get_config(config_file)
+    with phase('config'):
+        cfg = get_config(config_file)
 
     # Initialize Variables
     puppet_facts_dir = cfg['generate']['facts_dir']
     yaml_file_name = cfg['generate']['yaml_file']
     yaml_file = f'{puppet_facts_dir}/{yaml_file_name}'
+    output = cfg['generate'].get('output', DEFAULT_OUTPUT)
+    shard_dir_name = cfg['generate'].get('shard_dir', DEFAULT_SHARD_DIR)
+    shard_dir = f'{puppet_facts_dir}/{shard_dir_name}'
+
+    if output not in ['single', 'node', 'group']:
+        print("Invalid generate output", output, "- must be single, node or group")
+        sys.exit(2)
+
+    serializer = get_serializer(cfg)
+    file_name = yaml_file if output == 'single' else shard_dir
 
-    # Load contents of yaml file
+    if not path.exists(file_name):
+        print("Facts file", file_name, "does not exist - run generate first")
+        sys.exit(2)
 
-    with open(yaml_file, "r") as ymlfile:
-        yaml_data = yaml.safe_load(ymlfile)
+    # Load contents of facts file, or of the shard files
+    nodes = load_current_nodes(yaml_file, output, shard_dir, serializer)
 
-    # Iterate through the yaml data
+    # Load machines and valid fact catalogue from the table in one pass, or
+    # from each of the sources generate merges
+    sources = get_sources(cfg)
+    if sources is None:
+        machines, catalogue = load_machines_and_catalogue(table_client)
+    else:
+        machines, catalogue = load_sources_machines_and_catalogue(sources)
 
     validated = True
     error_list = []
 
     print("Starting validation")
 
-    for section in yaml_data:
+    # Check machines
+    for node in sorted(nodes):
+        if gbl.VERBOSE:
+            print(f"- Checking node {node}")
 
-        # Check machines
-        for node in yaml_data[section]:
-            if gbl.VERBOSE:
-                print(f"- Checking node {node}")
+        # Check that node exists in the table
+        if node not in machines:
+            error_list.append(f"Machine {node} does not exist in table")
+            validated = False
+            continue
 
-            # Check that node exists in the table
-            if check_machine_exists(table_client, node) == False:
-                error_list.append(f"Machine {node} does not exist in table")
+        # Check facts for this machine
+        for fact in nodes[node]:
+            value = nodes[node][fact]
+            if gbl.VERBOSE:
+                print(f"-- checking fact {fact}")
+            if fact not in catalogue:
+                error_list.append(f"Fact {fact} is invalid for machine {node}")
                 validated = False
-                continue
-
-            # Check facts for this machine
-            for fact in yaml_data[section][node]:
-                value = yaml_data[section][node][fact]
-                if gbl.VERBOSE:
-                    print(f"-- checking fact {fact}")
-                if check_fact_exists(table_client, fact) == False:
-                    error_list.append(f"Fact {fact} is invalid for machine {node}")
-                    validated = False
-                else:
-                    # Does this fact have valid values?
-                    if check_fact_has_valid_values(table_client, fact) == True:
-                        # If so, check that the value is valid
-                        if check_value(table_client, fact, value) == False:
-                            error_list.append(f"Value {value} for fact {fact} on machine {node} is invalid")
-                            validated = False
+            else:
+                # Does this fact have valid values?
+                valid_values = catalogue[fact]
+                if valid_values is not None:
+                    # If so, check that the value is valid
+                    if str(value) not in valid_values:
+                        error_list.append(f"Value {value} for fact {fact} on machine {node} is invalid")
+                        validated = False
 
     if validated == True:
         print("Validation successful")
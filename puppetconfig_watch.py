@@ -0,0 +1,218 @@
+# -----------------------------------------------------------------------------
+# Import Modules
+# -----------------------------------------------------------------------------
+import sys
+import signal
+import datetime
+import threading
+from puppetconfig_constants import PUPPETCFG_PK, KEY_ONLY, STATE_FILE_SUFFIX, WATCH_MAX_BACKOFF
+from puppetconfig_config import get_config, check_config
+from puppetconfig_serializer import import_yaml
+from puppetconfig_generate import do_generate, load_state, get_sources, get_source_client, get_source_state_file
+from puppetconfig_cache import format_timestamp
+import puppetconfig_globals as gbl
+
+# -----------------------------------------------------------------------------
+# External Modules
+# -----------------------------------------------------------------------------
+
+try:
+    from azure.core.exceptions import AzureError
+except:
+    print("Module azure.core not instaled [pip3 install azure.core]")
+    sys.exit(2)
+
+# -----------------------------------------------------------------------------
+# Function to check if any machine has changed since the last generate
+# Unlike the generate read this has no overlap - the entity that set the
+# high water mark would always be in it. The high water mark has microsecond
+# precision and table Timestamps are finer, so the probe starts a microsecond
+# after it. Writes that become visible late are picked up by the reconcile
+# run at the maximum poll interval
+# Returns True if there are changes or there is no state, False if there are
+# none, and None if the table can't be read
+# -----------------------------------------------------------------------------
+def check_for_changes(table_client, state_file):
+
+    state = load_state(state_file)
+    if state is None:
+        return True
+
+    since = format_timestamp(state['high_water'] + datetime.timedelta(microseconds=1))
+    query = f"PartitionKey eq '{PUPPETCFG_PK}' and Timestamp ge datetime'{since}'"
+
+    try:
+        data = table_client.query_entities(query, select=KEY_ONLY, results_per_page=1)
+        for record in data:
+            return True
+    except AzureError as err:
+        print("Error checking for changes")
+        print(err)
+        return None
+
+    return False
+
+# -----------------------------------------------------------------------------
+# Function to check if any source has changed since the last generate
+# source_clients keeps the client for each source between polls
+# Returns True, False or None as check_for_changes does
+# -----------------------------------------------------------------------------
+def check_sources_for_changes(sources, yaml_file, source_clients):
+
+    changes = False
+
+    for source in sources:
+        if source['name'] not in source_clients:
+            source_clients[source['name']] = get_source_client(source)
+        source_changes = check_for_changes(source_clients[source['name']], get_source_state_file(yaml_file, source))
+        if source_changes:
+            return True
+        if source_changes is None:
+            changes = None
+
+    return changes
+
+# -----------------------------------------------------------------------------
+# Function to check if an exception is an error in the configuration file -
+# invalid yaml, or a missing setting
+# -----------------------------------------------------------------------------
+def is_config_error(err):
+
+    return isinstance(err, (KeyError, import_yaml().YAMLError))
+
+# -----------------------------------------------------------------------------
+# Function to re-read the configuration file for a poll
+# The file may be part way through being edited, so an error is reported
+# rather than ending the daemon
+# Returns (yaml_file, state_file, sources), or None if the file can't be read
+# or is invalid
+# -----------------------------------------------------------------------------
+def load_watch_config(config_file):
+
+    try:
+        cfg = get_config(config_file)
+    except SystemExit:
+        return None
+    except OSError as err:
+        print("Error reading config file -", err)
+        return None
+    except Exception as err:
+        if not is_config_error(err):
+            raise
+        print("Error reading config file -", err)
+        return None
+
+    # The sources are checked here too, so get_sources won't exit
+    errors = check_config(cfg)
+    if len(errors) > 0:
+        for error in errors:
+            print(error)
+        return None
+
+    yaml_file = f"{cfg['generate']['facts_dir']}/{cfg['generate']['yaml_file']}"
+
+    return yaml_file, f"{yaml_file}{STATE_FILE_SUFFIX}", get_sources(cfg)
+
+# -----------------------------------------------------------------------------
+# Function to run generate, returning False instead of exiting on error
+# Table errors left after the retries (e.g. a dropped connection), file
+# errors (e.g. a full disk) and configuration errors fail the pass, which is
+# retried after a back off
+# -----------------------------------------------------------------------------
+def run_generate(table_client, config_file):
+
+    try:
+        do_generate(table_client, config_file)
+    except SystemExit as err:
+        if err.code in [0, None]:
+            return True
+        print("generate failed, will retry")
+        return False
+    except (AzureError, OSError) as err:
+        print("generate failed, will retry -", err)
+        return False
+    except Exception as err:
+        if not is_config_error(err):
+            raise
+        print("generate failed, will retry - invalid config file -", err)
+        return False
+
+    return True
+
+# -----------------------------------------------------------------------------
+# Function to run generate as a daemon, polling the table for changes
+# Polls every interval seconds, backing off to WATCH_MAX_BACKOFF times the
+# interval while nothing changes. The machine list is reconciled (to catch
+# deleted machines) whenever the poll interval reaches its maximum
+# SIGTERM/SIGINT stop the daemon after the current pass, SIGHUP triggers an
+# immediate refresh (and re-reads the configuration file)
+# -----------------------------------------------------------------------------
+def do_watch(table_client, config_file, interval):
+
+    wakeup = threading.Event()
+    flags = {'stop': False, 'refresh': False}
+
+    def handle_stop(signum, frame):
+        flags['stop'] = True
+        wakeup.set()
+
+    def handle_refresh(signum, frame):
+        flags['refresh'] = True
+        wakeup.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGHUP, handle_refresh)
+
+    max_wait = interval * WATCH_MAX_BACKOFF
+    wait = interval
+    source_clients = {}
+
+    watch_config = load_watch_config(config_file)
+    if watch_config is None:
+        print("Invalid config file", config_file)
+        sys.exit(2)
+
+    print("Watching for changes every", interval, "seconds")
+
+    run_generate(table_client, config_file)
+
+    while not flags['stop']:
+        wakeup.wait(wait)
+        wakeup.clear()
+
+        if flags['stop']:
+            break
+
+        # Keep the previous configuration if the file can't be read
+        new_config = load_watch_config(config_file)
+        if new_config is not None:
+            watch_config = new_config
+        else:
+            print("Keeping the previous configuration")
+        yaml_file, state_file, sources = watch_config
+
+        if flags['refresh']:
+            if gbl.VERBOSE:
+                print("Refresh requested")
+            flags['refresh'] = False
+            run_now = True
+        elif wait >= max_wait:
+            run_now = True
+        elif sources is None:
+            run_now = check_for_changes(table_client, state_file)
+        else:
+            run_now = check_sources_for_changes(sources, yaml_file, source_clients)
+
+        if not run_now:
+            wait = min(wait * 2, max_wait)
+            if gbl.DEBUG:
+                print("No changes, next poll in", wait, "seconds")
+            continue
+
+        if run_generate(table_client, config_file):
+            wait = interval
+        else:
+            wait = min(wait * 2, max_wait)
+
+    print("Stopping")